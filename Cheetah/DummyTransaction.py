@@ -13,6 +13,29 @@ class DummyResponse(object):
         return ''.join(self._outputChunks)
 
 
+class StreamingResponse(DummyResponse):
+    """A response whose output can be taken out of it as it is written."""
+
+    def __init__(self):
+        super(StreamingResponse, self).__init__()
+        self._size = 0
+        self._sizedChunks = 0
+
+    def size(self):
+        """The number of characters written since the last flush()."""
+        chunks = self._outputChunks
+        self._size += sum(map(len, chunks[self._sizedChunks:]))
+        self._sizedChunks = len(chunks)
+        return self._size
+
+    def flush(self):
+        """Returns the output written since the last flush()."""
+        output = self.getvalue()
+        del self._outputChunks[:]
+        self._size = self._sizedChunks = 0
+        return output
+
+
 class DummyTransaction(object):
     '''
         A dummy Transaction class is used by Cheetah in place of real Webware
@@ -115,15 +115,89 @@ Implementation details
 
 * NameMapper's search order is dictionary keys then object attributes
 
-* NameMapper.NotFound is raised if a value can't be found for a name.
-
-Cheetah uses the optimized C version (_namemapper.c) invariantly
+* NameMapper.NotFound is raised if a value can't be found for a name.  It
+  carries the missing part of the name as .key and the full name as .name, and
+  only formats its message when it is looked at.  valueFromSearchList and
+  valueFromFrameOrSearchList take a default= to return instead of raising.
+
+* valuesFromSearchList and valuesFromFrameOrSearchList look up a sequence of
+  names in a single pass over the namespaces and return a tuple of values
+  (or the default for names that can't be found).
+
+* valueFromSearchList and valueFromFrameOrSearchList take an optional
+  InlineCache.  Compiled templates give every placeholder its own cache, which
+  remembers the searchList index (and whether it was a key or an attribute)
+  that resolved the name last time.  The cache is guarded by the identity and
+  version tags of the namespaces searched before that index, so it is only used
+  while none of them could have gained the name.
+
+* compile_name(name, executeCallables, useDottedNotation) splits a name into
+  interned chunks once and fixes its flags.  The lookup functions accept the
+  result anywhere they accept a name, and a compiled name passed to
+  valueFromSearchList or valueFromFrameOrSearchList brings its own inline
+  cache.  Compiled templates emit one compiled name per call site; plain string
+  names are split once and remembered in a bounded table.
+
+* compile_name(name, lookupMode='dict') is for namespaces of plain nested
+  dicts (decoded JSON, say): every chunk after the first is looked up as a
+  mapping key only, never as an attribute, and nothing is autocalled.  The
+  first chunk is searched for as usual.  Templates compiled with the
+  'lookupMode' setting set to 'dict' use such names.
+
+* SearchList is a list of namespaces that keeps a merged index over every run
+  of consecutive dicts in it, so such a run costs one probe however many dicts
+  it has.  An index is rebuilt once one of its dicts (or the list) changed.
+  A SearchList also remembers which of its leading namespaces don't have the
+  names it was last searched for (guarded like an inline cache), so names that
+  keep missing, or that live in globals or builtins, skip straight past them.
+  Templates keep their searchList in a SearchList.
+
+* enable_stats() turns on lookup statistics, get_stats() returns them and
+  reset_stats() forgets them.  For every name that was searched for
+  (valueFromSearchList, valueFromFrameOrSearchList, valueFromFrame and the
+  batch versions) get_stats() has a dict of:
+
+    - 'locals', 'globals', 'builtins': how often the name was found there
+    - 'searchList': {searchList index: how often the name was found there}
+    - 'misses': lookups that ended in NotFound (also those using a default)
+    - 'autocalls': values the lookups called
+    - 'time': seconds spent in the lookups, autocalls included
+
+  A name counts as found wherever its first chunk was found.  enable_stats(False)
+  turns them off again; disabled statistics cost a single check per lookup.
+
+* On python 3 _namemapper keeps everything in per-module state, so
+  subinterpreters (also those with their own GIL) each get their own copy.  On
+  free-threaded builds it locks the caches that lookups share.
+
+Cheetah uses the optimized C version (_namemapper.c) when it is available.  On
+PyPy, or where the extension wasn't built, it uses the pure python version
+(_pynamemapper.py) instead, which behaves the same but never hits its inline
+caches.
 """
-
-# pylint:disable=unused-import
-from Cheetah._namemapper import NotFound  # noqa (intentionally unused)
-from Cheetah._namemapper import valueForKey  # noqa (intentionally unused)
-from Cheetah._namemapper import valueForName  # noqa (intentionally unused)
-from Cheetah._namemapper import valueFromSearchList  # noqa (intentionally unused)
-from Cheetah._namemapper import valueFromFrameOrSearchList  # noqa (intentionally unused)
-from Cheetah._namemapper import valueFromFrame  # noqa (intentionally unused)
+import platform
+
+try:
+    if platform.python_implementation() == 'PyPy':  # pragma: no cover
+        # cpyext makes the extension slower than the pure python version
+        raise ImportError
+    from Cheetah import _namemapper as _impl
+except ImportError:  # pragma: no cover
+    from Cheetah import _pynamemapper as _impl
+
+CompiledName = _impl.CompiledName
+InlineCache = _impl.InlineCache
+NotFound = _impl.NotFound
+SearchList = _impl.SearchList
+TooManyPeriodsInName = _impl.TooManyPeriodsInName
+valueForKey = _impl.valueForKey
+valueForName = _impl.valueForName
+valueFromSearchList = _impl.valueFromSearchList
+valueFromFrameOrSearchList = _impl.valueFromFrameOrSearchList
+valueFromFrame = _impl.valueFromFrame
+valuesFromSearchList = _impl.valuesFromSearchList
+valuesFromFrameOrSearchList = _impl.valuesFromFrameOrSearchList
+compile_name = _impl.compile_name
+enable_stats = _impl.enable_stats
+get_stats = _impl.get_stats
+reset_stats = _impl.reset_stats
@@ -60,7 +60,10 @@ def readSettingsFromConfigFileObj(file_obj):
     * The string 'False' will be converted to a Python false value
     """
     parser = ConfigParserCaseSensitive()
-    parser.readfp(file_obj)
+    if five.PY2:  # pragma: no cover (PY2)
+        parser.readfp(file_obj)
+    else:  # pragma: no cover (PY3)
+        parser.read_file(file_obj)
     assert 'globals' in parser.sections()
 
     return dict(
@@ -1,6 +1,7 @@
 """SourceReader class for Cheetah's LegacyParser and CodeGenerator"""
 from __future__ import unicode_literals
 
+import bisect
 import re
 
 EOLre = re.compile(r'[ \f\t]*(?:\r\n|\r|\n)')
@@ -12,27 +13,44 @@ WS_CHARS = ' \t'
 
 class SourceReader(object):  # pylint:disable=too-many-public-methods
     def __init__(self, src):
+        self._srcStack = []
+        self._readSrc(src)
+
+    def _readSrc(self, src):
         self._src = src
         self._srcLines = None
-        self._breakPoint = len(self._src)
+        self._breakPoint = len(src)
         self._pos = 0
 
-        # collect some meta-information
+        # collect some meta-information: where each line begins and ends
         self._EOLs = []
+        self._BOLs = []
         pos = 0
-        while pos < len(self):
+        while pos < len(src):
             EOLmatch = EOLZre.search(src, pos)
+            self._BOLs.append(pos)
             self._EOLs.append(EOLmatch.start())
             pos = EOLmatch.end()
 
-        self._BOLs = []
-        for pos in self._EOLs:
-            BOLpos = self.findBOL(pos)
-            self._BOLs.append(BOLpos)
-
     def src(self):
         return self._src
 
+    def pushSrc(self, src):
+        """Reads src (e.g. the output of a macro) from its start, until
+        popSrc() goes back to the current source and position.
+        """
+        self._srcStack.append((
+            self._src, self._srcLines, self._breakPoint, self._pos,
+            self._EOLs, self._BOLs,
+        ))
+        self._readSrc(src)
+
+    def popSrc(self):
+        (
+            self._src, self._srcLines, self._breakPoint, self._pos,
+            self._EOLs, self._BOLs,
+        ) = self._srcStack.pop()
+
     def __len__(self):
         return self._breakPoint
 
@@ -45,10 +63,10 @@ class SourceReader(object):  # pylint:disable=too-many-public-methods
         return self._srcLines
 
     def lineNum(self, pos):
-        for i in range(len(self._BOLs)):
-            if pos >= self._BOLs[i] and pos <= self._EOLs[i]:
-                return i
-        raise AssertionError('unknown position: {0}'.format(pos))
+        i = bisect.bisect_right(self._BOLs, pos) - 1
+        if i < 0 or pos > self._EOLs[i]:
+            raise AssertionError('unknown position: {0}'.format(pos))
+        return i
 
     def getRowCol(self, pos=None):
         if pos is None:
@@ -134,22 +152,20 @@ class SourceReader(object):  # pylint:disable=too-many-public-methods
             pos = EOLmatch.start()
         return self.readTo(to=pos, start=start)
 
-    def find(self, it, pos=None):
+    def startswith(self, it, pos=None):
         if pos is None:
             pos = self._pos
-        return self._src.find(it, pos)
-
-    def startswith(self, it, pos=None):
-        if self.find(it, pos) == self.pos():
-            return True
-        else:
-            return False
+        return self._src.startswith(it, pos)
 
     def findBOL(self, pos=None):
         if pos is None:
             pos = self._pos
-        src = self.src()
-        return max(src.rfind('\n', 0, pos) + 1, src.rfind('\r', 0, pos) + 1, 0)
+        i = bisect.bisect_right(self._BOLs, pos) - 1
+        if i >= 0 and pos <= self._EOLs[i]:
+            return self._BOLs[i]
+        else:
+            # right after a line break (or the start of an empty source)
+            return pos
 
     def findEOL(self, gobble=False):
         match = EOLZre.search(self.src(), self._pos)
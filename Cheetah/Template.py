@@ -6,7 +6,7 @@ from __future__ import unicode_literals
 
 from Cheetah import five
 from Cheetah.filters import filters
-from Cheetah.NameMapper import NotFound, valueFromSearchList
+from Cheetah.NameMapper import SearchList, compile_name, valueFromSearchList
 from Cheetah.Unspecified import Unspecified
 
 
@@ -17,6 +17,24 @@ from Cheetah.Unspecified import Unspecified
 # None or empty-string can be filtered into useful data, unlike NO_CONTENT.
 NO_CONTENT = object()
 
+# getVar / varExists names, compiled once.  Bounded so arbitrary runtime names
+# can't grow it forever.
+_compiled_names = {}
+_COMPILED_NAMES_MAX = 1024
+
+
+def _compiled_name(varName, autoCall, useDottedNotation):
+    key = (varName, autoCall, useDottedNotation)
+    try:
+        return _compiled_names[key]
+    except KeyError:
+        if len(_compiled_names) >= _COMPILED_NAMES_MAX:
+            _compiled_names.clear()
+        ret = _compiled_names[key] = compile_name(
+            varName.replace('$', ''), autoCall, useDottedNotation,
+        )
+        return ret
+
 
 class Template(object):
     """This class provides methods used by templates at runtime
@@ -94,8 +112,8 @@ class Template(object):
 
         self._CHEETAH__globalSetVars = {}
 
-        # create our own searchList
-        self._CHEETAH__searchList = [self._CHEETAH__globalSetVars, self]
+        # create our own searchList, indexed over its runs of dicts
+        self._CHEETAH__searchList = SearchList([self._CHEETAH__globalSetVars, self])
         if searchList is not None:
             self._CHEETAH__searchList.extend(list(searchList))
 
@@ -104,6 +122,22 @@ class Template(object):
 
         self.transaction = None
 
+    @property
+    def transaction(self):
+        """The transaction whose response the template methods write their
+        output to, or None outside of rendering.  A method called while there
+        is one writes to it and returns NO_CONTENT; otherwise it writes to a
+        transaction of its own and returns the output.
+        """
+        return self._CHEETAH__transaction
+
+    @transaction.setter
+    def transaction(self, trans):
+        # Compiled methods write to _CHEETAH__write, so they don't have to
+        # look up the response of the transaction every call.
+        self._CHEETAH__transaction = trans
+        self._CHEETAH__write = trans.response().write if trans else None
+
     def searchList(self):
         """Return a reference to the searchlist"""
         return self._CHEETAH__searchList
@@ -113,21 +147,16 @@ class Template(object):
         in the searchList, it returns the default value if one was given, or
         raises NameMapper.NotFound.
         """
-        try:
-            return valueFromSearchList(self.searchList(), varName.replace('$', ''), autoCall, useDottedNotation)
-        except NotFound:
-            if default is not Unspecified:
-                return default
-            else:
-                raise
+        name = _compiled_name(varName, autoCall, useDottedNotation)
+        if default is not Unspecified:
+            return valueFromSearchList(self.searchList(), name, default=default)
+        else:
+            return valueFromSearchList(self.searchList(), name)
 
     def varExists(self, varName, autoCall=False, useDottedNotation=True):
         """Test if a variable name exists in the searchList."""
-        try:
-            valueFromSearchList(self.searchList(), varName.replace('$', ''), autoCall, useDottedNotation)
-            return True
-        except NotFound:
-            return False
+        name = _compiled_name(varName, autoCall, useDottedNotation)
+        return valueFromSearchList(self.searchList(), name, default=Unspecified) is not Unspecified
 
     def respond(self):
         raise NotImplementedError
@@ -0,0 +1,574 @@
+"""A pure python implementation of Cheetah._namemapper.
+
+Cheetah.NameMapper uses it on PyPy (where C extensions go through the slow
+cpyext layer) and wherever the C extension isn't available.  It has the same
+semantics as the C version, except that inline caches never answer a lookup:
+without dict version tags there's no cheap way to tell that a namespace hasn't
+gained a name.
+
+The lookups are written to be easy on a tracing JIT: plain loops over the
+namespaces, no exceptions for misses in the common cases, and only
+valueFromFrame / valueFromFrameOrSearchList look at the caller's frame.
+"""
+from __future__ import unicode_literals
+
+import sys
+import time
+import types
+
+from Cheetah import five
+
+
+MAXCHUNKS = 15
+NAME_TABLE_SIZE = 4096
+# useDottedNotation of lookupMode='dict' names: every chunk after the first is
+# a mapping key, never an attribute
+_DICT_LOOKUPS = 2
+
+# Stands in for arguments that weren't passed and for failed probes.  It can't
+# be Unspecified, which callers pass as a default= of their own.
+_missing = object()
+
+if five.PY2:  # pragma: no cover
+    def _intern(chunk):
+        # intern() only takes native strings on python 2
+        try:
+            return intern(str(chunk))  # noqa
+        except UnicodeEncodeError:
+            return chunk
+    _text_types = (str, five.text)
+    _old_style_types = (types.ClassType, types.InstanceType)
+else:  # pragma: no cover
+    _intern = sys.intern
+    _text_types = (str,)
+    _old_style_types = ()
+
+try:
+    _now = time.perf_counter
+except AttributeError:  # pragma: no cover (python 2)
+    _now = time.time
+
+
+class NotFound(LookupError):
+    """A name could not be found"""
+    key = None
+    name = None
+    _formatted = False
+
+    def _format(self):
+        if self._formatted:
+            return
+        self._formatted = True
+        args = LookupError.args.__get__(self)
+        if not args and self.key is not None:
+            message = "cannot find '{0}'".format(self.key)
+            if self.name is not None:
+                message += " while searching for '{0}'".format(self.name)
+        elif len(args) == 1 and self.name is not None:
+            message = "{0} while searching for '{1}'".format(args[0], self.name)
+        else:
+            return
+        LookupError.args.__set__(self, (message,))
+
+    @property
+    def args(self):
+        self._format()
+        return LookupError.args.__get__(self)
+
+    @args.setter
+    def args(self, value):
+        LookupError.args.__set__(self, value)
+        self._formatted = True
+
+    def __str__(self):
+        self._format()
+        return LookupError.__str__(self)
+
+    def __repr__(self):
+        self._format()
+        return LookupError.__repr__(self)
+
+
+class TooManyPeriodsInName(Exception):
+    pass
+
+
+def _not_found(key, name=None):
+    exc = NotFound()
+    exc.key = key
+    exc.name = name
+    return exc
+
+
+def _wrap_not_found(exc, name):
+    """Record the full name on a NotFound raised while looking up one of its
+    chunks, unless a nested lookup already did.
+    """
+    if exc.name is None:
+        exc.name = name
+        exc._formatted = False
+
+
+class InlineCache(object):
+    """Per-call-site cache for valueFromSearchList / valueFromFrameOrSearchList"""
+    __slots__ = ('hits', 'misses')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+
+class CompiledName(object):
+    """A name prepared by compile_name()"""
+    __slots__ = ('name', 'chunks', 'executeCallables', 'useDottedNotation', 'lookupMode', 'hits', 'misses')
+
+    def __init__(self, name, chunks, executeCallables, useDottedNotation, lookupMode):
+        self.name = name
+        self.chunks = chunks
+        self.executeCallables = executeCallables
+        self.useDottedNotation = useDottedNotation
+        self.lookupMode = lookupMode
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'compile_name({0!r}, {1}, {2}{3})'.format(
+            self.name, bool(self.executeCallables), bool(self.useDottedNotation),
+            ", lookupMode='dict'" if self.lookupMode == 'dict' else '',
+        )
+
+
+class SearchList(list):
+    """A list of namespaces.  The C version keeps a merged index over its runs
+    of dicts; here it is searched like any other list.
+    """
+    __slots__ = ()
+
+
+def _flag(value):
+    """The same conversion as the "i" argument format of the C version."""
+    if isinstance(value, float):
+        raise TypeError('integer argument expected, got float')
+    return int(value)
+
+
+def _split_name(name):
+    """Split name on periods into a tuple of interned chunks.  A trailing
+    period is ignored and an empty name becomes a single empty chunk.
+    """
+    if name.count('.') > MAXCHUNKS - 2:
+        raise TooManyPeriodsInName(name)
+    chunks = name.split('.')
+    if len(chunks) > 1 and not chunks[-1]:
+        chunks.pop()
+    return tuple([_intern(five.text(chunk)) for chunk in chunks])
+
+
+_name_table = {}
+
+
+def _name_chunks(name):
+    """Returns the tuple of chunks for name, which is either a string or a
+    CompiledName.
+    """
+    if type(name) is CompiledName:
+        return name.chunks
+    if not isinstance(name, _text_types):
+        raise TypeError('name must be a string or a CompiledName')
+    chunks = _name_table.get(name)
+    if chunks is None:
+        chunks = _split_name(name)
+        if len(_name_table) >= NAME_TABLE_SIZE:
+            _name_table.clear()
+        _name_table[name] = chunks
+    return chunks
+
+
+def _resolve_flags(name, executeCallables, useDottedNotation):
+    """A CompiledName carries its own flags; passing them again is an error.
+    Otherwise unspecified flags get their defaults.
+    """
+    if type(name) is CompiledName:
+        if executeCallables is not _missing or useDottedNotation is not _missing:
+            raise TypeError('executeCallables and useDottedNotation are fixed by compile_name()')
+        if name.lookupMode == 'dict':
+            return name.executeCallables, _DICT_LOOKUPS
+        return name.executeCallables, name.useDottedNotation
+    return (
+        False if executeCallables is _missing else _flag(executeCallables) != 0,
+        True if useDottedNotation is _missing else _flag(useDottedNotation) != 0,
+    )
+
+
+def _full_name(name):
+    return name.name if type(name) is CompiledName else name
+
+
+def _is_mapping(obj):
+    return type(obj) is dict or hasattr(type(obj), '__getitem__')
+
+
+def _get_item(mapping, key):
+    """Returns mapping[key], or _missing if that fails in any way."""
+    if type(mapping) is dict:
+        return mapping.get(key, _missing)
+    try:
+        return mapping[key]
+    except Exception:
+        return _missing
+
+
+def _get_attr(obj, key):
+    """Returns the attribute, or _missing if there's no such attribute.
+    Other errors propagate.
+    """
+    try:
+        return getattr(obj, key)
+    except AttributeError:
+        return _missing
+
+
+def _probe(nameSpace, key):
+    """Look key up in a searchList namespace: first as a key of mappings,
+    then as an attribute.  Like hasattr(), any error counts as a miss.
+    """
+    if _is_mapping(nameSpace):
+        value = _get_item(nameSpace, key)
+        if value is not _missing:
+            return value
+    try:
+        return _get_attr(nameSpace, key)
+    except Exception:
+        return _missing
+
+
+def _is_instance_or_class(value):
+    if isinstance(value, (type,) + _old_style_types):
+        return True
+    # functions and their bound methods are only instances or classes if
+    # someone gave them an 'mro' attribute
+    if isinstance(value, types.FunctionType):
+        return 'mro' in value.__dict__
+    if isinstance(value, types.MethodType) and isinstance(value.__func__, types.FunctionType):
+        return 'mro' in value.__func__.__dict__
+
+    if not hasattr(value, '__class__'):  # pragma: no cover (old style)
+        return False
+    if hasattr(value, 'mro'):
+        return True
+    # method, func, or builtin func
+    if hasattr(value, 'im_func') or hasattr(value, 'func_code') or hasattr(value, '__self__'):
+        return False
+    # instance
+    return hasattr(value, '__init__')
+
+
+class _NameStats(object):
+    """Lookup statistics of one name, see get_stats()."""
+    __slots__ = ('locals', 'searchList', 'globals', 'builtins', 'misses', 'autocalls', 'time')
+
+    def __init__(self):
+        self.locals = self.globals = self.builtins = 0
+        self.misses = self.autocalls = 0
+        self.searchList = {}
+        self.time = 0.0
+
+    def count_hit(self, source):
+        if source == 'locals':
+            self.locals += 1
+        elif source == 'globals':
+            self.globals += 1
+        elif source == 'builtins':
+            self.builtins += 1
+        else:
+            self.searchList[source] = self.searchList.get(source, 0) + 1
+
+    def as_dict(self):
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__)
+
+
+_stats_enabled = False
+_stats = {}
+
+
+def _start_stats(name):
+    """Returns the _NameStats to record a lookup of name in, or None if
+    statistics are disabled.
+    """
+    if not _stats_enabled:
+        return None
+    name = _full_name(name)
+    stats = _stats.get(name)
+    if stats is None:
+        stats = _stats.setdefault(name, _NameStats())
+    return stats
+
+
+def _autocall(value, executeCallables, stats=None):
+    if executeCallables and callable(value) and not _is_instance_or_class(value):
+        if stats is not None:
+            stats.autocalls += 1
+        return value()
+    return value
+
+
+def _value_for_name(obj, chunks, executeCallables, useDottedNotation, stats=None):
+    value = obj
+    for key in chunks:
+        nextValue = _missing
+        if useDottedNotation == _DICT_LOOKUPS:
+            # keys only, no attributes
+            if _is_mapping(value):
+                nextValue = _get_item(value, key)
+            if nextValue is _missing:
+                raise _not_found(key)
+        elif useDottedNotation and _is_mapping(value):
+            nextValue = _get_item(value, key)
+        if nextValue is _missing:
+            nextValue = _get_attr(value, key)
+            if nextValue is _missing:
+                raise _not_found(key)
+        value = _autocall(nextValue, executeCallables, stats)
+    return value
+
+
+def _finish_lookup(firstValue, name, chunks, executeCallables, useDottedNotation, stats=None, source=None):
+    """Finish a lookup whose first chunk resolved to firstValue, found in
+    source (counted in stats, if given).
+    """
+    if stats is not None:
+        stats.count_hit(source)
+    try:
+        value = _autocall(firstValue, executeCallables, stats)
+        if len(chunks) > 1:
+            value = _value_for_name(value, chunks[1:], executeCallables, useDottedNotation, stats)
+        return value
+    except NotFound as e:
+        _wrap_not_found(e, name)
+        raise
+
+
+def _search(searchList, key, frame):
+    """Returns the value of key in the first namespace that has it, or
+    _missing, together with where it was found: 'locals', 'globals',
+    'builtins' or a searchList index.  With a frame its locals are searched
+    before the searchList and its globals and builtins after it.
+    """
+    if frame is not None:
+        value = _probe(frame.f_locals, key)
+        if value is not _missing:
+            return value, 'locals'
+
+    try:
+        nameSpaces = iter(searchList)
+    except TypeError:
+        raise TypeError('This searchList is not iterable!')
+    for index, nameSpace in enumerate(nameSpaces):
+        value = _probe(nameSpace, key)
+        if value is not _missing:
+            return value, index
+
+    if frame is not None:
+        value = _probe(frame.f_globals, key)
+        if value is not _missing:
+            return value, 'globals'
+        return _probe(frame.f_builtins, key), 'builtins'
+    return _missing, None
+
+
+def _search_list_lookup(searchList, name, executeCallables, useDottedNotation, cache, default, frame):
+    executeCallables, useDottedNotation = _resolve_flags(name, executeCallables, useDottedNotation)
+    if cache is not None:
+        if type(cache) is not InlineCache:
+            raise TypeError('cache must be an InlineCache or None')
+    elif type(name) is CompiledName:
+        cache = name
+    chunks = _name_chunks(name)
+    if cache is not None:
+        cache.misses += 1
+    stats = _start_stats(name)
+    if stats is not None:
+        start = _now()
+
+    try:
+        firstValue, source = _search(searchList, chunks[0], frame)
+        if firstValue is _missing:
+            raise _not_found(chunks[0], _full_name(name))
+        return _finish_lookup(
+            firstValue, _full_name(name), chunks, executeCallables, useDottedNotation, stats, source,
+        )
+    except NotFound:
+        if stats is not None:
+            stats.misses += 1
+        if default is _missing:
+            raise
+        return default
+    finally:
+        if stats is not None:
+            stats.time += _now() - start
+
+
+def _batch_lookup(searchList, names, executeCallables, useDottedNotation, default, frame):
+    """Look up the first chunks of all names during a single pass over the
+    namespaces, then finish every lookup in order.  Statistics split the time
+    of the shared pass evenly between the names.
+    """
+    start = _now() if _stats_enabled else None
+    try:
+        names = tuple(names)
+    except TypeError:
+        raise TypeError('names must be a sequence')
+    items = []
+    for name in names:
+        flags = _resolve_flags(name, executeCallables, useDottedNotation)
+        items.append((name, _name_chunks(name)) + flags + (_start_stats(name),))
+    values = [_missing] * len(items)
+    sources = [None] * len(items)
+    remaining = len(items)
+
+    def probe(nameSpace, source, remaining):
+        for i, item in enumerate(items):
+            if values[i] is _missing:
+                values[i] = _probe(nameSpace, item[1][0])
+                if values[i] is not _missing:
+                    sources[i] = source
+                    remaining -= 1
+        return remaining
+
+    if frame is not None:
+        remaining = probe(frame.f_locals, 'locals', remaining)
+    if remaining:
+        try:
+            nameSpaces = iter(searchList)
+        except TypeError:
+            raise TypeError('This searchList is not iterable!')
+        for index, nameSpace in enumerate(nameSpaces):
+            remaining = probe(nameSpace, index, remaining)
+            if not remaining:
+                break
+    if frame is not None and remaining:
+        remaining = probe(frame.f_globals, 'globals', remaining)
+        remaining = probe(frame.f_builtins, 'builtins', remaining)
+    if start is not None:
+        shareOfScan = (_now() - start) / max(len(items), 1)
+
+    results = []
+    for item, firstValue, source in zip(items, values, sources):
+        name, chunks, itemExecuteCallables, itemUseDottedNotation, stats = item
+        if stats is not None:
+            start = _now() - shareOfScan
+        try:
+            if firstValue is _missing:
+                raise _not_found(chunks[0], _full_name(name))
+            results.append(_finish_lookup(
+                firstValue, _full_name(name), chunks, itemExecuteCallables, itemUseDottedNotation,
+                stats, source,
+            ))
+        except NotFound:
+            if stats is not None:
+                stats.misses += 1
+            if default is _missing:
+                raise
+            results.append(default)
+        finally:
+            if stats is not None:
+                stats.time += _now() - start
+    return tuple(results)
+
+
+def valueForKey(obj, key):
+    if not isinstance(key, _text_types):
+        raise TypeError('key must be a string')
+    value = _probe(obj, key)
+    if value is _missing:
+        raise _not_found(key)
+    return value
+
+
+def valueForName(obj, name, executeCallables=_missing, useDottedNotation=_missing):
+    executeCallables, useDottedNotation = _resolve_flags(name, executeCallables, useDottedNotation)
+    chunks = _name_chunks(name)
+    try:
+        return _value_for_name(obj, chunks, executeCallables, useDottedNotation)
+    except NotFound as e:
+        _wrap_not_found(e, _full_name(name))
+        raise
+
+
+def valueFromSearchList(
+        searchList, name, executeCallables=_missing, useDottedNotation=_missing,
+        cache=None, default=_missing,
+):
+    return _search_list_lookup(searchList, name, executeCallables, useDottedNotation, cache, default, None)
+
+
+def valueFromFrameOrSearchList(
+        searchList, name, executeCallables=_missing, useDottedNotation=_missing,
+        cache=None, default=_missing,
+):
+    return _search_list_lookup(
+        searchList, name, executeCallables, useDottedNotation, cache, default, sys._getframe(1),
+    )
+
+
+def valueFromFrame(name, executeCallables=_missing, useDottedNotation=_missing):
+    executeCallables, useDottedNotation = _resolve_flags(name, executeCallables, useDottedNotation)
+    chunks = _name_chunks(name)
+    frame = sys._getframe(1)
+    stats = _start_stats(name)
+    if stats is not None:
+        start = _now()
+    try:
+        for source, nameSpace in (
+                ('locals', frame.f_locals), ('globals', frame.f_globals), ('builtins', frame.f_builtins),
+        ):
+            firstValue = _probe(nameSpace, chunks[0])
+            if firstValue is not _missing:
+                return _finish_lookup(
+                    firstValue, _full_name(name), chunks, executeCallables, useDottedNotation, stats, source,
+                )
+        raise _not_found(chunks[0], _full_name(name))
+    except NotFound:
+        if stats is not None:
+            stats.misses += 1
+        raise
+    finally:
+        if stats is not None:
+            stats.time += _now() - start
+
+
+def valuesFromSearchList(
+        searchList, names, executeCallables=_missing, useDottedNotation=_missing, default=_missing,
+):
+    return _batch_lookup(searchList, names, executeCallables, useDottedNotation, default, None)
+
+
+def valuesFromFrameOrSearchList(
+        searchList, names, executeCallables=_missing, useDottedNotation=_missing, default=_missing,
+):
+    return _batch_lookup(searchList, names, executeCallables, useDottedNotation, default, sys._getframe(1))
+
+
+def compile_name(name, executeCallables=0, useDottedNotation=1, lookupMode='default'):
+    if not isinstance(name, _text_types):
+        raise TypeError('name must be a string')
+    if lookupMode not in ('default', 'dict'):
+        raise ValueError("lookupMode must be 'default' or 'dict', not '{0}'".format(lookupMode))
+    # names in dict mode are never autocalled
+    return CompiledName(
+        name, _split_name(name), int(_flag(executeCallables) != 0 and lookupMode != 'dict'),
+        int(_flag(useDottedNotation) != 0), lookupMode,
+    )
+
+
+def enable_stats(enabled=True):
+    global _stats_enabled
+    _stats_enabled = bool(enabled)
+
+
+def get_stats():
+    return dict((name, stats.as_dict()) for name, stats in _stats.items())
+
+
+def reset_stats():
+    _stats.clear()
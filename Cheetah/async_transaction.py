@@ -0,0 +1,88 @@
+"""Provides the output buffering of templates compiled with asyncRespond.
+
+Methods of those templates are coroutines.  A placeholder whose value is
+awaitable takes its place in the output, and all of them are awaited
+concurrently when the method (or #call region) finishes.  Needs python 3.5+.
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import inspect
+
+from Cheetah import five
+from Cheetah.DummyTransaction import DummyTransaction
+from Cheetah.Template import NO_CONTENT
+
+
+class RenderedOutput(five.text):
+    """The output of an async template method.  It was filtered as it was
+    written, so placeholders write it as it is.
+    """
+    __slots__ = ()
+
+
+async def _resolve(template, awaitable, currentFilter):
+    # Template methods the awaitable calls start with the filter which was
+    # current at the placeholder.
+    template._CHEETAH__currentFilter = currentFilter
+    return await awaitable
+
+
+class AsyncTransaction(DummyTransaction):
+    """A transaction (and its own response) for an async template method."""
+
+    def __init__(self, template):
+        super(AsyncTransaction, self).__init__()
+        self._template = template
+        self._outputChunks = []
+        self._pending = []
+
+    def response(self, resp=None):
+        return self
+
+    def write(self, value):
+        self._outputChunks.append(value)
+
+    def write_value(self, value, placeholderFilter):
+        """Writes the filtered value of a placeholder, or leaves its place
+        in the output to an awaitable value.
+        """
+        if value is NO_CONTENT:
+            return
+        elif inspect.isawaitable(value):
+            self._pending.append((
+                len(self._outputChunks), value, placeholderFilter,
+                self._template._CHEETAH__currentFilter,
+            ))
+            self._outputChunks.append('')
+        else:
+            self._outputChunks.append(placeholderFilter(value))
+
+    async def finish(self):
+        """Awaits the awaitable values together and returns the output.
+
+        The template's transaction and current filter are the same
+        afterwards as before, whatever the awaited methods did to them.
+        """
+        pending, self._pending = self._pending, []
+        if pending:
+            template = self._template
+            transaction = template.transaction
+            currentFilter = template._CHEETAH__currentFilter
+            try:
+                # gather() starts coroutines in no particular order on 3.6
+                values = await asyncio.gather(*[
+                    asyncio.ensure_future(_resolve(template, awaitable, placeholderCurrentFilter))
+                    for _, awaitable, _, placeholderCurrentFilter in pending
+                ])
+            finally:
+                template.transaction = transaction
+                template._CHEETAH__currentFilter = currentFilter
+            for (index, _, placeholderFilter, _), value in zip(pending, values):
+                if value is NO_CONTENT:
+                    continue
+                elif isinstance(value, RenderedOutput):
+                    self._outputChunks[index] = value
+                else:
+                    self._outputChunks[index] = placeholderFilter(value)
+        return RenderedOutput(''.join(self._outputChunks))
@@ -13,8 +13,10 @@ Last Revision Date: $Date: 2007/12/10 18:25:20 $
 
 /* *************************************************************************** */
 #include <Python.h>
+#include <structmember.h>
 #include <string.h>
 #include <stdlib.h>
+#include <time.h>
 
 #include "namemapper.h"
 
@@ -23,27 +25,325 @@ extern "C" {
 #endif
 
 
-static PyObject *NotFound;   /* locally-raised exception */
-static PyObject *TooManyPeriods;   /* locally-raised exception */
-static PyObject* pprintMod_pformat; /* used for exception formatting */
+#ifndef IS_PYTHON3
+/* *************************************************************************** */
+/* Python 2 */
+/* *************************************************************************** */
+
+/* 2.x has no PyType_Spec.  The types are static there, and nm_addType fills
+ * them in from the same slots the heap types on 3.x are made of.
+ */
+typedef struct {
+    int slot;
+    void *pfunc;
+} PyType_Slot;
+
+typedef struct {
+    const char *name;
+    int basicsize;
+    int itemsize;
+    unsigned int flags;
+    PyType_Slot *slots;
+} PyType_Spec;
+
+enum {
+    Py_tp_dealloc = 1, Py_tp_repr, Py_tp_str, Py_tp_doc, Py_tp_traverse, Py_tp_clear, Py_tp_members,
+    Py_tp_getset, Py_tp_new
+};
+
+static void *PyMem_Calloc(size_t nelem, size_t elsize)
+{
+    void *mem = PyMem_Malloc(nelem * elsize);
+
+    if (mem != NULL) {
+        memset(mem, 0, nelem * elsize);
+    }
+    return mem;
+}
+
+/* Names are str or unicode; unicode ones must be ascii to be looked up. */
+#define NM_TEXT_CHECK(op) (PyString_Check(op) || PyUnicode_Check(op))
+#define NM_INTERN_FROM_STRING PyString_InternFromString
+
+static const char *nm_textAsUTF8(PyObject *text)
+{
+    if (PyUnicode_Check(text) && !(text = _PyUnicode_AsDefaultEncodedString(text, NULL))) {
+        return NULL;
+    }
+    return PyString_AsString(text);
+}
+
+/* intern() only takes native strings */
+static PyObject *nm_chunkFromString(const char *chunk, Py_ssize_t size)
+{
+    PyObject *result = PyString_FromStringAndSize(chunk, size);
+
+    if (result != NULL) {
+        PyString_InternInPlace(&result);
+    }
+    return result;
+}
+#else
+#define NM_TEXT_CHECK(op) PyUnicode_Check(op)
+#define NM_INTERN_FROM_STRING PyUnicode_InternFromString
+#define nm_textAsUTF8 PyUnicode_AsUTF8
+
+static PyObject *nm_chunkFromString(const char *chunk, Py_ssize_t size)
+{
+    PyObject *result = PyUnicode_FromStringAndSize(chunk, size);
+
+    if (result != NULL) {
+        PyUnicode_InternInPlace(&result);
+    }
+    return result;
+}
+#endif /* IS_PYTHON3 */
+
+
+/* isInstanceOrClass() asks up to eight hasattr() questions, but for most
+ * callables the answer is already known from the type:
+ *
+ * - functions and bound methods of functions are not instances or classes
+ *   unless someone put an 'mro' attribute into the function's __dict__
+ * - for builtin (static) types without an instance __dict__ the answer can't
+ *   differ between instances, so it is remembered per type, keyed by the
+ *   type's version tag.
+ */
+typedef struct {
+    PyTypeObject *type;                 /* borrowed, only compared by identity */
+    unsigned int typeVersion;
+    int isInstanceOrClass;
+} NMTypeDecision;
+
+/* Everything the module keeps between calls lives in its per-module state,
+ * so every interpreter that imports it gets its own types, exceptions and
+ * caches.  The module functions get at it through their module (self).
+ */
+typedef struct {
+    PyObject *NotFound;                 /* locally-raised exception */
+    PyObject *TooManyPeriods;           /* locally-raised exception */
+    PyTypeObject *InlineCacheType;
+    PyTypeObject *CompiledNameType;
+    PyTypeObject *SearchListType;
+    PyObject *nameTable;                /* plain string name -> tuple of interned chunks */
+    PyObject *mroString;
+    int statsEnabled;
+    PyObject *stats;                    /* full name -> capsule of NMNameStats */
+#ifdef NM_FREE_THREADED
+    PyMutex typeDecisionsMutex;
+    PyMutex statsMutex;
+#endif
+    NMTypeDecision typeDecisions[NM_TYPE_DECISIONS];
+} NMState;
+
+#ifdef IS_PYTHON3
+#define nm_getState(module) ((NMState *)PyModule_GetState(module))
+#else
+/* 2.x has a single interpreter and single-phase init: the state is static */
+static NMState nm_state;
+#define nm_getState(module) (&nm_state)
+#endif
+
+/* Instances of heap types own a reference to their type, which the GC needs
+ * to see since 3.9.  The static types of 2.x are not referenced.
+ */
+#if PY_VERSION_HEX >= 0x03090000
+#define NM_VISIT_TYPE(op) Py_VISIT(Py_TYPE(op))
+#else
+#define NM_VISIT_TYPE(op)
+#endif
+#ifdef IS_PYTHON3
+#define NM_DECREF_TYPE(tp) Py_DECREF(tp)
+#else
+#define NM_DECREF_TYPE(tp) (void)(tp)
+#endif
+
+#ifdef NM_FREE_THREADED
+#define NM_LOCK(mutex) PyMutex_Lock(mutex)
+#define NM_UNLOCK(mutex) PyMutex_Unlock(mutex)
+#define NM_BEGIN_CRITICAL_SECTION(op) Py_BEGIN_CRITICAL_SECTION(op)
+#define NM_END_CRITICAL_SECTION() Py_END_CRITICAL_SECTION()
+#else
+#define NM_LOCK(mutex)
+#define NM_UNLOCK(mutex)
+#define NM_BEGIN_CRITICAL_SECTION(op) {
+#define NM_END_CRITICAL_SECTION() }
+#endif
 
 
 /* *************************************************************************** */
 /* First the c versions of the functions */
 /* *************************************************************************** */
 
-static void setNotFoundException(char *key)
+/* *************************************************************************** */
+/* NotFound */
+/* *************************************************************************** */
+
+/* NotFound remembers the name chunk that was missing and the full name that
+ * was being searched for, and only formats its message when somebody asks for
+ * it (str(), repr() or .args).  Lookups that end up using a default
+ * never pay for the formatting.
+ */
+typedef struct {
+    PyBaseExceptionObject base;
+    PyObject *key;                      /* the name chunk that wasn't found */
+    PyObject *name;                     /* the full name being searched for */
+    int formatted;                      /* args already hold the final message */
+} NotFoundObject;
+
+static int NotFound_format(NotFoundObject *self)
+{
+    PyObject *args = self->base.args;
+    PyObject *message;
+
+    if (self->formatted) {
+        return 0;
+    }
+    if (args != NULL && PyTuple_GET_SIZE(args) == 0 && self->key != NULL) {
+        message = PyUnicode_FromFormat("cannot find '%s'", nm_textAsUTF8(self->key));
+        if (message != NULL && self->name != NULL) {
+            Py_SETREF(message, PyUnicode_FromFormat("%U while searching for '%s'",
+                        message, nm_textAsUTF8(self->name)));
+        }
+    } else if (args != NULL && PyTuple_GET_SIZE(args) == 1 && self->name != NULL) {
+        message = PyUnicode_FromFormat("%S while searching for '%s'",
+                PyTuple_GET_ITEM(args, 0), nm_textAsUTF8(self->name));
+    } else {
+        self->formatted = TRUE;
+        return 0;
+    }
+    if (message == NULL) {
+        return -1;
+    }
+    args = PyTuple_Pack(1, message);
+    Py_DECREF(message);
+    if (args == NULL) {
+        return -1;
+    }
+    Py_XSETREF(self->base.args, args);
+    self->formatted = TRUE;
+    return 0;
+}
+
+static int NotFound_traverse(NotFoundObject *self, visitproc visit, void *arg)
+{
+    NM_VISIT_TYPE(self);
+    Py_VISIT(self->key);
+    Py_VISIT(self->name);
+    return ((PyTypeObject *)PyExc_LookupError)->tp_traverse((PyObject *)self, visit, arg);
+}
+
+static int NotFound_clear(NotFoundObject *self)
+{
+    Py_CLEAR(self->key);
+    Py_CLEAR(self->name);
+    return ((PyTypeObject *)PyExc_LookupError)->tp_clear((PyObject *)self);
+}
+
+static void NotFound_dealloc(NotFoundObject *self)
+{
+    PyTypeObject *tp = Py_TYPE(self);
+
+    PyObject_GC_UnTrack(self);
+    NotFound_clear(self);
+    tp->tp_free((PyObject *)self);
+    NM_DECREF_TYPE(tp);
+}
+
+static PyObject *NotFound_str(NotFoundObject *self)
+{
+    if (NotFound_format(self) < 0) {
+        return NULL;
+    }
+    return ((PyTypeObject *)PyExc_LookupError)->tp_str((PyObject *)self);
+}
+
+static PyObject *NotFound_repr(NotFoundObject *self)
+{
+    if (NotFound_format(self) < 0) {
+        return NULL;
+    }
+    return ((PyTypeObject *)PyExc_LookupError)->tp_repr((PyObject *)self);
+}
+
+static PyObject *NotFound_getArgs(NotFoundObject *self, void *closure)
+{
+    if (NotFound_format(self) < 0) {
+        return NULL;
+    }
+    Py_INCREF(self->base.args);
+    return self->base.args;
+}
+
+static int NotFound_setArgs(NotFoundObject *self, PyObject *value, void *closure)
+{
+    PyObject *args;
+
+    if (value == NULL) {
+        PyErr_SetString(PyExc_TypeError, "args may not be deleted");
+        return -1;
+    }
+    if (!(args = PySequence_Tuple(value))) {
+        return -1;
+    }
+    Py_XSETREF(self->base.args, args);
+    self->formatted = TRUE;
+    return 0;
+}
+
+static PyGetSetDef NotFound_getset[] = {
+    {"args", (getter)NotFound_getArgs, (setter)NotFound_setArgs, NULL, NULL},
+    {NULL}
+};
+
+static PyMemberDef NotFound_members[] = {
+    {"key", T_OBJECT, offsetof(NotFoundObject, key), READONLY, "The part of the name that could not be found"},
+    {"name", T_OBJECT, offsetof(NotFoundObject, name), READONLY, "The full name that was searched for"},
+    {NULL}
+};
+
+static PyType_Slot NotFound_slots[] = {
+    {Py_tp_dealloc, NotFound_dealloc},
+    {Py_tp_repr, NotFound_repr},
+    {Py_tp_str, NotFound_str},
+    {Py_tp_doc, "A name could not be found"},
+    {Py_tp_traverse, NotFound_traverse},
+    {Py_tp_clear, NotFound_clear},
+    {Py_tp_members, NotFound_members},
+    {Py_tp_getset, NotFound_getset},
+    {0, NULL}
+};
+
+static PyType_Spec NotFound_spec = {
+    "NameMapper.NotFound",
+    sizeof(NotFoundObject),
+    0,
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC,
+    NotFound_slots,                         /* based on LookupError */
+};
+
+static void setNotFoundException(NMState *st, PyObject *key)
 {
-    PyObject *exceptionStr = NULL;
-    exceptionStr = PyUnicode_FromFormat("cannot find \'%s\'", key);
-    PyErr_SetObject(NotFound, exceptionStr);
-    Py_XDECREF(exceptionStr);
+    PyObject *exc;
+
+    if (!(exc = PyObject_CallObject(st->NotFound, NULL))) {
+        return;
+    }
+    Py_INCREF(key);
+    ((NotFoundObject *)exc)->key = key;
+    PyErr_SetObject(st->NotFound, exc);
+    Py_DECREF(exc);
 }
 
-static int wrapInternalNotFoundException(char *fullName)
+/* Record the full name on a NotFound raised while looking up one of its
+ * chunks.  NotFounds that already carry a name (raised by a nested lookup)
+ * are left alone.
+ */
+static int wrapInternalNotFoundException(NMState *st, PyObject *fullName)
 {
-    PyObject *excType, *excValue, *excTraceback, *isAlreadyWrapped = NULL;
-    PyObject *newExcValue = NULL;
+    PyObject *excType, *excValue, *excTraceback;
+    NotFoundObject *notFound;
+
     if (!ALLOW_WRAPPING_OF_NOTFOUND_EXCEPTIONS) {
         return 0;
     }
@@ -52,21 +352,19 @@ static int wrapInternalNotFoundException(char *fullName)
         return 0;
     }
 
-    if (PyErr_GivenExceptionMatches(PyErr_Occurred(), NotFound)) {
+    if (PyErr_ExceptionMatches(st->NotFound)) {
         PyErr_Fetch(&excType, &excValue, &excTraceback);
-        isAlreadyWrapped = PyObject_CallMethod(excValue, "find", "s", "while searching");
-
-        if (isAlreadyWrapped != NULL) {
-            if (PyLong_AsLong(isAlreadyWrapped) == -1) {
-                newExcValue = PyUnicode_FromFormat("%U while searching for \'%s\'",
-                        excValue, fullName);
+        PyErr_NormalizeException(&excType, &excValue, &excTraceback);
+        if (excValue != NULL && PyObject_TypeCheck(excValue, (PyTypeObject *)st->NotFound)) {
+            notFound = (NotFoundObject *)excValue;
+            if (notFound->name == NULL) {
+                Py_INCREF(fullName);
+                notFound->name = fullName;
+                /* a message formatted so far still lacks the name */
+                notFound->formatted = FALSE;
             }
-            Py_DECREF(isAlreadyWrapped);
         }
-        else {
-           newExcValue = excValue;
-        }
-        PyErr_Restore(excType, newExcValue, excTraceback);
+        PyErr_Restore(excType, excValue, excTraceback);
         return -1;
     }
     return 0;
@@ -110,63 +408,424 @@ static int isInstanceOrClass(PyObject *nextVal) {
 }
 
 
-static int getNameChunks(char *nameChunks[], char *name, char *nameCopy)
+/* Split name on periods into a new tuple of interned chunks.  A trailing
+ * period is ignored and an empty name becomes a single empty chunk.
+ */
+static PyObject *splitNameChunks(NMState *st, PyObject *name)
 {
-    char c;
-    char *currChunk;
+    const char *c, *currChunk;
+    PyObject *chunk;
+    PyObject *nameChunks[MAXCHUNKS];
     int currChunkNum = 0;
+    int i;
 
-    currChunk = nameCopy;
-    while ('\0' != (c = *nameCopy)) {
-    if ('.' == c) {
-        if (currChunkNum >= (MAXCHUNKS-2)) { /* avoid overflowing nameChunks[] */
-            PyErr_SetString(TooManyPeriods, name);
-            return 0;
+    if (!(c = currChunk = nm_textAsUTF8(name))) {
+        return NULL;
+    }
+    for (;; c++) {
+        if ('.' == *c || ('\0' == *c && (c > currChunk || currChunkNum == 0))) {
+            if ('.' == *c && currChunkNum >= (MAXCHUNKS-2)) { /* same limit as ever */
+                PyErr_SetObject(st->TooManyPeriods, name);
+                goto error;
+            }
+            if (!(chunk = nm_chunkFromString(currChunk, c - currChunk))) {
+                goto error;
+            }
+            nameChunks[currChunkNum++] = chunk;
+            currChunk = c + 1;
+        }
+        if ('\0' == *c) {
+            break;
         }
+    }
+    chunk = PyTuple_New(currChunkNum);
+    if (chunk == NULL) {
+        goto error;
+    }
+    for (i = 0; i < currChunkNum; i++) {
+        PyTuple_SET_ITEM(chunk, i, nameChunks[i]);
+    }
+    return chunk;
 
-        *nameCopy ='\0';
-        nameChunks[currChunkNum++] = currChunk;
-        nameCopy++;
-        currChunk = nameCopy;
-    } else
-        nameCopy++;
+error:
+    for (i = 0; i < currChunkNum; i++) {
+        Py_DECREF(nameChunks[i]);
+    }
+    return NULL;
+}
+
+
+/* Both helpers below return a new reference, or NULL without an exception
+ * set if the name isn't there, so a miss costs one probe and no exception
+ * object.
+ */
+
+/* Returns a new reference to dict[key], or NULL (with an exception set only if
+ * the lookup failed).  A borrowed value could go away while other threads
+ * change the dict.
+ */
+static PyObject *nm_dictGetItem(PyObject *dict, PyObject *key)
+{
+    PyObject *value;
+
+#if PY_VERSION_HEX >= 0x030D0000
+    PyDict_GetItemRef(dict, key, &value);
+#else
+    value = PyDict_GetItemWithError(dict, key);
+    Py_XINCREF(value);
+#endif
+    return value;
+}
+
+static PyObject *nm_getItem(PyObject *mapping, PyObject *key)
+{
+    PyObject *value;
+
+    if (PyDict_CheckExact(mapping)) {
+        value = nm_dictGetItem(mapping, key);
+    } else {
+        value = PyObject_GetItem(mapping, key);
     }
-    if (nameCopy > currChunk) {
-        nameChunks[currChunkNum++] = currChunk;
+    if (value == NULL) {
+        PyErr_Clear();
     }
-    return currChunkNum;
+    return value;
 }
 
+/* Returns 1 and sets *value if obj has the attribute, 0 if it doesn't and -1
+ * with an exception set if looking it up failed some other way.
+ */
+static int nm_getAttr(PyObject *obj, PyObject *key, PyObject **value)
+{
+#if PY_VERSION_HEX >= 0x030D0000
+    return PyObject_GetOptionalAttr(obj, key, value);
+#elif PY_VERSION_HEX >= 0x03070000
+    return _PyObject_LookupAttr(obj, key, value);
+#else
+    /* 2.x and 3.6: no way around the AttributeError */
+    if ((*value = PyObject_GetAttr(obj, key)) != NULL) {
+        return 1;
+    }
+    if (PyErr_ExceptionMatches(PyExc_AttributeError)) {
+        PyErr_Clear();
+        return 0;
+    }
+    return -1;
+#endif
+}
 
-static int PyNamemapper_hasKey(PyObject *obj, char *key)
+/* Look key up in a searchList namespace: first as a key of mappings, then as
+ * an attribute.  *kind is set to NM_IC_KEY or NM_IC_ATTR accordingly.  Like
+ * hasattr(), any error while looking counts as a miss.
+ */
+static PyObject *nm_probe(PyObject *nameSpace, PyObject *key, int *kind)
 {
-    if (PyMapping_Check(obj) && PyMapping_HasKeyString(obj, key)) {
-        return TRUE;
-    } else if (PyObject_HasAttrString(obj, key)) {
-        return TRUE;
+    PyObject *value = NULL;
+
+    if (PyMapping_Check(nameSpace) && (value = nm_getItem(nameSpace, key))) {
+        *kind = NM_IC_KEY;
+        return value;
+    }
+    if (nm_getAttr(nameSpace, key, &value) < 0) {
+        PyErr_Clear();
     }
-    return FALSE;
+    *kind = NM_IC_ATTR;
+    return value;
 }
 
 
-static PyObject *PyNamemapper_valueForKey(PyObject *obj, char *key)
+static PyObject *PyNamemapper_valueForKey(NMState *st, PyObject *obj, PyObject *key)
 {
-    PyObject *theValue = NULL;
+    PyObject *theValue;
+    int kind;
 
-    if (PyMapping_Check(obj) && PyMapping_HasKeyString(obj, key)) {
-        theValue = PyMapping_GetItemString(obj, key);
-    } else if (PyObject_HasAttrString(obj, key)) {
-        theValue = PyObject_GetAttrString(obj, key);
-    } else {
-        setNotFoundException(key);
+    if (!(theValue = nm_probe(obj, key, &kind))) {
+        setNotFoundException(st, key);
     }
     return theValue;
 }
 
-static PyObject *PyNamemapper_valueForName(PyObject *obj, char *nameChunks[], int numChunks, int executeCallables, int useDottedNotation)
+static int nm_functionHasMro(NMState *st, PyObject *func)
 {
-    int i;
-    char *currentKey;
+    PyObject **dictPtr = _PyObject_GetDictPtr(func);
+
+    if (dictPtr == NULL || *dictPtr == NULL) {
+        return 0;
+    }
+    if (PyDict_GetItemWithError(*dictPtr, st->mroString) != NULL) {
+        return 1;
+    }
+    return PyErr_Occurred() ? -1 : 0;
+}
+
+static int nm_isInstanceOrClass(NMState *st, PyObject *value)
+{
+    PyTypeObject *tp = Py_TYPE(value);
+    NMTypeDecision *decision;
+    int result = -2;
+
+    if (PyType_Check(value)) {
+        return 1;
+    }
+    if (PyFunction_Check(value)) {
+        return nm_functionHasMro(st, value);
+    }
+    if (PyMethod_Check(value) && PyFunction_Check(PyMethod_GET_FUNCTION(value))) {
+        return nm_functionHasMro(st, PyMethod_GET_FUNCTION(value));
+    }
+
+    if (PyType_HasFeature(tp, Py_TPFLAGS_HEAPTYPE) || tp->tp_dictoffset != 0 ||
+            tp->tp_getattro != PyObject_GenericGetAttr ||
+            !NM_TYPE_VERSION_VALID(tp)) {
+        return isInstanceOrClass(value);
+    }
+    decision = &st->typeDecisions[((size_t)tp >> 4) % NM_TYPE_DECISIONS];
+    NM_LOCK(&st->typeDecisionsMutex);
+    if (decision->type == tp && decision->typeVersion == tp->tp_version_tag) {
+        result = decision->isInstanceOrClass;
+    }
+    NM_UNLOCK(&st->typeDecisionsMutex);
+    if (result != -2) {
+        return result;
+    }
+    result = isInstanceOrClass(value);
+    NM_LOCK(&st->typeDecisionsMutex);
+    decision->type = tp;
+    decision->typeVersion = tp->tp_version_tag;
+    decision->isInstanceOrClass = result;
+    NM_UNLOCK(&st->typeDecisionsMutex);
+    return result;
+}
+
+
+/* *************************************************************************** */
+/* Lookup statistics */
+/* *************************************************************************** */
+
+/* With statistics enabled every search records, per full name, where its
+ * first chunk was found, whether it missed, how many values it autocalled and
+ * how long it took.  Disabled, a search only checks st->statsEnabled.
+ */
+typedef struct {
+    Py_ssize_t locals;
+    Py_ssize_t globals;
+    Py_ssize_t builtins;
+    Py_ssize_t misses;
+    Py_ssize_t autocalls;
+    double time;
+    Py_ssize_t numIndexes;
+    Py_ssize_t *searchList;             /* hits per searchList index */
+} NMNameStats;
+
+#define NM_STATS_CAPSULE "Cheetah._namemapper.NameStats"
+
+static double nm_now(void)
+{
+#if PY_VERSION_HEX >= 0x030D0000
+    PyTime_t t;
+
+    if (PyTime_PerfCounterRaw(&t) == 0) {
+        return PyTime_AsSecondsDouble(t);
+    }
+    return 0.0;
+#else
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec * 1e-9;
+#endif
+}
+
+static void nm_statsFree(PyObject *capsule)
+{
+    NMNameStats *stats = PyCapsule_GetPointer(capsule, NM_STATS_CAPSULE);
+
+    PyMem_Free(stats->searchList);
+    PyMem_Free(stats);
+}
+
+/* Returns a new reference to the capsule holding the statistics of name. */
+static PyObject *nm_statsFor(NMState *st, PyObject *name)
+{
+    PyObject *capsule;
+    NMNameStats *stats;
+
+    if ((capsule = nm_dictGetItem(st->stats, name)) || PyErr_Occurred()) {
+        return capsule;
+    }
+    if (!(stats = PyMem_Calloc(1, sizeof(NMNameStats)))) {
+        return PyErr_NoMemory();
+    }
+    if (!(capsule = PyCapsule_New(stats, NM_STATS_CAPSULE, nm_statsFree))) {
+        PyMem_Free(stats);
+        return NULL;
+    }
+#if PY_VERSION_HEX >= 0x030D0000
+    {
+        PyObject *result;
+
+        if (PyDict_SetDefaultRef(st->stats, name, capsule, &result) < 0) {
+            result = NULL;
+        }
+        Py_DECREF(capsule);
+        return result;
+    }
+#elif defined(IS_PYTHON3)
+    {
+        PyObject *result = PyDict_SetDefault(st->stats, name, capsule);
+
+        Py_XINCREF(result);
+        Py_DECREF(capsule);
+        return result;
+    }
+#else
+    /* the GIL is held since the lookup above */
+    if (PyDict_SetItem(st->stats, name, capsule) < 0) {
+        Py_CLEAR(capsule);
+    }
+    return capsule;
+#endif
+}
+
+/* Start recording a lookup of name.  Returns 0 with *capsule and *stats left
+ * NULL if statistics are disabled.
+ */
+static int nm_statsStart(NMState *st, PyObject *name, PyObject **capsule, NMNameStats **stats, double *start)
+{
+    if (!st->statsEnabled) {
+        return 0;
+    }
+    if (!(*capsule = nm_statsFor(st, name))) {
+        return -1;
+    }
+    *stats = PyCapsule_GetPointer(*capsule, NM_STATS_CAPSULE);
+    *start = nm_now();
+    return 0;
+}
+
+/* Count a first chunk found in source: a searchList index or NM_SOURCE_* */
+static void nm_statsCountHit(NMState *st, NMNameStats *stats, Py_ssize_t source)
+{
+    Py_ssize_t *grown;
+
+    NM_LOCK(&st->statsMutex);
+    if (source == NM_SOURCE_LOCALS) {
+        stats->locals++;
+    } else if (source == NM_SOURCE_GLOBALS) {
+        stats->globals++;
+    } else if (source == NM_SOURCE_BUILTINS) {
+        stats->builtins++;
+    } else if (source >= 0) {
+        if (source >= stats->numIndexes) {
+            grown = PyMem_Realloc(stats->searchList, (source + 1) * sizeof(Py_ssize_t));
+            if (grown == NULL) {
+                /* lose the count rather than fail the lookup */
+                NM_UNLOCK(&st->statsMutex);
+                return;
+            }
+            memset(grown + stats->numIndexes, 0, (source + 1 - stats->numIndexes) * sizeof(Py_ssize_t));
+            stats->searchList = grown;
+            stats->numIndexes = source + 1;
+        }
+        stats->searchList[source]++;
+    }
+    NM_UNLOCK(&st->statsMutex);
+}
+
+static void nm_statsCountAutocall(NMState *st, NMNameStats *stats)
+{
+    NM_LOCK(&st->statsMutex);
+    stats->autocalls++;
+    NM_UNLOCK(&st->statsMutex);
+}
+
+/* Finish recording a lookup that returned value: NULL with NotFound (or no
+ * exception at all) is a miss.  Releases capsule.
+ */
+static void nm_statsFinish(NMState *st, PyObject *capsule, NMNameStats *stats, PyObject *value, double start)
+{
+    double elapsed = nm_now() - start;
+    int missed = value == NULL && (!PyErr_Occurred() || PyErr_ExceptionMatches(st->NotFound));
+
+    NM_LOCK(&st->statsMutex);
+    stats->misses += missed;
+    stats->time += elapsed;
+    NM_UNLOCK(&st->statsMutex);
+    Py_DECREF(capsule);
+}
+
+static PyObject *nm_statsAsDict(NMState *st, NMNameStats *stats)
+{
+    PyObject *searchList;
+    PyObject *count;
+    PyObject *index;
+    Py_ssize_t i;
+    NMNameStats copy;
+
+    if (!(searchList = PyDict_New())) {
+        return NULL;
+    }
+    NM_LOCK(&st->statsMutex);
+    copy = *stats;
+    for (i = 0; i < stats->numIndexes; i++) {
+        if (!stats->searchList[i]) {
+            continue;
+        }
+        index = PyLong_FromSsize_t(i);
+        count = PyLong_FromSsize_t(stats->searchList[i]);
+        if (index == NULL || count == NULL || PyDict_SetItem(searchList, index, count) < 0) {
+            Py_XDECREF(index);
+            Py_XDECREF(count);
+            Py_CLEAR(searchList);
+            break;
+        }
+        Py_DECREF(index);
+        Py_DECREF(count);
+    }
+    NM_UNLOCK(&st->statsMutex);
+    if (searchList == NULL) {
+        return NULL;
+    }
+    return Py_BuildValue("{s:n,s:N,s:n,s:n,s:n,s:n,s:d}",
+            "locals", copy.locals,
+            "searchList", searchList,
+            "globals", copy.globals,
+            "builtins", copy.builtins,
+            "misses", copy.misses,
+            "autocalls", copy.autocalls,
+            "time", copy.time);
+}
+
+
+/* Steals a reference to value */
+static PyObject *PyNamemapper_autocall(NMState *st, PyObject *value, int executeCallables, NMNameStats *stats)
+{
+    PyObject *result;
+    int skip;
+
+    if (!executeCallables || !PyCallable_Check(value)) {
+        return value;
+    }
+    if ((skip = nm_isInstanceOrClass(st, value))) {
+        if (skip < 0) {
+            Py_DECREF(value);
+            return NULL;
+        }
+        return value;
+    }
+    if (stats != NULL) {
+        nm_statsCountAutocall(st, stats);
+    }
+    result = PyObject_CallObject(value, NULL);
+    Py_DECREF(value);
+    return result;
+}
+
+static PyObject *PyNamemapper_valueForName(NMState *st, PyObject *obj, PyObject *nameChunks[], Py_ssize_t numChunks,
+        int executeCallables, int useDottedNotation, NMNameStats *stats)
+{
+    Py_ssize_t i;
+    PyObject *currentKey;
     PyObject *currentVal = NULL;
     PyObject *nextVal = NULL;
 
@@ -180,29 +839,34 @@ static PyObject *PyNamemapper_valueForName(PyObject *obj, char *nameChunks[], in
             return NULL;
         }
 
-        if (useDottedNotation && PyMapping_Check(currentVal) && PyMapping_HasKeyString(currentVal, currentKey)) {
-            nextVal = PyMapping_GetItemString(currentVal, currentKey);
-        }
-
-        else {
-            PyObject *exc;
-            nextVal = PyObject_GetAttrString(currentVal, currentKey);
-            exc = PyErr_Occurred();
-
-            if (exc != NULL) {
-                // if exception == AttributeError, report our own exception
-                if (PyErr_ExceptionMatches(PyExc_AttributeError)) {
-                    setNotFoundException(currentKey);
+        nextVal = NULL;
+        if (useDottedNotation == NM_DICT_LOOKUPS) {
+            /* keys only, no attributes */
+            if (PyDict_CheckExact(currentVal)) {
+                nextVal = nm_dictGetItem(currentVal, currentKey);
+            } else if (PyMapping_Check(currentVal)) {
+                nextVal = nm_getItem(currentVal, currentKey);
+            }
+            if (nextVal == NULL) {
+                if (!PyErr_Occurred()) {
+                    setNotFoundException(st, currentKey);
                 }
-                // any exceptions results in failure
                 if (i > 0) {
                     Py_DECREF(currentVal);
                 }
                 return NULL;
             }
+        } else if (useDottedNotation && PyMapping_Check(currentVal)) {
+            nextVal = nm_getItem(currentVal, currentKey);
+        }
+        if (nextVal == NULL) {
+            int found = nm_getAttr(currentVal, currentKey, &nextVal);
 
-            if (nextVal == NULL) {
-                setNotFoundException(currentKey);
+            if (found <= 0) {
+                // a missing attribute is reported as our own exception
+                if (found == 0) {
+                    setNotFoundException(st, currentKey);
+                }
                 // any exceptions results in failure
                 if (i > 0) {
                     Py_DECREF(currentVal);
@@ -214,15 +878,8 @@ static PyObject *PyNamemapper_valueForName(PyObject *obj, char *nameChunks[], in
             Py_DECREF(currentVal);
         }
 
-        if (executeCallables && PyCallable_Check(nextVal) &&
-                (isInstanceOrClass(nextVal) == 0) ) {
-            if (!(currentVal = PyObject_CallObject(nextVal, NULL))) {
-                Py_DECREF(nextVal);
-                return NULL;
-            }
-            Py_DECREF(nextVal);
-        } else {
-            currentVal = nextVal;
+        if (!(currentVal = PyNamemapper_autocall(st, nextVal, executeCallables, stats))) {
+            return NULL;
         }
     }
 
@@ -231,214 +888,1699 @@ static PyObject *PyNamemapper_valueForName(PyObject *obj, char *nameChunks[], in
 
 
 /* *************************************************************************** */
-/* Now the wrapper functions to export into the Python module */
+/* Inline caches */
 /* *************************************************************************** */
 
+/* An InlineCache belongs to a single VFFSL/VFSL call site in a compiled
+ * template.  It remembers where the name was found last time (the searchList
+ * index and whether it was a dict key or an attribute) together with a guard
+ * for every namespace that was searched before it.  As long as the guards
+ * hold, the earlier namespaces still don't contain the name and the lookup
+ * can go straight to the namespace that had it.
+ *
+ * A guard on a dict is its version tag; if that moved on, one probe tells
+ * whether the name showed up.  A guard on any other object is the version tag
+ * of its type (the name must not come from the type) plus a probe of the
+ * instance __dict__, which templates write to on every call.
+ */
+
+typedef struct {
+    PyObject *nameSpace;                /* borrowed, only compared by identity */
+    int isDict;
+    unsigned int typeVersion;
+    unsigned long long dictVersion;
+} NMGuard;
+
+typedef struct {
+    PyObject *key;                      /* interned first name chunk */
+    Py_ssize_t index;                   /* searchList index, NM_IC_GLOBALS, NM_IC_BUILTINS or NM_IC_EMPTY */
+    int kind;                           /* NM_IC_KEY or NM_IC_ATTR */
+    Py_ssize_t numGuards;
+    NMGuard guards[NM_IC_MAXGUARDS];
+    NMGuard globalsGuard;               /* only used for NM_IC_BUILTINS */
+    Py_ssize_t hits;
+    Py_ssize_t misses;
+#ifdef NM_FREE_THREADED
+    PyMutex mutex;                      /* never held while code can run */
+#endif
+} NMInlineCache;
+
+typedef struct {
+    PyObject_HEAD
+    NMInlineCache cache;
+} InlineCacheObject;
+
+/* A name split into interned chunks once, ahead of time, together with the
+ * flags it is looked up with and the inline cache of its call site.
+ */
+typedef struct {
+    PyObject_HEAD
+    PyObject *name;
+    PyObject *chunks;                   /* tuple of interned chunks */
+    int executeCallables;
+    int useDottedNotation;
+    int dictLookups;                    /* lookupMode='dict' */
+    NMInlineCache cache;
+} CompiledNameObject;
+
+#define InlineCache_Check(st, op) (Py_TYPE(op) == (st)->InlineCacheType)
+#define CompiledName_Check(st, op) (Py_TYPE(op) == (st)->CompiledNameType)
+
+/* Count a lookup in the hits or misses of a cache */
+static void nm_inlineCacheCount(NMInlineCache *cache, Py_ssize_t *counter)
+{
+    NM_LOCK(&cache->mutex);
+    (*counter)++;
+    NM_UNLOCK(&cache->mutex);
+}
+
+#ifdef NM_HAVE_DICT_VERSION
+
+#if PY_VERSION_HEX >= 0x030C0000
+/* ma_version_tag is deprecated (but still maintained) on 3.12 and 3.13 */
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wdeprecated-declarations"
+#endif
+static unsigned long long nm_dictVersion(PyObject *dict)
+{
+    return ((PyDictObject *)dict)->ma_version_tag;
+}
+#if PY_VERSION_HEX >= 0x030C0000
+#pragma GCC diagnostic pop
+#endif
+
+/* Record that nameSpace does not contain key.  Returns 0 if the absence of
+ * key can't be cheaply proven again later.
+ */
+static int nm_makeGuard(NMGuard *guard, PyObject *nameSpace, PyObject *key)
+{
+    PyTypeObject *tp = Py_TYPE(nameSpace);
+
+    guard->nameSpace = nameSpace;
+    if (PyDict_CheckExact(nameSpace)) {
+        guard->isDict = TRUE;
+        guard->typeVersion = 0;
+        guard->dictVersion = nm_dictVersion(nameSpace);
+        return TRUE;
+    }
+
+    /* Plain objects: the name must not come from the type, so no descriptor
+     * or class attribute can produce it. */
+    if (tp->tp_getattro != PyObject_GenericGetAttr || PyMapping_Check(nameSpace)) {
+        return FALSE;
+    }
+    if (_PyType_Lookup(tp, key) != NULL || !NM_TYPE_VERSION_VALID(tp)) {
+        return FALSE;
+    }
+    guard->isDict = FALSE;
+    guard->typeVersion = tp->tp_version_tag;
+    guard->dictVersion = 0;
+    return TRUE;
+}
+
+static int nm_checkGuard(NMGuard *guard, PyObject *nameSpace, PyObject *key)
+{
+    PyTypeObject *tp = Py_TYPE(nameSpace);
+    PyObject **dictPtr;
+
+    if (guard->isDict) {
+        if (!PyDict_CheckExact(nameSpace)) {
+            return FALSE;
+        }
+        if (guard->nameSpace == nameSpace && nm_dictVersion(nameSpace) == guard->dictVersion) {
+            return TRUE;
+        }
+        if (PyDict_GetItemWithError(nameSpace, key) != NULL || PyErr_Occurred()) {
+            PyErr_Clear();
+            return FALSE;
+        }
+        guard->nameSpace = nameSpace;
+        guard->dictVersion = nm_dictVersion(nameSpace);
+        return TRUE;
+    }
+
+    if (!NM_TYPE_VERSION_VALID(tp) || tp->tp_version_tag != guard->typeVersion) {
+        return FALSE;
+    }
+    dictPtr = _PyObject_GetDictPtr(nameSpace);
+    if (dictPtr == NULL || *dictPtr == NULL) {
+        return TRUE;
+    }
+    if (PyDict_GetItemWithError(*dictPtr, key) != NULL || PyErr_Occurred()) {
+        PyErr_Clear();
+        return FALSE;
+    }
+    return TRUE;
+}
+
+/* Guard the first numGuards namespaces of a list.  Returns FALSE if that
+ * many can't be guarded.
+ */
+static int nm_makeGuards(NMGuard *guards, PyObject *searchList, Py_ssize_t numGuards, PyObject *key)
+{
+    Py_ssize_t i;
+
+    if (numGuards > NM_IC_MAXGUARDS || numGuards > PyList_GET_SIZE(searchList)) {
+        return FALSE;
+    }
+    for (i = 0; i < numGuards; i++) {
+        if (!nm_makeGuard(&guards[i], PyList_GET_ITEM(searchList, i), key)) {
+            return FALSE;
+        }
+    }
+    return TRUE;
+}
+
+/* Answer a lookup from view, which is either the cache itself or a snapshot
+ * of it.
+ */
+static PyObject *nm_inlineCacheProbe(NMInlineCache *cache, NMInlineCache *view, PyObject *searchList,
+        PyObject *firstChunk, int searchFrame, Py_ssize_t *source)
+{
+    Py_ssize_t i, size;
+    PyObject **items;
+    PyObject *nameSpace;
+    PyObject *value;
+
+    /* chunks are interned, so identity is enough */
+    if (view->index == NM_IC_EMPTY || view->key != firstChunk) {
+        return NULL;
+    }
+    if (!(PyList_Check(searchList) || PyTuple_Check(searchList))) {
+        return NULL;
+    }
+
+    size = PySequence_Fast_GET_SIZE(searchList);
+    items = PySequence_Fast_ITEMS(searchList);
+    if (view->index >= 0 ? size <= view->index : (!searchFrame || size != view->numGuards)) {
+        return NULL;
+    }
+    for (i = 0; i < view->numGuards; i++) {
+        if (!nm_checkGuard(&view->guards[i], items[i], view->key)) {
+            return NULL;
+        }
+    }
+
+    if (view->index >= 0) {
+        nameSpace = items[view->index];
+    } else if (view->index == NM_IC_GLOBALS) {
+        nameSpace = PyEval_GetGlobals();
+    } else {
+        if (!nm_checkGuard(&view->globalsGuard, PyEval_GetGlobals(), view->key)) {
+            return NULL;
+        }
+        nameSpace = PyEval_GetBuiltins();
+    }
+
+    if (view->kind == NM_IC_KEY) {
+        if (!PyDict_CheckExact(nameSpace) || !(value = nm_dictGetItem(nameSpace, view->key))) {
+            PyErr_Clear();
+            return NULL;
+        }
+    } else {
+        if (PyMapping_Check(nameSpace) || nm_getAttr(nameSpace, view->key, &value) <= 0) {
+            /* let the slow path decide what to make of it */
+            PyErr_Clear();
+            return NULL;
+        }
+    }
+    nm_inlineCacheCount(cache, &cache->hits);
+    *source = view->index;
+    return value;
+}
+
+/* Returns a new reference to the (not yet autocalled) value of the first name
+ * chunk and sets *source to where it was found.  Returns NULL without an
+ * exception set if the cache can't answer.  Callers hold the critical section
+ * of the searchList.
+ */
+static PyObject *nm_inlineCacheLookup(NMInlineCache *cache, PyObject *searchList, PyObject *firstChunk, int searchFrame,
+        Py_ssize_t *source)
+{
+#ifdef NM_FREE_THREADED
+    /* Other threads may store into the cache at any time, and probing the
+     * namespaces can run code, so the guards are checked on a snapshot. */
+    NMInlineCache snapshot;
+
+    NM_LOCK(&cache->mutex);
+    memcpy(&snapshot, cache, sizeof(NMInlineCache));
+    NM_UNLOCK(&cache->mutex);
+    return nm_inlineCacheProbe(cache, &snapshot, searchList, firstChunk, searchFrame, source);
+#else
+    return nm_inlineCacheProbe(cache, cache, searchList, firstChunk, searchFrame, source);
+#endif
+}
+
+static void nm_inlineCacheStore(NMInlineCache *cache, PyObject *key, Py_ssize_t index, int kind,
+        PyObject *nameSpace, NMGuard *guards, Py_ssize_t numGuards, NMGuard *globalsGuard)
+{
+    PyObject *oldKey;
+
+    /* the fast path only knows exact dicts and plain attributes */
+    if (kind == NM_IC_KEY ? !PyDict_CheckExact(nameSpace) : PyMapping_Check(nameSpace)) {
+        return;
+    }
+
+    Py_INCREF(key);
+    NM_LOCK(&cache->mutex);
+    oldKey = cache->key;
+    cache->key = key;
+    cache->index = index;
+    cache->kind = kind;
+    cache->numGuards = numGuards;
+    memcpy(cache->guards, guards, numGuards * sizeof(NMGuard));
+    if (globalsGuard) {
+        cache->globalsGuard = *globalsGuard;
+    }
+    NM_UNLOCK(&cache->mutex);
+    Py_XDECREF(oldKey);
+}
+
+#else /* !NM_HAVE_DICT_VERSION */
+
+static PyObject *nm_inlineCacheLookup(NMInlineCache *cache, PyObject *searchList, PyObject *firstChunk, int searchFrame,
+        Py_ssize_t *source)
+{
+    return NULL;
+}
+
+#endif /* NM_HAVE_DICT_VERSION */
+
+
+static PyObject *InlineCache_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    InlineCacheObject *self;
+
+    if (!PyArg_ParseTuple(args, ":InlineCache")) {
+        return NULL;
+    }
+    self = (InlineCacheObject *)type->tp_alloc(type, 0);
+    if (self != NULL) {
+        self->cache.index = NM_IC_EMPTY;
+    }
+    return (PyObject *)self;
+}
+
+static void InlineCache_dealloc(InlineCacheObject *self)
+{
+    PyTypeObject *tp = Py_TYPE(self);
+
+    Py_XDECREF(self->cache.key);
+    tp->tp_free((PyObject *)self);
+    NM_DECREF_TYPE(tp);
+}
+
+static PyMemberDef InlineCache_members[] = {
+    {"hits", T_PYSSIZET, offsetof(InlineCacheObject, cache.hits), READONLY, "Lookups answered by the cache"},
+    {"misses", T_PYSSIZET, offsetof(InlineCacheObject, cache.misses), READONLY, "Lookups that took the slow path"},
+    {NULL}
+};
+
+static PyType_Slot InlineCache_slots[] = {
+    {Py_tp_new, InlineCache_new},
+    {Py_tp_dealloc, InlineCache_dealloc},
+    {Py_tp_doc, "Per-call-site cache for valueFromSearchList / valueFromFrameOrSearchList"},
+    {Py_tp_members, InlineCache_members},
+    {0, NULL}
+};
+
+static PyType_Spec InlineCache_spec = {
+    "Cheetah._namemapper.InlineCache",
+    sizeof(InlineCacheObject),
+    0,
+    Py_TPFLAGS_DEFAULT,
+    InlineCache_slots,
+};
+
+
+static void CompiledName_dealloc(CompiledNameObject *self)
+{
+    PyTypeObject *tp = Py_TYPE(self);
+
+    Py_XDECREF(self->name);
+    Py_XDECREF(self->chunks);
+    Py_XDECREF(self->cache.key);
+    tp->tp_free((PyObject *)self);
+    NM_DECREF_TYPE(tp);
+}
+
+static PyObject *CompiledName_repr(CompiledNameObject *self)
+{
+    return PyUnicode_FromFormat("compile_name(%R, %s, %s%s)", self->name,
+            self->executeCallables ? "True" : "False",
+            self->useDottedNotation ? "True" : "False",
+            self->dictLookups ? ", lookupMode='dict'" : "");
+}
+
+static PyObject *CompiledName_getLookupMode(CompiledNameObject *self, void *closure)
+{
+    return PyUnicode_FromString(self->dictLookups ? "dict" : "default");
+}
+
+static PyGetSetDef CompiledName_getset[] = {
+    {"lookupMode", (getter)CompiledName_getLookupMode, NULL, "'default' or 'dict'", NULL},
+    {NULL}
+};
+
+static PyMemberDef CompiledName_members[] = {
+    {"name", T_OBJECT, offsetof(CompiledNameObject, name), READONLY, "The full name"},
+    {"chunks", T_OBJECT, offsetof(CompiledNameObject, chunks), READONLY, "The interned name chunks"},
+    {"executeCallables", T_INT, offsetof(CompiledNameObject, executeCallables), READONLY, NULL},
+    {"useDottedNotation", T_INT, offsetof(CompiledNameObject, useDottedNotation), READONLY, NULL},
+    {"hits", T_PYSSIZET, offsetof(CompiledNameObject, cache.hits), READONLY, "Lookups answered by the cache"},
+    {"misses", T_PYSSIZET, offsetof(CompiledNameObject, cache.misses), READONLY, "Lookups that took the slow path"},
+    {NULL}
+};
+
+static PyType_Slot CompiledName_slots[] = {
+    {Py_tp_dealloc, CompiledName_dealloc},
+    {Py_tp_repr, CompiledName_repr},
+    {Py_tp_doc, "A name prepared by compile_name()"},
+    {Py_tp_members, CompiledName_members},
+    {Py_tp_getset, CompiledName_getset},
+    {0, NULL}
+};
+
+/* Only compile_name() makes CompiledNames */
+#ifdef Py_TPFLAGS_DISALLOW_INSTANTIATION
+#define NM_TPFLAGS_NO_NEW Py_TPFLAGS_DISALLOW_INSTANTIATION
+#else
+#define NM_TPFLAGS_NO_NEW 0
+#endif
+
+static PyType_Spec CompiledName_spec = {
+    "Cheetah._namemapper.CompiledName",
+    sizeof(CompiledNameObject),
+    0,
+    Py_TPFLAGS_DEFAULT | NM_TPFLAGS_NO_NEW,
+    CompiledName_slots,
+};
+
+
+/* *************************************************************************** */
+/* SearchList */
+/* *************************************************************************** */
+
+/* A SearchList is a list of namespaces which keeps a merged index over every
+ * run of (two or more) consecutive plain dicts in it.  The index of a run maps
+ * each key to the value from the first dict in the run that has it, so a name
+ * costs one probe per run instead of one per dict.
+ *
+ * The layout (the runs) is recomputed whenever the list no longer holds the
+ * namespaces it was computed for, and an index is dropped as soon as the
+ * version tag of one of its dicts moves on.  To keep dicts that change all
+ * the time from being merged over and over, an index is only rebuilt once the
+ * lookups since it was dropped would have probed as many keys as it takes to
+ * build it.
+ *
+ * A SearchList also remembers, for the last names it was searched for, how
+ * many of its leading namespaces don't have the name, with a guard (as in an
+ * inline cache) for each of them.  Names that are missing altogether, or only
+ * found in globals and builtins, then skip the whole list for as long as the
+ * guards hold.  A dict that gains the name (a #set global writes to the first
+ * one) or an object that gets it as an attribute fails its guard and is
+ * searched again; a different layout forgets every name.
+ */
+
+typedef struct {
+    Py_ssize_t length;                  /* namespaces in the run, 1 if not indexed */
+    PyObject *index;                    /* merged dict, or NULL */
+    Py_ssize_t lookups;                 /* lookups since the index was dropped */
+} NMRun;
+
+typedef struct {
+    PyObject *key;                      /* interned name chunk */
+    Py_ssize_t numAbsent;               /* namespaces without key when it was stored */
+    Py_ssize_t numGuards;               /* the first numGuards namespaces don't have key */
+    NMGuard guards[1];                  /* numGuards of them */
+} NMNegativeEntry;
+
+typedef struct {
+    PyListObject list;
+    PyObject *layout;                   /* tuple of the namespaces the runs were computed for */
+    NMRun *runs;                        /* one per layout item, only used at the start of a run */
+    unsigned long long *versions;       /* dict version tags the indexes were built from */
+    NMNegativeEntry **negatives;        /* NM_NEGATIVE_ENTRIES slots by key hash, or NULL */
+    Py_ssize_t skipped;                 /* namespaces lookups didn't have to search */
+} SearchListObject;
+
+#define SearchList_Check(st, op) PyObject_TypeCheck(op, (st)->SearchListType)
+
+static void SearchList_clearLayout(SearchListObject *self)
+{
+    Py_ssize_t i;
+
+    if (self->negatives != NULL) {
+        for (i = 0; i < NM_NEGATIVE_ENTRIES; i++) {
+            if (self->negatives[i] != NULL) {
+                Py_DECREF(self->negatives[i]->key);
+                PyMem_Free(self->negatives[i]);
+            }
+        }
+        PyMem_Free(self->negatives);
+        self->negatives = NULL;
+    }
+    if (self->layout != NULL) {
+        for (i = 0; i < PyTuple_GET_SIZE(self->layout); i++) {
+            Py_CLEAR(self->runs[i].index);
+        }
+    }
+    PyMem_Free(self->runs);
+    PyMem_Free(self->versions);
+    self->runs = NULL;
+    self->versions = NULL;
+    Py_CLEAR(self->layout);
+}
+
+static int SearchList_traverse(SearchListObject *self, visitproc visit, void *arg)
+{
+    Py_ssize_t i;
+
+    if (self->layout != NULL) {
+        for (i = 0; i < PyTuple_GET_SIZE(self->layout); i++) {
+            Py_VISIT(self->runs[i].index);
+        }
+    }
+    Py_VISIT(self->layout);
+    NM_VISIT_TYPE(self);
+    return PyList_Type.tp_traverse((PyObject *)self, visit, arg);
+}
+
+static int SearchList_clear(SearchListObject *self)
+{
+    SearchList_clearLayout(self);
+    return PyList_Type.tp_clear((PyObject *)self);
+}
+
+static void SearchList_dealloc(SearchListObject *self)
+{
+    PyTypeObject *tp = Py_TYPE(self);
+
+    PyObject_GC_UnTrack(self);
+#if PY_VERSION_HEX >= 0x03080000
+    Py_TRASHCAN_BEGIN(self, SearchList_dealloc)
+#else
+    Py_TRASHCAN_SAFE_BEGIN(self)
+#endif
+    SearchList_clearLayout(self);
+    PyList_Type.tp_dealloc((PyObject *)self);
+    NM_DECREF_TYPE(tp);
+#if PY_VERSION_HEX >= 0x03080000
+    Py_TRASHCAN_END
+#else
+    Py_TRASHCAN_SAFE_END(self)
+#endif
+}
+
+static PyMemberDef SearchList_members[] = {
+    {"skipped", T_PYSSIZET, offsetof(SearchListObject, skipped), READONLY,
+        "Namespaces that lookups skipped because they were known not to have the name"},
+    {NULL}
+};
+
+static PyType_Slot SearchList_slots[] = {
+    {Py_tp_dealloc, SearchList_dealloc},
+    {Py_tp_doc, "A list of namespaces with a merged index over its runs of dicts"},
+    {Py_tp_traverse, SearchList_traverse},
+    {Py_tp_clear, SearchList_clear},
+    {Py_tp_members, SearchList_members},
+    {0, NULL}
+};
+
+static PyType_Spec SearchList_spec = {
+    "Cheetah._namemapper.SearchList",
+    sizeof(SearchListObject),
+    0,
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC,
+    SearchList_slots,                       /* based on list */
+};
+
+#ifdef NM_HAVE_DICT_VERSION
+
+/* Make sure the runs describe the namespaces currently in the list. */
+static int nm_searchListLayout(SearchListObject *self)
+{
+    Py_ssize_t size = PyList_GET_SIZE(self);
+    PyObject **items = ((PyListObject *)self)->ob_item;
+    Py_ssize_t i, j;
+
+    if (self->layout != NULL && PyTuple_GET_SIZE(self->layout) == size) {
+        for (i = 0; i < size && PyTuple_GET_ITEM(self->layout, i) == items[i]; i++) {
+        }
+        if (i == size) {
+            return 0;
+        }
+    }
+
+    SearchList_clearLayout(self);
+    self->runs = PyMem_Calloc(size ? size : 1, sizeof(NMRun));
+    self->versions = PyMem_Calloc(size ? size : 1, sizeof(unsigned long long));
+    if (self->runs == NULL || self->versions == NULL) {
+        SearchList_clearLayout(self);
+        PyErr_NoMemory();
+        return -1;
+    }
+    if (!(self->layout = PyList_AsTuple((PyObject *)self))) {
+        SearchList_clearLayout(self);
+        return -1;
+    }
+
+    items = &PyTuple_GET_ITEM(self->layout, 0);
+    for (i = 0; i < size; i = j) {
+        for (j = i; j < size && PyDict_CheckExact(items[j]); j++) {
+        }
+        if (j - i < 2) {
+            j = i + 1;
+        }
+        self->runs[i].length = j - i;
+    }
+    return 0;
+}
+
+/* Returns the up to date merged index of the run starting at start (borrowed)
+ * or NULL, without an exception set, if the run should be probed dict by dict.
+ */
+static PyObject *nm_runIndex(SearchListObject *self, PyObject *layout, Py_ssize_t start)
+{
+    NMRun *run = &self->runs[start];
+    PyObject **items = &PyTuple_GET_ITEM(layout, start);
+    unsigned long long *versions = &self->versions[start];
+    Py_ssize_t length = run->length;
+    Py_ssize_t numKeys = 0;
+    PyObject *index;
+    Py_ssize_t i;
+
+    if (run->index != NULL) {
+        for (i = 0; i < length && versions[i] == nm_dictVersion(items[i]); i++) {
+        }
+        if (i == length) {
+            return run->index;
+        }
+        Py_CLEAR(run->index);
+    }
+
+    for (i = 0; i < length; i++) {
+        numKeys += PyDict_GET_SIZE(items[i]);
+    }
+    if (++run->lookups * length < numKeys) {
+        return NULL;
+    }
+
+    if (!(index = PyDict_New())) {
+        return NULL;
+    }
+    /* earlier dicts win, so merge them last */
+    for (i = length - 1; i >= 0; i--) {
+        if (PyDict_Update(index, items[i]) < 0) {
+            Py_DECREF(index);
+            return NULL;
+        }
+    }
+    if (self->layout != layout) {
+        /* merging ran code which replaced the layout */
+        Py_DECREF(index);
+        return NULL;
+    }
+    for (i = 0; i < length; i++) {
+        versions[i] = nm_dictVersion(items[i]);
+    }
+    run->lookups = 0;
+    run->index = index;
+    return index;
+}
+
+static NMNegativeEntry **nm_negativeSlot(SearchListObject *self, PyObject *key)
+{
+    return &self->negatives[(size_t)PyObject_Hash(key) % NM_NEGATIVE_ENTRIES];
+}
+
+/* Returns how many of the leading namespaces of layout are known not to have
+ * key.  *stored receives how many a search must find without key to be worth
+ * remembering.
+ */
+static Py_ssize_t nm_negativeCheck(SearchListObject *self, PyObject *layout, PyObject *key, Py_ssize_t *stored)
+{
+    NMNegativeEntry *entry;
+    Py_ssize_t i;
+
+    *stored = 0;
+    if (self->negatives == NULL || (entry = *nm_negativeSlot(self, key)) == NULL || entry->key != key) {
+        return 0;
+    }
+    for (i = 0; i < entry->numGuards; i++) {
+        if (!nm_checkGuard(&entry->guards[i], PyTuple_GET_ITEM(layout, i), key)) {
+            break;
+        }
+    }
+    if (self->layout != layout) {
+        /* checking ran code which replaced the layout, and the entry with it */
+        return 0;
+    }
+    if (i < entry->numGuards) {
+        /* namespace i may have key now */
+        entry->numGuards = entry->numAbsent = i;
+    }
+    *stored = entry->numAbsent;
+    return i;
+}
+
+/* Remember that the first numAbsent namespaces of layout don't have key. */
+static void nm_negativeStore(SearchListObject *self, PyObject *layout, PyObject *key, Py_ssize_t numAbsent)
+{
+    NMGuard guards[NM_IC_MAXGUARDS];
+    NMNegativeEntry **slot;
+    NMNegativeEntry *entry;
+    Py_ssize_t i;
+
+    if (self->layout != layout) {
+        return;
+    }
+    for (i = 0; i < Py_MIN(numAbsent, NM_IC_MAXGUARDS) && nm_makeGuard(&guards[i], PyTuple_GET_ITEM(layout, i), key); i++) {
+    }
+    if (i == 0) {
+        return;
+    }
+    if (self->negatives == NULL) {
+        if (!(self->negatives = PyMem_Calloc(NM_NEGATIVE_ENTRIES, sizeof(NMNegativeEntry *)))) {
+            return;
+        }
+    }
+    if (!(entry = PyMem_Malloc(sizeof(NMNegativeEntry) + (i - 1) * sizeof(NMGuard)))) {
+        return;
+    }
+    Py_INCREF(key);
+    entry->key = key;
+    /* a namespace that can't be guarded ends the entry for good */
+    entry->numAbsent = numAbsent;
+    entry->numGuards = i;
+    memcpy(entry->guards, guards, i * sizeof(NMGuard));
+
+    slot = nm_negativeSlot(self, key);
+    if (*slot != NULL) {
+        Py_DECREF((*slot)->key);
+        PyMem_Free(*slot);
+    }
+    *slot = entry;
+}
+
+/* Returns a new reference to the value of key in the first namespace of the
+ * SearchList that has it, or NULL (with an exception set only if the layout
+ * couldn't be computed).  Like nm_probe it skips namespaces that raise.  If
+ * position is given it receives the list index of that namespace.  Callers
+ * hold the critical section of the SearchList.
+ */
+static PyObject *nm_searchListFind(SearchListObject *self, PyObject *key, Py_ssize_t *position, int *kind)
+{
+    PyObject *layout;
+    PyObject *nameSpace;
+    PyObject *index;
+    PyObject *value = NULL;
+    Py_ssize_t i, j, size, length, known, stored, start;
+    Py_ssize_t numAbsent;
+
+    if (nm_searchListLayout(self) < 0) {
+        return NULL;
+    }
+    layout = self->layout;
+    Py_INCREF(layout);
+    size = PyTuple_GET_SIZE(layout);
+
+    /* start with the run that has the first namespace which may have key */
+    known = nm_negativeCheck(self, layout, key, &stored);
+    for (start = 0; self->layout == layout && start < known && start + self->runs[start].length <= known;
+            start += self->runs[start].length) {
+    }
+    self->skipped += start;
+    numAbsent = size;
+
+    for (i = start; i < size; i += length) {
+        length = self->layout == layout ? self->runs[i].length : 1;
+        if (length > 1 && _PyType_Lookup(Py_TYPE(PyTuple_GET_ITEM(layout, i)), key) != NULL) {
+            /* the attributes of the first dict (keys, get, ...) come before
+             * the keys of the dicts after it: probe it on its own */
+            nameSpace = PyTuple_GET_ITEM(layout, i);
+            if ((value = nm_probe(nameSpace, key, kind))) {
+                numAbsent = i;
+                if (position != NULL) {
+                    *position = i;
+                }
+                goto done;
+            }
+        }
+        if (length > 1) {
+            /* comparing keys can run code that drops the index */
+            Py_XINCREF(index = nm_runIndex(self, layout, i));
+            if (index != NULL && (value = PyDict_GetItemWithError(index, key))) {
+                Py_INCREF(value);
+                Py_DECREF(index);
+                *kind = NM_IC_KEY;
+                numAbsent = i;
+                if (position != NULL) {
+                    /* the index doesn't know which dict the value came from */
+                    for (j = i; j < i + length - 1 && !PyDict_GetItemWithError(PyTuple_GET_ITEM(layout, j), key); j++) {
+                    }
+                    PyErr_Clear();
+                    *position = j;
+                }
+                goto done;
+            }
+            Py_XDECREF(index);
+            if (index != NULL && !PyErr_Occurred()) {
+                /* like nm_probe, fall back to the attributes of a dict, which
+                 * all come from its type */
+                if (nm_getAttr(PyTuple_GET_ITEM(layout, i), key, &value) < 0) {
+                    PyErr_Clear();
+                }
+                if (value != NULL) {
+                    *kind = NM_IC_ATTR;
+                    numAbsent = i;
+                    if (position != NULL) {
+                        *position = i;
+                    }
+                    goto done;
+                }
+                continue;
+            }
+            PyErr_Clear();
+        }
+
+        /* probe the namespaces (of a run without an index) one by one */
+        for (j = i; j < i + length; j++) {
+            nameSpace = PyTuple_GET_ITEM(layout, j);
+            if ((value = nm_probe(nameSpace, key, kind))) {
+                numAbsent = j;
+                if (position != NULL) {
+                    *position = j;
+                }
+                goto done;
+            }
+        }
+    }
+
+done:
+    if (numAbsent > stored) {
+        nm_negativeStore(self, layout, key, numAbsent);
+    }
+    Py_DECREF(layout);
+    return value;
+}
+
+#endif /* NM_HAVE_DICT_VERSION */
+
+
+/* Returns a new reference to the tuple of interned chunks for name, which is
+ * either a string or a CompiledName.
+ */
+static PyObject *nm_getNameChunks(NMState *st, PyObject *name)
+{
+    PyObject *chunks;
+
+    if (CompiledName_Check(st, name)) {
+        chunks = ((CompiledNameObject *)name)->chunks;
+        Py_INCREF(chunks);
+        return chunks;
+    }
+    if (!NM_TEXT_CHECK(name)) {
+        PyErr_SetString(PyExc_TypeError, "name must be a string or a CompiledName");
+        return NULL;
+    }
+
+    if ((chunks = nm_dictGetItem(st->nameTable, name)) != NULL) {
+        return chunks;
+    }
+    if (PyErr_Occurred() || !(chunks = splitNameChunks(st, name))) {
+        return NULL;
+    }
+    if (PyDict_Size(st->nameTable) >= NM_NAME_TABLE_SIZE) {
+        PyDict_Clear(st->nameTable);
+    }
+    if (PyDict_SetItem(st->nameTable, name, chunks) < 0) {
+        Py_DECREF(chunks);
+        return NULL;
+    }
+    return chunks;
+}
+
+/* A CompiledName carries its own flags; passing them again is an error.
+ * Otherwise unspecified (-1) flags get their defaults.
+ */
+static int nm_resolveFlags(NMState *st, PyObject *name, int *executeCallables, int *useDottedNotation)
+{
+    if (CompiledName_Check(st, name)) {
+        if (*executeCallables != -1 || *useDottedNotation != -1) {
+            PyErr_SetString(PyExc_TypeError,
+                    "executeCallables and useDottedNotation are fixed by compile_name()");
+            return -1;
+        }
+        *executeCallables = ((CompiledNameObject *)name)->executeCallables;
+        *useDottedNotation = ((CompiledNameObject *)name)->dictLookups ? NM_DICT_LOOKUPS :
+            ((CompiledNameObject *)name)->useDottedNotation;
+        return 0;
+    }
+    *executeCallables = *executeCallables == -1 ? FALSE : *executeCallables != 0;
+    *useDottedNotation = *useDottedNotation == -1 ? TRUE : *useDottedNotation != 0;
+    return 0;
+}
+
+static PyObject *nm_fullName(NMState *st, PyObject *name)
+{
+    return CompiledName_Check(st, name) ? ((CompiledNameObject *)name)->name : name;
+}
+
+
+/* *************************************************************************** */
+/* Searching namespaces */
+/* *************************************************************************** */
+
+/* Finish a lookup whose first chunk resolved to firstValue (stolen), found in
+ * source (counted in stats, if given).
+ */
+static PyObject *PyNamemapper_finishLookup(NMState *st, PyObject *firstValue, PyObject *name, PyObject *nameChunks[],
+        Py_ssize_t numChunks, int executeCallables, int useDottedNotation, NMNameStats *stats, Py_ssize_t source)
+{
+    PyObject *theValue;
+
+    if (stats != NULL) {
+        nm_statsCountHit(st, stats, source);
+    }
+    theValue = PyNamemapper_autocall(st, firstValue, executeCallables, stats);
+    if (theValue != NULL && numChunks > 1) {
+        firstValue = theValue;
+        theValue = PyNamemapper_valueForName(st, firstValue, &nameChunks[1], numChunks - 1,
+                executeCallables, useDottedNotation, stats);
+        Py_DECREF(firstValue);
+    }
+    if (wrapInternalNotFoundException(st, name)) {
+        theValue = NULL;
+    }
+    return theValue;
+}
+
+/* The search behind valueFromSearchList (searchFrame = FALSE) and
+ * valueFromFrameOrSearchList (searchFrame = TRUE).  Without raiseIfMissing
+ * a first chunk that is nowhere to be found returns NULL without raising.
+ *
+ * The first chunk is always looked up as a key as well as an attribute,
+ * because otherwise looking up locals and globals (from the dicts locals()
+ * and globals()) would always fail.
+ */
+static PyObject *PyNamemapper_search(NMState *st, PyObject *searchList, PyObject *name, PyObject *nameChunks[],
+        Py_ssize_t numChunks, int executeCallables, int useDottedNotation, int searchFrame, NMInlineCache *cache,
+        int raiseIfMissing, NMNameStats *stats)
+{
+    PyObject *key = nameChunks[0];
+    PyObject *nameSpace = NULL;
+    PyObject *firstValue = NULL;
+    PyObject *iterator = NULL;
+    Py_ssize_t index = 0;
+    int kind;
+#ifdef NM_HAVE_DICT_VERSION
+    NMGuard guards[NM_IC_MAXGUARDS];
+    NMGuard globalsGuard;
+    int cacheable = FALSE;
+#endif
+
+    if (searchFrame) {
+        if ((firstValue = nm_probe(PyEval_GetLocals(), key, &kind))) {
+            index = NM_SOURCE_LOCALS;
+            goto found;
+        }
+    }
+
+    if (cache != NULL) {
+        NM_BEGIN_CRITICAL_SECTION(searchList);
+        firstValue = nm_inlineCacheLookup(cache, searchList, key, searchFrame, &index);
+        NM_END_CRITICAL_SECTION();
+        if (firstValue != NULL) {
+            goto found;
+        }
+        nm_inlineCacheCount(cache, &cache->misses);
+#ifdef NM_HAVE_DICT_VERSION
+        cacheable = PyList_Check(searchList) || PyTuple_Check(searchList);
+#endif
+    }
+
+#ifdef NM_HAVE_DICT_VERSION
+    if (SearchList_Check(st, searchList)) {
+        NM_BEGIN_CRITICAL_SECTION(searchList);
+        firstValue = nm_searchListFind((SearchListObject *)searchList, key, &index, &kind);
+        if (firstValue != NULL || !PyErr_Occurred()) {
+            if (firstValue == NULL) {
+                index = PyList_GET_SIZE(searchList);
+            }
+            if (cacheable) {
+                cacheable = nm_makeGuards(guards, searchList, index, key);
+            }
+            /* the list may have shrunk while it was searched */
+            if (firstValue != NULL && cacheable && index < PyList_GET_SIZE(searchList)) {
+                nm_inlineCacheStore(cache, key, index, kind, PyList_GET_ITEM(searchList, index), guards, index, NULL);
+            }
+        }
+        NM_END_CRITICAL_SECTION();
+        if (firstValue != NULL) {
+            goto found;
+        }
+        if (PyErr_Occurred()) {
+            goto done;
+        }
+        goto searchGlobals;
+    }
+#endif
+
+    iterator = PyObject_GetIter(searchList);
+    if (iterator == NULL) {
+        PyErr_SetString(PyExc_TypeError, "This searchList is not iterable!");
+        return NULL;
+    }
+
+    while ((nameSpace = PyIter_Next(iterator))) {
+        if ((firstValue = nm_probe(nameSpace, key, &kind))) {
+#ifdef NM_HAVE_DICT_VERSION
+            if (cacheable) {
+                nm_inlineCacheStore(cache, key, index, kind, nameSpace, guards, index, NULL);
+            }
+#endif
+            Py_DECREF(nameSpace);
+            goto found;
+        }
+#ifdef NM_HAVE_DICT_VERSION
+        if (cacheable && !(index < NM_IC_MAXGUARDS && nm_makeGuard(&guards[index], nameSpace, key))) {
+            cacheable = FALSE;
+        }
+#endif
+        index++;
+        Py_DECREF(nameSpace);
+        if (PyErr_CheckSignals()) {
+            goto done;
+        }
+    }
+    if (PyErr_Occurred()) {
+        goto done;
+    }
+
+#ifdef NM_HAVE_DICT_VERSION
+searchGlobals:
+#endif
+    if (searchFrame) {
+        nameSpace = PyEval_GetGlobals();
+        if ((firstValue = nm_probe(nameSpace, key, &kind))) {
+#ifdef NM_HAVE_DICT_VERSION
+            if (cacheable) {
+                nm_inlineCacheStore(cache, key, NM_IC_GLOBALS, kind, nameSpace, guards, index, NULL);
+            }
+#endif
+            index = NM_SOURCE_GLOBALS;
+            goto found;
+        }
+#ifdef NM_HAVE_DICT_VERSION
+        if (cacheable && !nm_makeGuard(&globalsGuard, nameSpace, key)) {
+            cacheable = FALSE;
+        }
+#endif
+
+        nameSpace = PyEval_GetBuiltins();
+        if ((firstValue = nm_probe(nameSpace, key, &kind))) {
+#ifdef NM_HAVE_DICT_VERSION
+            if (cacheable) {
+                nm_inlineCacheStore(cache, key, NM_IC_BUILTINS, kind, nameSpace, guards, index, &globalsGuard);
+            }
+#endif
+            index = NM_SOURCE_BUILTINS;
+            goto found;
+        }
+    }
+
+    if (raiseIfMissing) {
+        setNotFoundException(st, key);
+        wrapInternalNotFoundException(st, name);
+    }
+
+done:
+    Py_XDECREF(iterator);
+    return NULL;
+
+found:
+    Py_XDECREF(iterator);
+    return PyNamemapper_finishLookup(st, firstValue, name, nameChunks, numChunks, executeCallables, useDottedNotation,
+            stats, index);
+}
+
+
+/* *************************************************************************** */
+/* Now the wrapper functions to export into the Python module */
+/* *************************************************************************** */
+
+
+static PyObject *namemapper_valueForKey(PyObject *self, PyObject *args)
+{
+    PyObject *obj;
+    PyObject *key;
+
+    if (!PyArg_ParseTuple(args, "OO", &obj, &key)) {
+        return NULL;
+    }
+    if (!NM_TEXT_CHECK(key)) {
+        PyErr_SetString(PyExc_TypeError, "key must be a string");
+        return NULL;
+    }
+
+    return PyNamemapper_valueForKey(nm_getState(self), obj, key);
+}
+
+static PyObject *namemapper_compile_name(PYARGS)
+{
+    PyObject *name;
+    int executeCallables = 0;
+    int useDottedNotation = 1;
+    const char *lookupMode = "default";
+    int dictLookups;
+    CompiledNameObject *compiled;
+    NMState *st;
+
+    static char *kwlist[] = {"name", "executeCallables", "useDottedNotation", "lookupMode", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|iis", kwlist, &name, &executeCallables, &useDottedNotation,
+                &lookupMode)) {
+        return NULL;
+    }
+    if (!NM_TEXT_CHECK(name)) {
+        PyErr_SetString(PyExc_TypeError, "name must be a string");
+        return NULL;
+    }
+    dictLookups = strcmp(lookupMode, "dict") == 0;
+    if (!dictLookups && strcmp(lookupMode, "default") != 0) {
+        PyErr_Format(PyExc_ValueError, "lookupMode must be 'default' or 'dict', not '%s'", lookupMode);
+        return NULL;
+    }
+
+    st = nm_getState(self);
+    compiled = (CompiledNameObject *)st->CompiledNameType->tp_alloc(st->CompiledNameType, 0);
+    if (compiled == NULL) {
+        return NULL;
+    }
+    memset(&compiled->cache, 0, sizeof(NMInlineCache));
+    compiled->cache.index = NM_IC_EMPTY;
+    /* names in dict mode are never autocalled */
+    compiled->executeCallables = executeCallables && !dictLookups;
+    compiled->useDottedNotation = useDottedNotation != 0;
+    compiled->dictLookups = dictLookups;
+    Py_INCREF(name);
+    compiled->name = name;
+    if (!(compiled->chunks = splitNameChunks(st, name))) {
+        Py_DECREF(compiled);
+        return NULL;
+    }
+    return (PyObject *)compiled;
+}
+
+static PyObject *nm_valueForName(NMState *st, PyObject *obj, PyObject *name, int executeCallables, int useDottedNotation)
+{
+    PyObject *nameChunks;
+    PyObject *theValue;
+
+    if (nm_resolveFlags(st, name, &executeCallables, &useDottedNotation)) {
+        return NULL;
+    }
+    if (!(nameChunks = nm_getNameChunks(st, name))) {
+        return NULL;
+    }
+
+    theValue = PyNamemapper_valueForName(st, obj, PySequence_Fast_ITEMS(nameChunks), PyTuple_GET_SIZE(nameChunks),
+            executeCallables, useDottedNotation, NULL);
+    if (wrapInternalNotFoundException(st, nm_fullName(st, name))) {
+        theValue = NULL;
+    }
+    Py_DECREF(nameChunks);
+
+    return theValue;
+}
+
+/* Shared by valueFromSearchList and valueFromFrameOrSearchList.  A
+ * CompiledName brings its own inline cache; an explicit cache wins.  If
+ * defaultValue is given it is returned instead of raising NotFound.
+ */
+static PyObject *nm_searchListLookup(NMState *st, PyObject *searchList, PyObject *name, int executeCallables,
+        int useDottedNotation, PyObject *cacheObj, PyObject *defaultValue, int searchFrame)
+{
+    NMInlineCache *cache = NULL;
+    PyObject *nameChunks;
+    PyObject *theValue;
+    PyObject *statsCapsule = NULL;
+    NMNameStats *stats = NULL;
+    double start;
+
+    if (nm_resolveFlags(st, name, &executeCallables, &useDottedNotation)) {
+        return NULL;
+    }
+    if (cacheObj != NULL && cacheObj != Py_None) {
+        if (!InlineCache_Check(st, cacheObj)) {
+            PyErr_SetString(PyExc_TypeError, "cache must be an InlineCache or None");
+            return NULL;
+        }
+        cache = &((InlineCacheObject *)cacheObj)->cache;
+    } else if (CompiledName_Check(st, name)) {
+        cache = &((CompiledNameObject *)name)->cache;
+    }
+    if (!(nameChunks = nm_getNameChunks(st, name))) {
+        return NULL;
+    }
+    if (nm_statsStart(st, nm_fullName(st, name), &statsCapsule, &stats, &start)) {
+        Py_DECREF(nameChunks);
+        return NULL;
+    }
+
+    theValue = PyNamemapper_search(st, searchList, nm_fullName(st, name), PySequence_Fast_ITEMS(nameChunks),
+            PyTuple_GET_SIZE(nameChunks), executeCallables, useDottedNotation, searchFrame, cache,
+            defaultValue == NULL, stats);
+    Py_DECREF(nameChunks);
+    if (stats != NULL) {
+        nm_statsFinish(st, statsCapsule, stats, theValue, start);
+    }
+    if (theValue == NULL && defaultValue != NULL && (!PyErr_Occurred() || PyErr_ExceptionMatches(st->NotFound))) {
+        PyErr_Clear();
+        Py_INCREF(defaultValue);
+        theValue = defaultValue;
+    }
+
+    return theValue;
+}
+
+static PyObject *nm_valueFromFrame(NMState *st, PyObject *name, int executeCallables, int useDottedNotation)
+{
+    PyObject *nameChunks;
+    PyObject **chunks;
+    Py_ssize_t numChunks;
+    PyObject *nameSpaces[3];
+    static const Py_ssize_t sources[3] = {NM_SOURCE_LOCALS, NM_SOURCE_GLOBALS, NM_SOURCE_BUILTINS};
+    PyObject *theValue = NULL;
+    PyObject *statsCapsule = NULL;
+    NMNameStats *stats = NULL;
+    double start;
+    int kind;
+    int i;
+
+    if (nm_resolveFlags(st, name, &executeCallables, &useDottedNotation)) {
+        return NULL;
+    }
+    if (!(nameChunks = nm_getNameChunks(st, name))) {
+        return NULL;
+    }
+    chunks = PySequence_Fast_ITEMS(nameChunks);
+    numChunks = PyTuple_GET_SIZE(nameChunks);
+    if (nm_statsStart(st, nm_fullName(st, name), &statsCapsule, &stats, &start)) {
+        Py_DECREF(nameChunks);
+        return NULL;
+    }
+
+    nameSpaces[0] = PyEval_GetLocals();
+    nameSpaces[1] = PyEval_GetGlobals();
+    nameSpaces[2] = PyEval_GetBuiltins();
+    for (i = 0; i < 3; i++) {
+        if ((theValue = nm_probe(nameSpaces[i], chunks[0], &kind))) {
+            theValue = PyNamemapper_finishLookup(st, theValue, nm_fullName(st, name), chunks, numChunks,
+                    executeCallables, useDottedNotation, stats, sources[i]);
+            goto done;
+        }
+    }
+
+    setNotFoundException(st, chunks[0]);
+    wrapInternalNotFoundException(st, nm_fullName(st, name));
+done:
+    Py_DECREF(nameChunks);
+    if (stats != NULL) {
+        nm_statsFinish(st, statsCapsule, stats, theValue, start);
+    }
+
+    return theValue;
+}
+
+/* The batch lookup behind valuesFromSearchList (searchFrame = FALSE) and
+ * valuesFromFrameOrSearchList (searchFrame = TRUE).  The first chunks of all
+ * names are resolved during a single pass over the namespaces, then every
+ * lookup is finished in order.  Statistics split the time of the shared pass
+ * evenly between the names.
+ */
+typedef struct {
+    PyObject *name;                     /* borrowed from the names sequence */
+    PyObject *chunks;
+    PyObject *firstValue;
+    Py_ssize_t source;
+    int executeCallables;
+    int useDottedNotation;
+    PyObject *statsCapsule;
+    NMNameStats *stats;
+} NMBatchItem;
+
+static Py_ssize_t nm_batchProbe(NMBatchItem *items, Py_ssize_t numItems, PyObject *nameSpace, Py_ssize_t source,
+        Py_ssize_t remaining)
+{
+    Py_ssize_t i;
+    int kind;
+
+    for (i = 0; i < numItems && remaining; i++) {
+        if (items[i].firstValue == NULL) {
+            items[i].firstValue = nm_probe(nameSpace, PyTuple_GET_ITEM(items[i].chunks, 0), &kind);
+            if (items[i].firstValue != NULL) {
+                items[i].source = source;
+                remaining--;
+            }
+        }
+    }
+    return remaining;
+}
+
+static PyObject *nm_batchLookup(NMState *st, PyObject *searchList, PyObject *names, int executeCallables,
+        int useDottedNotation, PyObject *defaultValue, int searchFrame)
+{
+    PyObject *namesSeq;
+    PyObject *iterator = NULL;
+    PyObject *nameSpace;
+    PyObject *theValue;
+    PyObject *result = NULL;
+    NMBatchItem *items;
+    Py_ssize_t numItems, remaining, i, index = 0;
+    double start = 0.0, shareOfScan = 0.0;
+#ifdef NM_HAVE_DICT_VERSION
+    int kind;
+#endif
+
+    if (!(namesSeq = PySequence_Fast(names, "names must be a sequence"))) {
+        return NULL;
+    }
+    numItems = remaining = PySequence_Fast_GET_SIZE(namesSeq);
+    items = PyMem_Malloc((numItems ? numItems : 1) * sizeof(NMBatchItem));
+    if (items == NULL) {
+        Py_DECREF(namesSeq);
+        return PyErr_NoMemory();
+    }
+    memset(items, 0, (numItems ? numItems : 1) * sizeof(NMBatchItem));
+    for (i = 0; i < numItems; i++) {
+        items[i].name = PySequence_Fast_GET_ITEM(namesSeq, i);
+        items[i].executeCallables = executeCallables;
+        items[i].useDottedNotation = useDottedNotation;
+        if (nm_resolveFlags(st, items[i].name, &items[i].executeCallables, &items[i].useDottedNotation) ||
+                !(items[i].chunks = nm_getNameChunks(st, items[i].name)) ||
+                nm_statsStart(st, nm_fullName(st, items[i].name), &items[i].statsCapsule, &items[i].stats, &start)) {
+            goto done;
+        }
+    }
 
-static PyObject *namemapper_valueForKey(PyObject *self, PyObject *args)
-{
-    PyObject *obj;
-    char *key;
+    if (searchFrame) {
+        remaining = nm_batchProbe(items, numItems, PyEval_GetLocals(), NM_SOURCE_LOCALS, remaining);
+    }
+#ifdef NM_HAVE_DICT_VERSION
+    if (remaining && SearchList_Check(st, searchList)) {
+        NM_BEGIN_CRITICAL_SECTION(searchList);
+        for (i = 0; i < numItems && remaining; i++) {
+            if (items[i].firstValue == NULL) {
+                items[i].firstValue = nm_searchListFind((SearchListObject *)searchList,
+                        PyTuple_GET_ITEM(items[i].chunks, 0), &items[i].source, &kind);
+                if (items[i].firstValue != NULL) {
+                    remaining--;
+                } else if (PyErr_Occurred()) {
+                    break;
+                }
+            }
+        }
+        NM_END_CRITICAL_SECTION();
+        if (PyErr_Occurred()) {
+            goto done;
+        }
+    } else
+#endif
+    if (remaining) {
+        if (!(iterator = PyObject_GetIter(searchList))) {
+            PyErr_SetString(PyExc_TypeError, "This searchList is not iterable!");
+            goto done;
+        }
+        while (remaining && (nameSpace = PyIter_Next(iterator))) {
+            remaining = nm_batchProbe(items, numItems, nameSpace, index++, remaining);
+            Py_DECREF(nameSpace);
+            if (PyErr_CheckSignals()) {
+                goto done;
+            }
+        }
+        if (PyErr_Occurred()) {
+            goto done;
+        }
+    }
+    if (searchFrame && remaining) {
+        remaining = nm_batchProbe(items, numItems, PyEval_GetGlobals(), NM_SOURCE_GLOBALS, remaining);
+        remaining = nm_batchProbe(items, numItems, PyEval_GetBuiltins(), NM_SOURCE_BUILTINS, remaining);
+    }
+    if (numItems && items[0].stats != NULL) {
+        shareOfScan = (nm_now() - start) / numItems;
+    }
 
-    if (!PyArg_ParseTuple(args, "Os", &obj, &key)) {
-        return NULL;
+    if (!(result = PyTuple_New(numItems))) {
+        goto done;
+    }
+    for (i = 0; i < numItems; i++) {
+        start = items[i].stats != NULL ? nm_now() - shareOfScan : 0.0;
+        if (items[i].firstValue != NULL) {
+            theValue = PyNamemapper_finishLookup(st, items[i].firstValue, nm_fullName(st, items[i].name),
+                    PySequence_Fast_ITEMS(items[i].chunks), PyTuple_GET_SIZE(items[i].chunks),
+                    items[i].executeCallables, items[i].useDottedNotation, items[i].stats, items[i].source);
+            items[i].firstValue = NULL;     /* stolen */
+        } else {
+            theValue = NULL;
+            if (defaultValue == NULL) {
+                setNotFoundException(st, PyTuple_GET_ITEM(items[i].chunks, 0));
+                wrapInternalNotFoundException(st, nm_fullName(st, items[i].name));
+            }
+        }
+        if (items[i].stats != NULL) {
+            nm_statsFinish(st, items[i].statsCapsule, items[i].stats, theValue, start);
+            items[i].statsCapsule = NULL;
+        }
+        if (theValue == NULL) {
+            if (defaultValue == NULL || (PyErr_Occurred() && !PyErr_ExceptionMatches(st->NotFound))) {
+                Py_CLEAR(result);
+                goto done;
+            }
+            PyErr_Clear();
+            Py_INCREF(defaultValue);
+            theValue = defaultValue;
+        }
+        PyTuple_SET_ITEM(result, i, theValue);
     }
 
-    return PyNamemapper_valueForKey(obj, key);
+done:
+    for (i = 0; i < numItems; i++) {
+        Py_XDECREF(items[i].chunks);
+        Py_XDECREF(items[i].firstValue);
+        Py_XDECREF(items[i].statsCapsule);
+    }
+    PyMem_Free(items);
+    Py_XDECREF(iterator);
+    Py_DECREF(namesSeq);
+    return result;
 }
 
+/* Unspecified flags are passed on as -1 so that nm_resolveFlags can tell
+ * them apart from explicit ones.
+ */
+
 static PyObject *namemapper_valueForName(PYARGS)
 {
     PyObject *obj;
-    char *name;
-    int executeCallables = 0;
-    int useDottedNotation = 1;
-
-    char *nameCopy = NULL;
-    char *tmpPntr1 = NULL;
-    char *tmpPntr2 = NULL;
-    char *nameChunks[MAXCHUNKS];
-    int numChunks;
-
-    PyObject *theValue;
+    PyObject *name;
+    int executeCallables = -1;
+    int useDottedNotation = -1;
 
     static char *kwlist[] = {"obj", "name", "executeCallables", "useDottedNotation", NULL};
 
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "Os|ii", kwlist,  &obj, &name, &executeCallables, &useDottedNotation)) {
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|ii", kwlist,  &obj, &name, &executeCallables, &useDottedNotation)) {
         return NULL;
     }
-
-    createNameCopyAndChunks();
-
-    theValue = PyNamemapper_valueForName(obj, nameChunks, numChunks, executeCallables, useDottedNotation);
-    free(nameCopy);
-    if (wrapInternalNotFoundException(name)) {
-        theValue = NULL;
-    }
-
-    return theValue;
+    return nm_valueForName(nm_getState(self), obj, name, executeCallables, useDottedNotation);
 }
 
 static PyObject *namemapper_valueFromSearchList(PYARGS)
 {
     PyObject *searchList;
-    char *name;
-    int executeCallables = 0;
-    int useDottedNotation = 1;
+    PyObject *name;
+    int executeCallables = -1;
+    int useDottedNotation = -1;
+    PyObject *cache = NULL;
+    PyObject *defaultValue = NULL;
 
-    char *nameCopy = NULL;
-    char *tmpPntr1 = NULL;
-    char *tmpPntr2 = NULL;
-    char *nameChunks[MAXCHUNKS];
-    int numChunks;
+    static char *kwlist[] = {"searchList", "name", "executeCallables", "useDottedNotation", "cache", "default", NULL};
 
-    PyObject *nameSpace = NULL;
-    PyObject *theValue = NULL;
-    PyObject *theValue_tmp = NULL;
-    PyObject *iterator = NULL;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|iiOO", kwlist, &searchList, &name,
+                &executeCallables, &useDottedNotation, &cache, &defaultValue)) {
+        return NULL;
+    }
+    return nm_searchListLookup(nm_getState(self), searchList, name, executeCallables, useDottedNotation, cache,
+            defaultValue, FALSE);
+}
+
+static PyObject *namemapper_valueFromFrameOrSearchList(PYARGS)
+{
+    PyObject *searchList;
+    PyObject *name;
+    int executeCallables = -1;
+    int useDottedNotation = -1;
+    PyObject *cache = NULL;
+    PyObject *defaultValue = NULL;
 
-    static char *kwlist[] = {"searchList", "name", "executeCallables", "useDottedNotation", NULL};
+    static char *kwlist[] = {"searchList", "name", "executeCallables", "useDottedNotation", "cache", "default", NULL};
 
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "Os|ii", kwlist, &searchList, &name, &executeCallables, &useDottedNotation)) {
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|iiOO", kwlist, &searchList, &name,
+                &executeCallables, &useDottedNotation, &cache, &defaultValue)) {
         return NULL;
     }
+    return nm_searchListLookup(nm_getState(self), searchList, name, executeCallables, useDottedNotation, cache,
+            defaultValue, TRUE);
+}
 
-    createNameCopyAndChunks();
+static PyObject *namemapper_valueFromFrame(PYARGS)
+{
+    PyObject *name;
+    int executeCallables = -1;
+    int useDottedNotation = -1;
 
-    iterator = PyObject_GetIter(searchList);
-    if (iterator == NULL) {
-        PyErr_SetString(PyExc_TypeError, "This searchList is not iterable!");
-        goto done;
-    }
+    static char *kwlist[] = {"name", "executeCallables", "useDottedNotation", NULL};
 
-    while ((nameSpace = PyIter_Next(iterator))) {
-        checkForNameInNameSpaceAndReturnIfFound(TRUE);
-        Py_DECREF(nameSpace);
-        if (PyErr_CheckSignals()) {
-        theValue = NULL;
-        goto done;
-        }
-    }
-    if (PyErr_Occurred()) {
-        theValue = NULL;
-        goto done;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|ii", kwlist, &name, &executeCallables, &useDottedNotation)) {
+        return NULL;
     }
+    return nm_valueFromFrame(nm_getState(self), name, executeCallables, useDottedNotation);
+}
 
-    setNotFoundException(nameChunks[0]);
 
-done:
-    Py_XDECREF(iterator);
-    free(nameCopy);
+static PyObject *nm_batchLookupArgs(PyObject *self, PyObject *args, PyObject *kwargs, int searchFrame)
+{
+    PyObject *searchList;
+    PyObject *names;
+    int executeCallables = -1;
+    int useDottedNotation = -1;
+    PyObject *defaultValue = NULL;
 
-    return theValue;
+    static char *kwlist[] = {"searchList", "names", "executeCallables", "useDottedNotation", "default", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|iiO", kwlist, &searchList, &names,
+                &executeCallables, &useDottedNotation, &defaultValue)) {
+        return NULL;
+    }
+    return nm_batchLookup(nm_getState(self), searchList, names, executeCallables, useDottedNotation, defaultValue,
+            searchFrame);
 }
 
-static PyObject *namemapper_valueFromFrameOrSearchList(PyObject *self, PyObject *args, PyObject *keywds)
+static PyObject *namemapper_valuesFromSearchList(PYARGS)
 {
-    /* python function args */
-    char *name;
-    int executeCallables = 0;
-    int useDottedNotation = 1;
-    PyObject *searchList = NULL;
+    return nm_batchLookupArgs(self, args, kwargs, FALSE);
+}
 
-    /* locals */
-    char *nameCopy = NULL;
-    char *tmpPntr1 = NULL;
-    char *tmpPntr2 = NULL;
-    char *nameChunks[MAXCHUNKS];
-    int numChunks;
+static PyObject *namemapper_valuesFromFrameOrSearchList(PYARGS)
+{
+    return nm_batchLookupArgs(self, args, kwargs, TRUE);
+}
 
-    PyObject *nameSpace = NULL;
-    PyObject *theValue = NULL;
-    PyObject *theValue_tmp = NULL;
-    PyObject *iterator = NULL;
 
-    static char *kwlist[] = {"searchList", "name",  "executeCallables", "useDottedNotation", NULL};
+#if PY_VERSION_HEX >= 0x03070000
+/* *************************************************************************** */
+/* METH_FASTCALL entry points */
+/* *************************************************************************** */
 
-    if (!PyArg_ParseTupleAndKeywords(args, keywds, "Os|ii", kwlist,  &searchList, &name,
-                    &executeCallables, &useDottedNotation)) {
-        return NULL;
-    }
+/* Compiled templates call the lookup functions positionally, most of the time
+ * with just a searchList (or object) and a CompiledName.  These entry points
+ * take that straight from the argument vector; keyword calls are handed to
+ * the PyArg_ParseTupleAndKeywords versions above.
+ */
 
-    createNameCopyAndChunks();
+typedef PyObject *(*nm_varargsfunc)(PyObject *, PyObject *, PyObject *);
 
-    nameSpace = PyEval_GetLocals();
-    checkForNameInNameSpaceAndReturnIfFound(FALSE);
+static PyObject *nm_keywordsFallback(nm_varargsfunc func, PyObject *self, PyObject *const *args, Py_ssize_t nargs,
+        PyObject *kwnames)
+{
+    PyObject *argsTuple;
+    PyObject *kwargs = NULL;
+    PyObject *result = NULL;
+    Py_ssize_t i;
 
-    iterator = PyObject_GetIter(searchList);
-    if (iterator == NULL) {
-        PyErr_SetString(PyExc_TypeError, "This searchList is not iterable!");
-        goto done;
+    if (!(argsTuple = PyTuple_New(nargs))) {
+        return NULL;
     }
-    while ((nameSpace = PyIter_Next(iterator))) {
-        checkForNameInNameSpaceAndReturnIfFound(TRUE);
-        Py_DECREF(nameSpace);
-        if (PyErr_CheckSignals()) {
-            theValue = NULL;
+    for (i = 0; i < nargs; i++) {
+        Py_INCREF(args[i]);
+        PyTuple_SET_ITEM(argsTuple, i, args[i]);
+    }
+    if (kwnames != NULL && PyTuple_GET_SIZE(kwnames)) {
+        if (!(kwargs = PyDict_New())) {
             goto done;
         }
+        for (i = 0; i < PyTuple_GET_SIZE(kwnames); i++) {
+            if (PyDict_SetItem(kwargs, PyTuple_GET_ITEM(kwnames, i), args[nargs + i]) < 0) {
+                goto done;
+            }
+        }
     }
-    if (PyErr_Occurred()) {
-        theValue = NULL;
-        goto done;
-    }
-
-    nameSpace = PyEval_GetGlobals();
-    checkForNameInNameSpaceAndReturnIfFound(FALSE);
+    result = func(self, argsTuple, kwargs);
 
-    nameSpace = PyEval_GetBuiltins();
-    checkForNameInNameSpaceAndReturnIfFound(FALSE);
+done:
+    Py_DECREF(argsTuple);
+    Py_XDECREF(kwargs);
+    return result;
+}
 
-    setNotFoundException(nameChunks[0]);
+/* The same conversion as the "i" format unit, with a shortcut for bools. */
+static int nm_flagFromArg(PyObject *arg, int *flag)
+{
+    long value;
 
-done:
-    Py_XDECREF(iterator);
-    free(nameCopy);
+    if (arg == Py_True || arg == Py_False) {
+        *flag = arg == Py_True;
+        return 0;
+    }
+    if (PyFloat_Check(arg)) {
+        PyErr_SetString(PyExc_TypeError, "integer argument expected, got float");
+        return -1;
+    }
+    value = PyLong_AsLong(arg);
+    if (value == -1 && PyErr_Occurred()) {
+        return -1;
+    }
+    if (value > INT_MAX || value < INT_MIN) {
+        PyErr_SetString(PyExc_OverflowError, "signed integer is greater than maximum");
+        return -1;
+    }
+    *flag = (int)value;
+    return 0;
+}
 
-    return theValue;
+static int nm_flagsFromArgs(PyObject *const *flags, Py_ssize_t numFlags, int *executeCallables, int *useDottedNotation)
+{
+    if (numFlags > 0 && nm_flagFromArg(flags[0], executeCallables) < 0) {
+        return -1;
+    }
+    if (numFlags > 1 && nm_flagFromArg(flags[1], useDottedNotation) < 0) {
+        return -1;
+    }
+    return 0;
 }
 
-static PyObject *namemapper_valueFromFrame(PyObject *self, PyObject *args, PyObject *keywds)
+#define NM_HAS_KEYWORDS(kwnames) ((kwnames) != NULL && PyTuple_GET_SIZE(kwnames))
+
+static PyObject *namemapper_valueForName_fast(PyObject *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames)
 {
-    /* python function args */
-    char *name;
-    int executeCallables = 0;
-    int useDottedNotation = 1;
+    int executeCallables = -1;
+    int useDottedNotation = -1;
+
+    if (NM_HAS_KEYWORDS(kwnames) || nargs < 2 || nargs > 4) {
+        return nm_keywordsFallback(namemapper_valueForName, self, args, nargs, kwnames);
+    }
+    if (nm_flagsFromArgs(args + 2, nargs - 2, &executeCallables, &useDottedNotation) < 0) {
+        return NULL;
+    }
+    return nm_valueForName(nm_getState(self), args[0], args[1], executeCallables, useDottedNotation);
+}
 
-    /* locals */
-    char *tmpPntr1 = NULL;
-    char *tmpPntr2 = NULL;
+static PyObject *nm_searchListLookup_fast(nm_varargsfunc fallback, PyObject *self, PyObject *const *args,
+        Py_ssize_t nargs, PyObject *kwnames, int searchFrame)
+{
+    int executeCallables = -1;
+    int useDottedNotation = -1;
+    PyObject *defaultValue = NULL;
+
+    /* default= is the one keyword worth a fast path */
+    if (NM_HAS_KEYWORDS(kwnames)) {
+        if (PyTuple_GET_SIZE(kwnames) != 1 ||
+                PyUnicode_CompareWithASCIIString(PyTuple_GET_ITEM(kwnames, 0), "default") != 0) {
+            return nm_keywordsFallback(fallback, self, args, nargs, kwnames);
+        }
+        defaultValue = args[nargs];
+    }
+    if (nargs < 2 || nargs > 5) {
+        return nm_keywordsFallback(fallback, self, args, nargs, kwnames);
+    }
+    if (nm_flagsFromArgs(args + 2, nargs - 2, &executeCallables, &useDottedNotation) < 0) {
+        return NULL;
+    }
+    return nm_searchListLookup(nm_getState(self), args[0], args[1], executeCallables, useDottedNotation,
+            nargs > 4 ? args[4] : NULL, defaultValue, searchFrame);
+}
 
-    char *nameCopy = NULL;
-    char *nameChunks[MAXCHUNKS];
-    int numChunks;
+static PyObject *namemapper_valueFromSearchList_fast(PyObject *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames)
+{
+    return nm_searchListLookup_fast(namemapper_valueFromSearchList, self, args, nargs, kwnames, FALSE);
+}
 
-    PyObject *nameSpace = NULL;
-    PyObject *theValue = NULL;
-    PyObject *theValue_tmp = NULL;
+static PyObject *namemapper_valueFromFrameOrSearchList_fast(PyObject *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames)
+{
+    return nm_searchListLookup_fast(namemapper_valueFromFrameOrSearchList, self, args, nargs, kwnames, TRUE);
+}
 
-    static char *kwlist[] = {"name", "executeCallables", "useDottedNotation", NULL};
+static PyObject *namemapper_valueFromFrame_fast(PyObject *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames)
+{
+    int executeCallables = -1;
+    int useDottedNotation = -1;
 
-    if (!PyArg_ParseTupleAndKeywords(args, keywds, "s|ii", kwlist, &name, &executeCallables, &useDottedNotation)) {
+    if (NM_HAS_KEYWORDS(kwnames) || nargs < 1 || nargs > 3) {
+        return nm_keywordsFallback(namemapper_valueFromFrame, self, args, nargs, kwnames);
+    }
+    if (nm_flagsFromArgs(args + 1, nargs - 1, &executeCallables, &useDottedNotation) < 0) {
         return NULL;
     }
+    return nm_valueFromFrame(nm_getState(self), args[0], executeCallables, useDottedNotation);
+}
 
-    createNameCopyAndChunks();
+#define NM_LOOKUP_METHOD(name, func) \
+    {name, (PyCFunction)(void(*)(void))func##_fast, METH_FASTCALL|METH_KEYWORDS}
+#else
+#define NM_LOOKUP_METHOD(name, func) \
+    {name, (PyCFunction)func, METH_VARARGS|METH_KEYWORDS}
+#endif /* METH_FASTCALL */
 
-    nameSpace = PyEval_GetLocals();
-    checkForNameInNameSpaceAndReturnIfFound(FALSE);
 
-    nameSpace = PyEval_GetGlobals();
-    checkForNameInNameSpaceAndReturnIfFound(FALSE);
+static PyObject *namemapper_enable_stats(PYARGS)
+{
+    PyObject *enabled = Py_True;
+    int isTrue;
 
-    nameSpace = PyEval_GetBuiltins();
-    checkForNameInNameSpaceAndReturnIfFound(FALSE);
+    static char *kwlist[] = {"enabled", NULL};
 
-    setNotFoundException(nameChunks[0]);
-done:
-    free(nameCopy);
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O", kwlist, &enabled)) {
+        return NULL;
+    }
+    if ((isTrue = PyObject_IsTrue(enabled)) < 0) {
+        return NULL;
+    }
+    nm_getState(self)->statsEnabled = isTrue;
+    Py_RETURN_NONE;
+}
 
-    return theValue;
+static PyObject *namemapper_get_stats(PyObject *self, PyObject *unused)
+{
+    NMState *st = nm_getState(self);
+    PyObject *items;
+    PyObject *result;
+    PyObject *nameStats;
+    Py_ssize_t i;
+
+    if (!(items = PyDict_Items(st->stats)) || !(result = PyDict_New())) {
+        Py_XDECREF(items);
+        return NULL;
+    }
+    for (i = 0; i < PyList_GET_SIZE(items); i++) {
+        PyObject *item = PyList_GET_ITEM(items, i);
+
+        nameStats = nm_statsAsDict(st, PyCapsule_GetPointer(PyTuple_GET_ITEM(item, 1), NM_STATS_CAPSULE));
+        if (nameStats == NULL || PyDict_SetItem(result, PyTuple_GET_ITEM(item, 0), nameStats) < 0) {
+            Py_XDECREF(nameStats);
+            Py_CLEAR(result);
+            break;
+        }
+        Py_DECREF(nameStats);
+    }
+    Py_DECREF(items);
+    return result;
+}
+
+static PyObject *namemapper_reset_stats(PyObject *self, PyObject *unused)
+{
+    PyDict_Clear(nm_getState(self)->stats);
+    Py_RETURN_NONE;
 }
 
 
@@ -447,10 +2589,16 @@ done:
 
 static struct PyMethodDef namemapper_methods[] = {
   {"valueForKey", namemapper_valueForKey,  1},
-  {"valueForName", (PyCFunction)namemapper_valueForName,  METH_VARARGS|METH_KEYWORDS},
-  {"valueFromSearchList", (PyCFunction)namemapper_valueFromSearchList,  METH_VARARGS|METH_KEYWORDS},
-  {"valueFromFrame", (PyCFunction)namemapper_valueFromFrame,  METH_VARARGS|METH_KEYWORDS},
-  {"valueFromFrameOrSearchList", (PyCFunction)namemapper_valueFromFrameOrSearchList,  METH_VARARGS|METH_KEYWORDS},
+  NM_LOOKUP_METHOD("valueForName", namemapper_valueForName),
+  NM_LOOKUP_METHOD("valueFromSearchList", namemapper_valueFromSearchList),
+  NM_LOOKUP_METHOD("valueFromFrame", namemapper_valueFromFrame),
+  NM_LOOKUP_METHOD("valueFromFrameOrSearchList", namemapper_valueFromFrameOrSearchList),
+  {"valuesFromSearchList", (PyCFunction)namemapper_valuesFromSearchList,  METH_VARARGS|METH_KEYWORDS},
+  {"valuesFromFrameOrSearchList", (PyCFunction)namemapper_valuesFromFrameOrSearchList,  METH_VARARGS|METH_KEYWORDS},
+  {"compile_name", (PyCFunction)namemapper_compile_name,  METH_VARARGS|METH_KEYWORDS},
+  {"enable_stats", (PyCFunction)namemapper_enable_stats,  METH_VARARGS|METH_KEYWORDS},
+  {"get_stats", namemapper_get_stats,  METH_NOARGS},
+  {"reset_stats", namemapper_reset_stats,  METH_NOARGS},
   {NULL,         NULL}
 };
 
@@ -458,54 +2606,183 @@ static struct PyMethodDef namemapper_methods[] = {
 /* *************************************************************************** */
 /* Initialization function (import-time) */
 
+/* Multi-phase initialization: the module and its state are created per
+ * interpreter, and nm_exec fills the state in.  2.x initializes the module
+ * once, into the static state.
+ */
+
+#ifdef IS_PYTHON3
+static PyObject *nm_addType(PyObject *m, PyType_Spec *spec, PyObject *base, const char *name)
+{
+    PyObject *bases = NULL;
+    PyObject *type;
+
+    /* a single base type (rather than a tuple) needs 3.10+ */
+    if (base != NULL && !(bases = PyTuple_Pack(1, base))) {
+        return NULL;
+    }
+    type = PyType_FromSpecWithBases(spec, bases);
+    Py_XDECREF(bases);
+    if (type == NULL) {
+        return NULL;
+    }
+    Py_INCREF(type);
+    if (PyModule_AddObject(m, name, type) < 0) {
+        Py_DECREF(type);
+        Py_DECREF(type);
+        return NULL;
+    }
+    return type;
+}
+#else
+static PyObject *nm_addType(PyObject *m, PyType_Spec *spec, PyObject *base, const char *name)
+{
+    PyTypeObject *type;
+    PyType_Slot *slot;
+
+    if (!(type = PyMem_Calloc(1, sizeof(PyTypeObject)))) {
+        return PyErr_NoMemory();
+    }
+    Py_REFCNT(type) = 1;
+    Py_TYPE(type) = &PyType_Type;
+    type->tp_name = spec->name;
+    type->tp_basicsize = spec->basicsize;
+    type->tp_itemsize = spec->itemsize;
+    type->tp_flags = spec->flags;
+    type->tp_base = (PyTypeObject *)base;
+    for (slot = spec->slots; slot->slot; slot++) {
+        switch (slot->slot) {
+            case Py_tp_dealloc: type->tp_dealloc = (destructor)slot->pfunc; break;
+            case Py_tp_repr: type->tp_repr = (reprfunc)slot->pfunc; break;
+            case Py_tp_str: type->tp_str = (reprfunc)slot->pfunc; break;
+            case Py_tp_doc: type->tp_doc = (const char *)slot->pfunc; break;
+            case Py_tp_traverse: type->tp_traverse = (traverseproc)slot->pfunc; break;
+            case Py_tp_clear: type->tp_clear = (inquiry)slot->pfunc; break;
+            case Py_tp_members: type->tp_members = (PyMemberDef *)slot->pfunc; break;
+            case Py_tp_getset: type->tp_getset = (PyGetSetDef *)slot->pfunc; break;
+            case Py_tp_new: type->tp_new = (newfunc)slot->pfunc; break;
+        }
+    }
+    if (PyType_Ready(type) < 0) {
+        return NULL;
+    }
+    Py_INCREF(type);
+    if (PyModule_AddObject(m, name, (PyObject *)type) < 0) {
+        Py_DECREF(type);
+        return NULL;
+    }
+    return (PyObject *)type;
+}
+#endif
+
+static int nm_exec(PyObject *m)
+{
+    NMState *st = nm_getState(m);
+
+    if (!(st->NotFound = nm_addType(m, &NotFound_spec, PyExc_LookupError, "NotFound"))) {
+        return -1;
+    }
+    if (!(st->TooManyPeriods = PyErr_NewException("NameMapper.TooManyPeriodsInName", NULL, NULL))) {
+        return -1;
+    }
+    Py_INCREF(st->TooManyPeriods);
+    if (PyModule_AddObject(m, "TooManyPeriodsInName", st->TooManyPeriods) < 0) {
+        Py_DECREF(st->TooManyPeriods);
+        return -1;
+    }
+
+    if (!(st->InlineCacheType = (PyTypeObject *)nm_addType(m, &InlineCache_spec, NULL, "InlineCache"))) {
+        return -1;
+    }
+    if (!(st->CompiledNameType = (PyTypeObject *)nm_addType(m, &CompiledName_spec, NULL, "CompiledName"))) {
+        return -1;
+    }
+#ifndef Py_TPFLAGS_DISALLOW_INSTANTIATION
+    st->CompiledNameType->tp_new = NULL;
+#endif
+    if (!(st->SearchListType = (PyTypeObject *)nm_addType(m, &SearchList_spec, (PyObject *)&PyList_Type, "SearchList"))) {
+        return -1;
+    }
+
+    if (!(st->nameTable = PyDict_New()) || !(st->mroString = NM_INTERN_FROM_STRING("mro")) ||
+            !(st->stats = PyDict_New())) {
+        return -1;
+    }
+    return 0;
+}
+
 #ifdef IS_PYTHON3
+static int nm_traverse(PyObject *m, visitproc visit, void *arg)
+{
+    NMState *st = nm_getState(m);
+
+    Py_VISIT(st->NotFound);
+    Py_VISIT(st->TooManyPeriods);
+    Py_VISIT(st->InlineCacheType);
+    Py_VISIT(st->CompiledNameType);
+    Py_VISIT(st->SearchListType);
+    Py_VISIT(st->nameTable);
+    Py_VISIT(st->stats);
+    return 0;
+}
+
+static int nm_clear(PyObject *m)
+{
+    NMState *st = nm_getState(m);
+
+    Py_CLEAR(st->NotFound);
+    Py_CLEAR(st->TooManyPeriods);
+    Py_CLEAR(st->InlineCacheType);
+    Py_CLEAR(st->CompiledNameType);
+    Py_CLEAR(st->SearchListType);
+    Py_CLEAR(st->nameTable);
+    Py_CLEAR(st->mroString);
+    Py_CLEAR(st->stats);
+    return 0;
+}
+
+static void nm_free(void *m)
+{
+    nm_clear((PyObject *)m);
+}
+
+static PyModuleDef_Slot namemapper_slots[] = {
+    {Py_mod_exec, nm_exec},
+#ifdef Py_mod_multiple_interpreters
+    {Py_mod_multiple_interpreters, Py_MOD_PER_INTERPRETER_GIL_SUPPORTED},
+#endif
+#ifdef Py_mod_gil
+    {Py_mod_gil, Py_MOD_GIL_NOT_USED},
+#endif
+    {0, NULL}
+};
+
 static struct PyModuleDef namemappermodule = {
     PyModuleDef_HEAD_INIT,
     "_namemapper",
     NULL, /* docstring */
-    -1,
+    sizeof(NMState),
     namemapper_methods,
-    NULL,
-    NULL,
-    NULL,
-    NULL};
+    namemapper_slots,
+    nm_traverse,
+    nm_clear,
+    nm_free,
+};
 
 PyMODINIT_FUNC PyInit__namemapper(void)
 {
-    PyObject *m = PyModule_Create(&namemappermodule);
+    return PyModuleDef_Init(&namemappermodule);
+}
 #else
-DL_EXPORT(void) init_namemapper(void)
+PyMODINIT_FUNC init_namemapper(void)
 {
     PyObject *m = Py_InitModule3("_namemapper", namemapper_methods, NULL);
-#endif
 
-    PyObject *d, *pprintMod;
-
-    /* add symbolic constants to the module */
-    d = PyModule_GetDict(m);
-    NotFound = PyErr_NewException("NameMapper.NotFound", PyExc_LookupError, NULL);
-    TooManyPeriods = PyErr_NewException("NameMapper.TooManyPeriodsInName", NULL, NULL);
-    PyDict_SetItemString(d, "NotFound", NotFound);
-    PyDict_SetItemString(d, "TooManyPeriodsInName", TooManyPeriods);
-
-    pprintMod = PyImport_ImportModule("pprint");
-    if (!pprintMod) {
-#ifdef IS_PYTHON3
-        return NULL;
-#else
-        return;
-#endif
-    }
-    pprintMod_pformat = PyObject_GetAttrString(pprintMod, "pformat");
-    Py_DECREF(pprintMod);
-    /* check for errors */
-    if (PyErr_Occurred()) {
-        Py_FatalError("Can't initialize module _namemapper");
+    if (m != NULL) {
+        nm_exec(m);
     }
-#ifdef IS_PYTHON3
-    return m;
-#endif
 }
+#endif
 
 #ifdef __cplusplus
 }
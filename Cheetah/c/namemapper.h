@@ -37,6 +37,13 @@
 
 #if PY_MAJOR_VERSION >= 3
 #define IS_PYTHON3
+#else
+/* 2.x has no PyDict_GetItemWithError; PyDict_GetItem swallows errors in
+ * __hash__ / __eq__ there, which the lookups treat as a miss anyway */
+#define PyDict_GetItemWithError PyDict_GetItem
+#endif
+#ifndef PyDict_GET_SIZE
+#define PyDict_GET_SIZE(mp) (((PyDictObject *)(mp))->ma_used)
 #endif
 
 #define TRUE 1
@@ -49,37 +56,50 @@
  * _namemapper.c specific definitions
  */
 #define MAXCHUNKS 15		/* max num of nameChunks for the arrays */
+
+/*
+ * Inline caches need a cheap way to tell that a dict has not changed since
+ * it was last looked at.  Dict version tags provide that on 3.6 - 3.13; on
+ * other versions the caches are never filled and every lookup takes the slow
+ * path.
+ */
+#if PY_VERSION_HEX >= 0x03060000 && PY_VERSION_HEX < 0x030E0000
+#define NM_HAVE_DICT_VERSION
+#endif
+/* 3.13 stopped setting Py_TPFLAGS_VALID_VERSION_TAG: a type's version tag is
+ * valid there while it is not 0 */
+#if PY_VERSION_HEX >= 0x030D0000
+#define NM_TYPE_VERSION_VALID(tp) ((tp)->tp_version_tag != 0)
+#else
+#define NM_TYPE_VERSION_VALID(tp) PyType_HasFeature((tp), Py_TPFLAGS_VALID_VERSION_TAG)
+#endif
+#define NM_IC_MAXGUARDS 16     /* deepest searchList index an inline cache remembers */
+#define NM_IC_EMPTY -1
+#define NM_IC_GLOBALS -2
+#define NM_IC_BUILTINS -3
+/* where lookup statistics say a first name chunk was found, besides a searchList index */
+#define NM_SOURCE_LOCALS -4
+#define NM_SOURCE_GLOBALS NM_IC_GLOBALS
+#define NM_SOURCE_BUILTINS NM_IC_BUILTINS
+#define NM_IC_KEY 0
+#define NM_IC_ATTR 1
 #define ALLOW_WRAPPING_OF_NOTFOUND_EXCEPTIONS 1
-#define createNameCopyAndChunks() {\
-    nameCopy = malloc(strlen(name) + 1);\
-    tmpPntr1 = name; \
-    tmpPntr2 = nameCopy;\
-    while ((*tmpPntr2++ = *tmpPntr1++)); \
-        numChunks = getNameChunks(nameChunks, name, nameCopy); \
-    if (PyErr_Occurred()) { 	/* there might have been TooManyPeriods */\
-        free(nameCopy);\
-        return NULL;\
-    }\
-}
 
-#define checkForNameInNameSpaceAndReturnIfFound(namespace_decref) { \
-    if (PyNamemapper_hasKey(nameSpace, nameChunks[0])) {\
-        /* We always do the first lookup with useDottedNotation = 1, because
-         * otherwise looking up locals and globals (from the dicts locals() and
-         * globals()) would always fail. */ \
-        theValue_tmp = theValue = PyNamemapper_valueForName(nameSpace, &nameChunks[0], 1, executeCallables, 1); \
-        if (numChunks > 1) { \
-            theValue = PyNamemapper_valueForName(theValue_tmp, &nameChunks[1], numChunks - 1, executeCallables, useDottedNotation);\
-            Py_DECREF(theValue_tmp);\
-        }\
-        if (namespace_decref) {\
-            Py_DECREF(nameSpace);\
-        }\
-        if (wrapInternalNotFoundException(name)) {\
-            theValue = NULL;\
-        }\
-        goto done;\
-    }\
-}
+/* useDottedNotation of lookupMode='dict' names: every chunk after the first is
+ * a mapping key, never an attribute */
+#define NM_DICT_LOOKUPS 2
+
+#define NM_NAME_TABLE_SIZE 4096 /* plain string names remembered with their chunks */
+#define NM_TYPE_DECISIONS 64    /* types whose isInstanceOrClass() answer is remembered */
+#define NM_NEGATIVE_ENTRIES 16  /* names a SearchList remembers the absence of */
+
+/*
+ * Free-threaded builds run lookups of one interpreter in parallel, so the
+ * state they share (inline caches, the type decisions, SearchList indexes)
+ * is locked there.  The locks are no-ops everywhere else.
+ */
+#ifdef Py_GIL_DISABLED
+#define NM_FREE_THREADED
+#endif
 
 #endif
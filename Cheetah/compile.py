@@ -1,9 +1,17 @@
 from __future__ import unicode_literals
 
-import imp
+import collections
+import hashlib
 import io
+import marshal
+import numbers
 import os.path
+import sys
+import tempfile
+import threading
+import types
 
+import Cheetah
 from Cheetah import five
 from Cheetah.legacy_compiler import LegacyCompiler
 
@@ -69,6 +77,13 @@ def compile_file(filename, target=None, **kwargs):
     return target
 
 
+def _create_module_from_code(code, filename):
+    module = types.ModuleType(str('created_module'))
+    module.__file__ = filename
+    exec(code, module.__dict__)  # pylint:disable=exec-used
+    return module
+
+
 def _create_module_from_source(source, filename='<generated cheetah module>'):
     """Creates a module from the given source.
 
@@ -77,25 +92,244 @@ def _create_module_from_source(source, filename='<generated cheetah module>'):
     """
     assert type(source) is five.text
 
-    module = imp.new_module('created_module')
-    module.__file__ = filename
     code = compile(source, filename, 'exec', dont_inherit=True)
-    exec(code, module.__dict__)  # pylint:disable=exec-used
-    return module
+    return _create_module_from_code(code, filename)
+
+
+def _setting_key(value):
+    """Returns a key of a setting value which is the same in every process.
+    Functions and classes are keyed on their module and qualified name.
+    Raises ValueError for values without one, like lambdas or objects which
+    repr with their address.
+    """
+    if isinstance(value, (five.text, bytes, numbers.Number, type(None))):
+        return value
+    elif isinstance(value, dict):
+        return sorted(
+            ((_setting_key(key), _setting_key(val)) for key, val in value.items()),
+            key=repr,
+        )
+    elif isinstance(value, (list, tuple)):
+        return (type(value).__name__, [_setting_key(item) for item in value])
+    elif isinstance(value, (set, frozenset)):
+        return (type(value).__name__, sorted((_setting_key(item) for item in value), key=repr))
+
+    # Only values which their module and name lead back to
+    found = sys.modules.get(getattr(value, '__module__', None))
+    qualname = getattr(value, '__qualname__', getattr(value, '__name__', ''))
+    for attr in qualname.split('.'):
+        found = getattr(found, attr, None)
+    if found is not value:
+        raise ValueError('{0!r} has no stable key'.format(value))
+    return ('global', value.__module__, qualname)
+
+
+def _cache_key(source, cls_name, settings, compiler_cls):
+    """Returns the key of a template in the caches, or None if its settings
+    can't be keyed the same in every process.
+    """
+    try:
+        settings_key = _setting_key(settings or {})
+    except ValueError:
+        return None
+    key = repr((
+        source,
+        cls_name,
+        settings_key,
+        compiler_cls.__module__,
+        compiler_cls.__name__,
+        Cheetah.__version__,
+        sys.version,
+    ))
+    return hashlib.sha256(key.encode('UTF-8')).hexdigest()
+
+
+def _write_cache(path, cache_dir, code):
+    """Writes the code object to the cache entry at path.  The cache is
+    best effort: an entry which can't be written (a full disk, a cache_dir
+    which can't be created or written to) is left out.
+    """
+    tmp_path = None
+    try:
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+        # Other processes sharing the cache only ever see complete entries:
+        # the entry is written to a temporary file which is then renamed
+        # over it (atomically, on the POSIX systems cheetah runs on).
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(marshal.dumps(code))
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+def _create_module_from_cache(
+        key,
+        source,
+        cls_name,
+        cache_dir,
+        settings,
+        compiler_cls,
+        filename='<generated cheetah module>',
+):
+    """Creates the module of a template, using the code object cached in
+    cache_dir for the same source, settings, compiler class, cheetah and
+    python if there is one and caching it otherwise.
+    """
+    path = os.path.join(cache_dir, key + '.marshal')
+    try:
+        with io.open(path, 'rb') as cache_file:
+            code = marshal.loads(cache_file.read())
+    except (IOError, EOFError, ValueError, TypeError):
+        code = None
+
+    if code is None:
+        compiled_source = compile_source(
+            source, cls_name=cls_name, settings=settings,
+            compiler_cls=compiler_cls,
+        )
+        code = compile(compiled_source, filename, 'exec', dont_inherit=True)
+
+        _write_cache(path, cache_dir, code)
+    return _create_module_from_code(code, filename)
 
 
-def compile_to_class(source, cls_name='DynamicallyCompiledTemplate', **kwargs):
+class ClassCache(object):
+    """A thread-safe LRU of the classes compile_to_class built.
+
+    It holds at most max_entries classes, of templates whose sources are at
+    most max_size characters together, and counts its hits, misses and
+    evictions.
+    """
+
+    def __init__(self, max_entries=512, max_size=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Forgets every class and resets the counters."""
+        with self._lock:
+            # key -> (class, size), least recently used first
+            self._classes = collections.OrderedDict()
+            self._size = 0
+            self._hits = self._misses = self._evictions = 0
+
+    def get(self, key):
+        """Returns the class cached under key, or None."""
+        with self._lock:
+            try:
+                entry = self._classes.pop(key)
+            except KeyError:
+                self._misses += 1
+                return None
+            self._classes[key] = entry
+            self._hits += 1
+            return entry[0]
+
+    def add(self, key, cls, size):
+        """Caches cls under key, evicting the least recently used classes
+        as needed.  Returns the class cached under key, which is an earlier
+        one if another thread added that in the meantime.
+        """
+        with self._lock:
+            if key in self._classes:
+                return self._classes[key][0]
+            self._classes[key] = (cls, size)
+            self._size += size
+            while (
+                    len(self._classes) > self.max_entries or
+                    self._size > self.max_size
+            ):
+                _, (_, evicted_size) = self._classes.popitem(last=False)
+                self._size -= evicted_size
+                self._evictions += 1
+            return cls
+
+    def stats(self):
+        """Returns a dict of the 'hits', 'misses' and 'evictions' so far and
+        the current number of 'entries' and their 'size'.
+        """
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'entries': len(self._classes),
+                'size': self._size,
+            }
+
+
+# The classes compile_to_class built, by default
+class_cache = ClassCache()
+
+
+def compile_to_class(
+        source,
+        cls_name='DynamicallyCompiledTemplate',
+        settings=None,
+        compiler_cls=LegacyCompiler,
+        cache_dir=None,
+        class_cache=class_cache,
+):
     """Compile source directly to a `type` object.  Mainly used by tests.
 
+    Compiling the same source with the same cls_name, settings and compiler
+    class again returns the same class from class_cache (pass None to always
+    build a new class).
+
+    With a cache_dir, the compiled code is cached on disk there (the
+    directory is created if needed), keyed on the source, cls_name,
+    settings, compiler class and the versions of cheetah and python.  Any
+    number of processes can share a cache directory.  Entries which can't
+    be written are left out of the cache.
+
+    Functions and classes in the settings are keyed on their module and
+    name.  Templates with settings which can't be keyed that way (lambdas,
+    nested functions, other objects) are compiled without either cache.
+
     :param text source: Text representing the cheetah source
     :param text cls_name: Classname for generated module.
-    :param kwargs: Keyword args passed to `compile`
+    :param dict settings: Compile settings
+    :param type compiler_cls: Class to use for the compiler.
+    :param text cache_dir: Directory of the on-disk cache, or None.
+    :param ClassCache class_cache: In-memory cache of the classes, or None.
     :return: A `Template` class
     :rtype: type
     """
-    compiled_source = compile_source(source, cls_name=cls_name, **kwargs)
-    module = _create_module_from_source(compiled_source)
+    if class_cache is None and cache_dir is None:
+        key = None
+    else:
+        key = _cache_key(source, cls_name, settings, compiler_cls)
+
+    if key is not None and class_cache is not None:
+        cls = class_cache.get(key)
+        if cls is not None:
+            return cls
+
+    if key is None or cache_dir is None:
+        compiled_source = compile_source(
+            source, cls_name=cls_name, settings=settings,
+            compiler_cls=compiler_cls,
+        )
+        module = _create_module_from_source(compiled_source)
+    else:
+        module = _create_module_from_cache(
+            key, source, cls_name, cache_dir, settings, compiler_cls,
+        )
     cls = getattr(module, cls_name)
     # To prevent our module from getting gc'd
     cls.__module_obj__ = module
+
+    if key is not None and class_cache is not None:
+        cls = class_cache.add(key, cls, len(source))
     return cls
@@ -9,6 +9,7 @@
 '''
 from __future__ import unicode_literals
 
+import ast
 import collections
 import copy
 import re
@@ -20,6 +21,7 @@ from Cheetah.legacy_parser import LegacyParser
 from Cheetah.legacy_parser import SET_GLOBAL
 from Cheetah.legacy_parser import escapedNewlineRE
 from Cheetah.SettingsManager import SettingsManager
+from Cheetah.Template import Template
 
 
 CallDetails = collections.namedtuple(
@@ -32,7 +34,18 @@ _DEFAULT_COMPILER_SETTINGS = [
     ('useNameMapper', True, 'Enable NameMapper for dotted notation and searchList support'),
     ('useAutocalling', False, 'Detect and call callable objects in searchList, requires useNameMapper=True'),
     ('useDottedNotation', False, 'Allow use of dotted notation for dictionary lookups, requires useNameMapper=True'),
+    (
+        'lookupMode', 'default',
+        "'dict' looks up the dotted parts of $names as mapping keys only, never as attributes, and never autocalls. "
+        'For searchLists of plain nested dicts, such as decoded JSON',
+    ),
     ('useLegacyImportMode', True, 'All #import statements are relocated to the top of the generated Python module'),
+    (
+        'loadGlobalsDirectly', True,
+        "$names of #import'ed names and of common builtin functions (len, str, enumerate, sorted, ...) load the "
+        'global instead of searching the searchList for it first (the template\'s own methods and attributes '
+        'still come first).  Turn it off for searchLists that shadow such names',
+    ),
 
     ('mainMethodName', 'respond', ''),
     ('mainMethodNameForSubclasses', 'writeBody', ''),
@@ -48,11 +61,148 @@ _DEFAULT_COMPILER_SETTINGS = [
     ('macroDirectives', {}, 'For providing macros'),
 
     ('future_unicode_literals', True, 'from __future__ import unicode_literals'),
+
+    (
+        'prefetchSearchListNames', False,
+        'Look up the searchList names used by a method once, when it starts.  The rest of a dotted name '
+        'is still looked up where it is used.  Assumes the searchList does not change while the method runs',
+    ),
+    (
+        'streamingRespond', False,
+        'Compile the main method (respond) into a generator, respond_iter, which yields the output in chunks: '
+        'at #flush, before and after #blocks, and at the end of a loop iteration once streamingChunkSize '
+        'characters are waiting.  respond joins them',
+    ),
+    ('streamingChunkSize', 8192, 'See streamingRespond'),
+    (
+        'hoistLoopInvariantLookups', False,
+        'Look up the searchList names used in a #for or #while loop once, before the loop, unless they are '
+        'local variables somewhere in the method.  The rest of a dotted name is still looked up in the loop.  '
+        'Autocalled names only if they are in pureNames.  Assumes the searchList does not change while the '
+        'loop runs',
+    ),
+    (
+        'eliminateCommonLookups', False,
+        'Look up the searchList names which a method has more than one placeholder of once, when it starts, '
+        'unless they are local variables somewhere in the method.  The rest of a dotted name is still looked '
+        'up where it is used.  Autocalled names only if they are in pureNames.  Assumes the searchList does '
+        'not change while the method runs',
+    ),
+    (
+        'pureNames', [],
+        'Autocalled searchList names (without the $, up to the first period) whose values '
+        'hoistLoopInvariantLookups and eliminateCommonLookups may compute once and reuse.  They are computed '
+        'before the loop or method runs, even if the placeholders using them are not reached',
+    ),
+    (
+        'asyncRespond', False,
+        'Compile the methods into coroutines, with respond named arespond.  Placeholders whose values are '
+        'awaitable are awaited concurrently when the method finishes, and written where they were',
+    ),
 ]
 
+# The builtins loadGlobalsDirectly loads: functions templates call, under
+# names searchLists don't use for values of their own (as they do id, type,
+# format, filter, input, hash, min or max)
+_BUILTIN_NAMES = frozenset((
+    'abs', 'all', 'any', 'bool', 'enumerate', 'float', 'getattr', 'hasattr',
+    'int', 'isinstance', 'len', 'range', 'repr', 'reversed', 'round',
+    'sorted', 'str', 'tuple', 'zip',
+))
+
 DEFAULT_COMPILER_SETTINGS = dict([(v[0], v[1]) for v in _DEFAULT_COMPILER_SETTINGS])
 
 
+def _bound_names(source):
+    """Returns the names that are assigned, imported or declared anywhere in
+    the function defined by source, or None if it can't be parsed.
+    """
+    try:
+        func = ast.parse(source).body[0]
+    except SyntaxError:
+        return None
+
+    names = set()
+    for node in ast.walk(func):
+        if isinstance(node, ast.Name):
+            if not isinstance(node.ctx, ast.Load):
+                names.add(node.id)
+        elif isinstance(node, ast.alias):
+            names.add((node.asname or node.name).split('.')[0])
+        elif isinstance(node, ast.arguments):
+            # py2 keeps *args and **kwargs as plain strings
+            names.update(
+                arg for arg in (node.vararg, node.kwarg) if isinstance(arg, str)
+            )
+        elif isinstance(node, (ast.Global, getattr(ast, 'Nonlocal', ast.Global))):
+            names.update(node.names)
+        elif node is not func:
+            # function parameters, nested defs and classes, except ... as
+            for attr in ('arg', 'name'):
+                if isinstance(getattr(node, attr, None), str):
+                    names.add(getattr(node, attr))
+    return names
+
+
+def _target_names(node):
+    """Returns the plain names an assignment target binds."""
+    if isinstance(node, ast.Name):
+        return {node.id}
+    elif isinstance(node, (ast.Tuple, ast.List)):
+        return set().union(*[_target_names(elt) for elt in node.elts])
+    elif isinstance(node, getattr(ast, 'Starred', ())):
+        return _target_names(node.value)
+    else:
+        return set()
+
+
+def _assigned_names(source):
+    """Returns the names source (python statements) assigns to as a local
+    variable.  Names it may assign to, such as those bound by a walrus or in
+    a nested block, aren't included.
+    """
+    try:
+        body = ast.parse(source).body
+    except SyntaxError:
+        return set()
+
+    names = set()
+    for node in body:
+        if isinstance(node, ast.Assign):
+            targets = node.targets
+        elif isinstance(node, (ast.AugAssign, ast.For)):
+            targets = [node.target]
+        elif isinstance(node, getattr(ast, 'AnnAssign', ())) and node.value:
+            targets = [node.target]
+        elif isinstance(node, ast.With):
+            # py2 has a single context manager per With node
+            items = getattr(node, 'items', [node])
+            targets = [item.optional_vars for item in items if item.optional_vars]
+        elif isinstance(node, getattr(ast, 'Try', getattr(ast, 'TryExcept', ()))):
+            # py2 has a Name node as the name of an except clause
+            targets = [
+                handler.name if isinstance(handler.name, ast.AST) else ast.Name(handler.name, ast.Store())
+                for handler in node.handlers if handler.name
+            ]
+        else:
+            targets = []
+        for target in targets:
+            names.update(_target_names(target))
+    return names
+
+
+def _deleted_names(source):
+    try:
+        body = ast.parse(source).body
+    except SyntaxError:
+        return set()
+    return set().union(*[
+        _target_names(target)
+        for node in body if isinstance(node, ast.Delete)
+        for target in node.targets
+    ])
+
+
 def genPlainVar(nameChunks):
     """Generate Python code for a Cheetah $var without using NameMapper
     (Unified Dotted Notation with the SearchList).
@@ -111,6 +261,10 @@ class GenUtils(object):
         is False, otherwise it defaults to True. It is overridden by the global
         setting 'useAutocalling' if this setting is False.
 
+        With the setting lookupMode='dict' the compiled names look up every
+        part after the first as a mapping key (and nothing is autocalled), so
+        $a.b.c is a['b']['c'] for whatever $a is on the searchList.
+
         EXAMPLE
         ------------------------------------------------------------------------
         if the raw Cheetah Var is
@@ -123,13 +277,20 @@ class GenUtils(object):
           ]
 
         When this method is fed the list above it returns
-          VFN(VFN(VFFSL(SL, 'a.b.c',True)[1], 'd',False)(), 'x.y.z',True)
+          VFN(VFN(VFFSL(SL, _n1)[1], _n2)(), _n3)
+        If 'a' is a local variable that is bound at this point of the method,
+        and isn't autocalled, 'a' is used directly instead of VFFSL, as in
+          VFN(VFN(VFN(a, _n1)[1], _n2)(), _n3)
+        with _n1 for 'b.c'.
         which can be represented as
           VFN(B`, name=C[0], executeCallables=(useAC and C[1]))C[2]
         where:
           VFN = NameMapper.valueForName
           VFFSL = NameMapper.valueFromFrameOrSearchList
           SL = self.searchList()
+          _n1, _n2, _n3 = module level NameMapper.compile_name() constants
+              for 'a.b.c', 'd' and 'x.y.z' carrying the flags below (and,
+              for _n1, the inline cache of this call site)
           useAC = self.setting('useAutocalling') # True in this example
 
           A = ('a.b.c',True,'[1]')
@@ -144,26 +305,34 @@ class GenUtils(object):
           B` = VFN(A`, name=B[0], executeCallables=(useAC and B[1]))B[2]
           A` = VFFSL(SL, name=A[0], executeCallables=(useAC and A[1]))A[2]
         """
-        defaultUseAC = self.setting('useAutocalling')
+        if self.setting('lookupMode') not in ('default', 'dict'):
+            raise ValueError("lookupMode must be 'default' or 'dict', not {0!r}".format(self.setting('lookupMode')))
+        defaultUseAC = self.setting('useAutocalling') and self.setting('lookupMode') != 'dict'
         useDottedNotation = self.setting('useDottedNotation')
 
+        self._nameMapperVarCount += 1
         nameChunks.reverse()
         name, useAC, remainder = nameChunks.pop()
 
-        pythonCode = 'VFFSL(SL, "%s", %s, %s)%s' % (
-            name,
-            defaultUseAC and useAC,
-            useDottedNotation,
-            remainder,
-        )
+        local, _, rest = name.partition('.')
+        if not (defaultUseAC and useAC) and self.isLocalName(local):
+            # a local that is certainly bound: NameMapper would find it first
+            if rest:
+                pythonCode = 'VFN(%s, %s)%s' % (
+                    local, self.addCompiledName(rest, False, useDottedNotation), remainder,
+                )
+            else:
+                pythonCode = local + remainder
+        else:
+            constName = self.addCompiledName(name, defaultUseAC and useAC, useDottedNotation)
+            self.addSearchListLookup(constName, name, defaultUseAC and useAC, useDottedNotation)
+            pythonCode = 'VFFSL(SL, %s)%s' % (constName, remainder)
 
         while nameChunks:
             name, useAC, remainder = nameChunks.pop()
-            pythonCode = 'VFN(%s, "%s", %s, %s)%s' % (
+            pythonCode = 'VFN(%s, %s)%s' % (
                 pythonCode,
-                name,
-                defaultUseAC and useAC,
-                useDottedNotation,
+                self.addCompiledName(name, defaultUseAC and useAC, useDottedNotation),
                 remainder,
             )
 
@@ -171,6 +340,9 @@ class GenUtils(object):
 
 
 class MethodCompiler(GenUtils):
+    # locals assigned by _addAutoSetupCode
+    _autoSetupLocals = frozenset(('_trans', 'write', 'SL', '_filter'))
+
     def __init__(
             self,
             methodName,
@@ -194,6 +366,32 @@ class MethodCompiler(GenUtils):
         self._isGenerator = False
         self._argStringList = [('self', None)]
         self._decorators = decorators or []
+        self._searchListLookups = []
+        self._globalSetNames = set()
+        # #set global name -> the indentation level it was set at, while it
+        # is certainly set (like _localNames), and the constNames of the
+        # search list lookups at points where their name is
+        self._certainGlobalSetNames = {}
+        self._certainGlobalSetLookups = set()
+        self._readsGlobalSetVars = False
+        # (header chunk index, indentation level of the body) of the #for and
+        # #while loops being compiled, and (header chunk index, end chunk
+        # index) of the finished ones
+        self._openLoops = []
+        self._loops = []
+        self._hoistedCount = 0
+        self._prefetchChunk = None
+        self._commonLookupChunks = []
+        # (chunk index, indentation, whenFull) of the points at which the
+        # streaming main method yields its output
+        self._flushPoints = []
+        self._isStreaming = False
+        self._isAsync = False
+        # local name -> the indentation level it was bound at.  Names only
+        # stay here while they are certainly bound: leaving the block that
+        # bound one drops it.
+        self._localNames = dict.fromkeys(self._autoSetupLocals - {'_trans'}, 0)
+        self._localNames['self'] = 0
 
     def setting(self, key):
         return self._settingsManager.setting(key)
@@ -211,9 +409,31 @@ class MethodCompiler(GenUtils):
         if not has_double_star_arg:
             self.addMethArg('**KWS', None)
 
+        self._isStreaming = (
+            self.setting('streamingRespond') and
+            self._methodName == self._classCompiler.mainMethodName()
+        )
+        if self._isStreaming and (self._isGenerator or self._hasReturnStatement):
+            raise AssertionError(
+                'The main method of a streaming template cannot #return or #yield'
+            )
+        self._isAsync = self.setting('asyncRespond')
+        if self._isStreaming and self._isAsync:
+            raise AssertionError('asyncRespond templates cannot use streamingRespond')
+
+    def finishBody(self, classNames, globalNames, globalSetNames):
+        """Called by the containing class compiler instance once all of its
+        methods are known, with the names of ClassCompiler.staticNames().
+        """
         self._indentLev = 2
         mainBodyChunks = self._methodBodyChunks
         self._methodBodyChunks = []
+        self._resolveNamesStatically(mainBodyChunks, classNames, globalNames, globalSetNames)
+        self._prefetchSearchListNames(mainBodyChunks)
+        self._eliminateCommonLookups(mainBodyChunks, globalSetNames)
+        self._hoistLoopInvariantLookups(mainBodyChunks, globalSetNames)
+        if self._isStreaming:
+            self._addFlushPoints(mainBodyChunks)
         self._addAutoSetupCode()
         self._methodBodyChunks.extend(mainBodyChunks)
         self._addAutoCleanupCode()
@@ -221,6 +441,25 @@ class MethodCompiler(GenUtils):
     def methodName(self):
         return self._methodName
 
+    def _defName(self):
+        if self._isStreaming:
+            return self._methodName + '_iter'
+        elif self._isAsync and self._methodName == 'respond':
+            return 'arespond'
+        else:
+            return self._methodName
+
+    def definedNames(self):
+        """The names of the methods the generated code defines."""
+        if self._isStreaming:
+            return {self._methodName, self._defName()}
+        else:
+            return {self._defName()}
+
+    def globalSetNames(self):
+        """The names the method does a #set global of."""
+        return self._globalSetNames
+
     def setMethodName(self, name):
         self._methodName = name
 
@@ -236,16 +475,51 @@ class MethodCompiler(GenUtils):
         if not self._indentLev:
             raise AssertionError('Attempt to dedent when the indentLev is 0')
         self._indentLev -= 1
+        for names in (self._localNames, self._certainGlobalSetNames):
+            for name, indentLev in tuple(names.items()):
+                if indentLev > self._indentLev:
+                    del names[name]
+        while self._openLoops and self._openLoops[-1][1] > self._indentLev:
+            start, _ = self._openLoops.pop()
+            self._loops.append((start, len(self._methodBodyChunks)))
+
+    # methods for tracking local variables
+
+    def isLocalName(self, name):
+        """Whether name is a local variable which is certainly bound at this
+        point of the method.
+        """
+        return name in self._localNames
+
+    def bindLocalNames(self, names):
+        for name in names:
+            self._localNames.setdefault(name, self._indentLev)
 
     # methods for final code wrapping
 
     def methodDef(self):
         self.commitStrConst()
-        return ''.join((
+        methodDef = ''.join((
             self.methodSignature(),
             '\n',
             self.methodBody(),
         ))
+        if self._isStreaming:
+            methodDef = self._streamingWrapperDef() + '\n\n' + methodDef
+        return methodDef
+
+    def _streamingWrapperDef(self):
+        """The main method of a streaming template, which joins the output
+        of its generator.
+        """
+        ind = self._indent
+        return '\n'.join((
+            '{0}def {1}(self, **KWS):'.format(ind, self._methodName),
+            '{0}## CHEETAH: joins the output of {1}_iter()'.format(ind * 2, self._methodName),
+            '{0}_nested = self._CHEETAH__write is not None'.format(ind * 2),
+            "{0}_output = ''.join(self.{1}_iter(**KWS))".format(ind * 2, self._methodName),
+            '{0}return NO_CONTENT if _nested else _output'.format(ind * 2),
+        ))
 
     def methodBody(self):
         return ''.join(self._methodBodyChunks)
@@ -270,7 +544,10 @@ class MethodCompiler(GenUtils):
         else:
             self.addChunk('_v = %s' % chunk)
 
-        self.addChunk('if _v is not NO_CONTENT: write(_filter(_v))')
+        if self.setting('asyncRespond'):
+            self.addChunk('write_value(_v, _filter)')
+        else:
+            self.addChunk('if _v is not NO_CONTENT: write(_filter(_v))')
 
     def addStrConst(self, strConst):
         self._pendingStrConstChunks.append(strConst)
@@ -335,11 +612,16 @@ class MethodCompiler(GenUtils):
             else:
                 primary = components.lvalue
                 secondary = ''
+            self._globalSetNames.add(primary)
+            if not secondary:
+                self._certainGlobalSetNames.setdefault(primary, self._indentLev)
             expr = 'self._CHEETAH__globalSetVars["{0}"]{1} {2} {3}'.format(
                 primary, secondary, components.op, components.rvalue,
             )
 
         self.addChunk(expr)
+        if setStyle is not SET_GLOBAL:
+            self.bindLocalNames(_assigned_names(expr))
 
     def addIndentingDirective(self, expr, lineCol):
         assert expr[-1] != ':'
@@ -348,9 +630,22 @@ class MethodCompiler(GenUtils):
         self.appendToPrevChunk(' # generated from line %s, col %s' % lineCol)
         self.indent()
 
-    addWhile = addIndentingDirective
-    addFor = addIndentingDirective
-    addWith = addIndentingDirective
+    def addBindingDirective(self, expr, lineCol):
+        self.addIndentingDirective(expr, lineCol)
+        self.bindLocalNames(_assigned_names(expr + ': pass'))
+
+    def _addLoop(self, addDirective, expr, lineCol):
+        self.commitStrConst()
+        self._openLoops.append((len(self._methodBodyChunks), self._indentLev + 1))
+        addDirective(expr, lineCol)
+
+    def addWhile(self, expr, lineCol):
+        self._addLoop(self.addIndentingDirective, expr, lineCol)
+
+    def addFor(self, expr, lineCol):
+        self._addLoop(self.addBindingDirective, expr, lineCol)
+
+    addWith = addBindingDirective
     addIf = addIndentingDirective
     addTry = addIndentingDirective
 
@@ -366,7 +661,10 @@ class MethodCompiler(GenUtils):
         self.appendToPrevChunk(' # generated from line %s, col %s' % lineCol)
         self.indent()
 
-    addExcept = addReIndentingDirective
+    def addExcept(self, expr, dedent=True, lineCol=None):
+        self.addReIndentingDirective(expr, dedent=dedent, lineCol=lineCol)
+        self.bindLocalNames(_assigned_names('try: pass\n' + expr + ': pass'))
+
     addFinally = addReIndentingDirective
 
     def addElse(self, expr, dedent=True, lineCol=None):
@@ -385,9 +683,13 @@ class MethodCompiler(GenUtils):
         self._isGenerator = True
         self.addChunk(expr)
 
+    def addDel(self, expr):
+        self.addChunk(expr)
+        for name in _deleted_names(expr):
+            self._localNames.pop(name, None)
+
     addSilent = addChunk
     addPass = addChunk
-    addDel = addChunk
     addAssert = addChunk
     addRaise = addChunk
     addBreak = addChunk
@@ -395,6 +697,9 @@ class MethodCompiler(GenUtils):
 
     def addPSP(self, PSP):
         self.commitStrConst()
+        if re.search(r'\bdel\b', PSP):
+            # don't try to follow what arbitrary code deletes
+            self._localNames.clear()
 
         for line in PSP.splitlines():
             self.addChunk(line)
@@ -417,13 +722,17 @@ class MethodCompiler(GenUtils):
                 col=lineCol[1],
             )
         )
-        self.addChunk('_orig_trans{0} = trans'.format(call_id))
-        self.addChunk(
-            'self.transaction = trans = _call{0} = DummyTransaction()'.format(
-                call_id
+        self.addChunk('_orig_trans{0} = self.transaction'.format(call_id))
+        if self.setting('asyncRespond'):
+            self.addChunk(
+                'self.transaction = _call{0} = AsyncTransaction(self)'.format(call_id)
             )
-        )
-        self.addChunk('write = trans.response().write')
+            self.addChunk('write_value = _call{0}.write_value'.format(call_id))
+        else:
+            self.addChunk(
+                'self.transaction = _call{0} = DummyTransaction()'.format(call_id)
+            )
+        self.addChunk('write = self._CHEETAH__write')
 
     def endCallRegion(self):
         call_details = self._callRegionsStack.pop()
@@ -434,13 +743,16 @@ class MethodCompiler(GenUtils):
             call_details.lineCol,
         )
 
-        self.addChunk(
-            'self.transaction = trans = _orig_trans{0}'.format(call_id),
-        )
-        self.addChunk('write = trans.response().write')
+        self.addChunk('self.transaction = _orig_trans{0}'.format(call_id))
+        self.addChunk('write = self._CHEETAH__write')
+        if self.setting('asyncRespond'):
+            self.addChunk('write_value = _orig_trans{0}.write_value'.format(call_id))
         self.addChunk('del _orig_trans{0}'.format(call_id))
 
-        self.addChunk('_call_arg{0} = _call{0}.response().getvalue()'.format(call_id))
+        if self.setting('asyncRespond'):
+            self.addChunk('_call_arg{0} = await _call{0}.finish()'.format(call_id))
+        else:
+            self.addChunk('_call_arg{0} = _call{0}.response().getvalue()'.format(call_id))
         self.addChunk('del _call{0}'.format(call_id))
 
         args = (', ' + args).strip()
@@ -488,19 +800,38 @@ class MethodCompiler(GenUtils):
     def _addAutoSetupCode(self):
         self.addChunk(self._initialMethodComment)
 
-        self.addChunk('trans = self.transaction')
-        self.addChunk('if not trans:')
-        self.indent()
-        self.addChunk('self.transaction = trans = DummyTransaction()')
-        self.addChunk('_dummyTrans = True')
-        self.dedent()
-        self.addChunk('else:')
-        self.indent()
-        self.addChunk('_dummyTrans = False')
-        self.dedent()
-        self.addChunk('write = trans.response().write')
+        if self._isAsync:
+            # Async methods always have a transaction of their own: they
+            # run after the method which called them got to its end.
+            self.addChunk('self.transaction = _trans = AsyncTransaction(self)')
+            self.addChunk('write = self._CHEETAH__write')
+            self.addChunk('write_value = _trans.write_value')
+        else:
+            # A method called while another one is rendering writes to its
+            # output; only the outermost one has a transaction of its own.
+            self.addChunk('write = self._CHEETAH__write')
+            self.addChunk('if write is None:')
+            self.indent()
+            if self._isStreaming:
+                self.addChunk('_trans = DummyTransaction()')
+                self.addChunk('_out = _trans.response(StreamingResponse())')
+                self.addChunk('self.transaction = _trans')
+            else:
+                self.addChunk('self.transaction = _trans = DummyTransaction()')
+            self.addChunk('write = self._CHEETAH__write')
+            self.dedent()
+            self.addChunk('else:')
+            self.indent()
+            self.addChunk('_trans = _out = None' if self._isStreaming else '_trans = None')
+            self.dedent()
         if self.setting('useNameMapper'):
             self.addChunk('SL = self._CHEETAH__searchList')
+        if self._readsGlobalSetVars:
+            self.addChunk('_globalSetVars = self._CHEETAH__globalSetVars')
+        if self._prefetchChunk:
+            self.addChunk(self._prefetchChunk)
+        for chunk in self._commonLookupChunks:
+            self.addChunk(chunk)
         self.addChunk('_filter = self._CHEETAH__currentFilter')
         self.addChunk('')
         self.addChunk("#" * 40)
@@ -513,36 +844,322 @@ class MethodCompiler(GenUtils):
         self.addChunk('## END - generated method body')
         self.addChunk('')
 
-        if not self._isGenerator:
-            self.addChunk('if _dummyTrans:')
+        if self._isStreaming:
+            self.addChunk('if _out is not None:')
             self.indent()
             self.addChunk('self.transaction = None')
-            self.addChunk('return trans.response().getvalue()')
+            self.addChunk('_v = _out.flush()')
+            self.addChunk('if _v:')
+            self.indent()
+            self.addChunk('yield _v')
             self.dedent()
-            self.addChunk('else:')
+            self.dedent()
+        elif self._isAsync:
+            if not self._isGenerator:
+                self.addChunk('self.transaction = None')
+                self.addChunk('return await _trans.finish()')
+        elif not self._isGenerator:
+            self.addChunk('if _trans is None:')
             self.indent()
             self.addChunk('return NO_CONTENT')
             self.dedent()
+            self.addChunk('self.transaction = None')
+            self.addChunk('return _trans.response().getvalue()')
         self.addChunk('')
 
+    def addFlush(self):
+        self.addChunk('pass')
+        self.addFlushPoint()
+
+    def addFlushPoint(self, whenFull=False):
+        """Marks the current point of the method as one where the streaming
+        main method yields the output so far (whenFull: only once there are
+        streamingChunkSize characters of it).
+        """
+        self.commitStrConst()
+        self._flushPoints.append((len(self._methodBodyChunks), self.indentation(), whenFull))
+
+    def _addFlushPoints(self, bodyChunks):
+        for index, indentation, whenFull in reversed(self._flushPoints):
+            minSize = self.setting('streamingChunkSize') if whenFull else 1
+            lines = (
+                'if _out is not None and _out.size() >= {0}:'.format(minSize),
+                self._indent + 'self.transaction = None',
+                self._indent + 'yield _out.flush()',
+                self._indent + 'self.transaction = _trans',
+            )
+            bodyChunks.insert(index, ''.join('\n' + indentation + line for line in lines))
+
+    def addSearchListLookup(self, constName, name, useAC, useDottedNotation):
+        """Records the VFFSL(SL, constName) call site of a placeholder."""
+        self._searchListLookups.append((constName, name, useAC, useDottedNotation))
+        if name.partition('.')[0] in self._certainGlobalSetNames:
+            self._certainGlobalSetLookups.add(constName)
+
+    def localNames(self, bodyChunks):
+        """Returns the names which are local variables of the generated
+        method, or None if they can't be determined.
+        """
+        source = 'def _({0}):{1}\n{2}pass\n'.format(
+            self.methodArgString(), ''.join(bodyChunks), self.indentation(),
+        )
+        names = _bound_names(source)
+        if names is not None:
+            names.update(self._autoSetupLocals)
+        return names
+
+    def _resolveNamesStatically(self, bodyChunks, classNames, globalNames, globalSetNames):
+        """Replaces the method's VFFSL call sites of names of the class by
+        lookups on self, those of names of globals by plain loads of the
+        global, and those of names the class does a #set global of by a look
+        in the dict of #set global variables first.  Only the frame locals
+        and the #set global variables come before self in the search, so
+        names that are local variables somewhere in the method are left
+        alone, and names of the class or of globals are still searched for
+        when the dict of #set global variables has them.  Autocalled globals
+        and #set global variables are left alone too.
+        """
+        if not (classNames or globalNames or globalSetNames) or not self._searchListLookups:
+            return
+        localNames = self.localNames(bodyChunks)
+        if localNames is None:
+            return
+
+        searchListLookups = []
+        for lookup in self._searchListLookups:
+            constName, name, useAC, useDottedNotation = lookup
+            first, _, rest = name.partition('.')
+            if first in localNames:
+                searchListLookups.append(lookup)
+                continue
+            elif first in globalSetNames and not useAC:
+                self._readsGlobalSetVars = True
+                if constName in self._certainGlobalSetLookups:
+                    code = '_globalSetVars["{0}"]'.format(first)
+                else:
+                    code = '(_globalSetVars["{0}"] if "{0}" in _globalSetVars else VFFSL(SL, {1}))'.format(
+                        first, constName,
+                    )
+            elif first in classNames:
+                if useAC:
+                    code = 'VFN(self, {0})'.format(constName)
+                else:
+                    code = 'self.' + first
+            elif first in globalNames and not useAC:
+                code = first
+            else:
+                searchListLookups.append(lookup)
+                continue
+            if rest and not useAC:
+                code = 'VFN({0}, {1})'.format(
+                    code,
+                    self._moduleCompiler.addCompiledName(rest, False, useDottedNotation),
+                )
+            if first not in globalSetNames:
+                # Partial templates and other templates calling the method
+                # can still #set global the name in self's variables
+                self._readsGlobalSetVars = True
+                code = '(VFFSL(SL, {0}) if "{1}" in _globalSetVars else {2})'.format(
+                    constName, first, code,
+                )
+            call = 'VFFSL(SL, {0})'.format(constName)
+            for i, chunk in enumerate(bodyChunks):
+                if call in chunk:
+                    bodyChunks[i] = chunk.replace(call, code)
+        self._searchListLookups = searchListLookups
+
+    def _reuseFirstName(self, bodyChunks, lookup, var):
+        """Replaces the VFFSL call site of lookup by one using var, the value
+        of the first part of its name looked up earlier, when it was found.
+        The rest of the name is still looked up at the call site.
+        """
+        constName, name, useAC, useDottedNotation = lookup
+        call = 'VFFSL(SL, {0})'.format(constName)
+        rest = name.partition('.')[2]
+        for i, chunk in enumerate(bodyChunks):
+            if call in chunk:
+                value = var
+                if rest:
+                    value = 'VFN({0}, {1})'.format(
+                        var, self._moduleCompiler.addCompiledName(rest, useAC, useDottedNotation),
+                    )
+                bodyChunks[i] = chunk.replace(
+                    call, '({0} if {1} is not NotFound else {2})'.format(value, var, call),
+                )
+
+    def _prefetchSearchListNames(self, bodyChunks):
+        """Looks up the first part of the names of the method's VFFSL call
+        sites in a single VFFSLS call in the preamble.  Each call site looks
+        up the rest of its name on the prefetched value and falls back to
+        VFFSL if the first part couldn't be found at that time.
+
+        Autocalled names and names that are local variables somewhere in the
+        method are left alone, as are methods doing a #set global.
+        """
+        if (
+                not self.setting('prefetchSearchListNames') or
+                not self._searchListLookups or
+                self._globalSetNames
+        ):
+            return
+        localNames = self.localNames(bodyChunks)
+        if localNames is None:
+            return
+
+        # first name -> (variable, constName)
+        prefetched = collections.OrderedDict()
+        searchListLookups = []
+        for lookup in self._searchListLookups:
+            constName, name, useAC, useDottedNotation = lookup
+            first = name.partition('.')[0]
+            call = 'VFFSL(SL, {0})'.format(constName)
+            if useAC or first in localNames or not any(call in chunk for chunk in bodyChunks):
+                searchListLookups.append(lookup)
+                continue
+            if first not in prefetched:
+                prefetched[first] = (
+                    '_p{0}'.format(len(prefetched) + 1),
+                    self._moduleCompiler.addCompiledName(first, False, useDottedNotation),
+                )
+            self._reuseFirstName(bodyChunks, lookup, prefetched[first][0])
+        self._searchListLookups = searchListLookups
+
+        if prefetched:
+            variables, constNames = zip(*prefetched.values())
+            self._prefetchChunk = '{0}, = VFFSLS(SL, ({1},), default=NotFound)'.format(
+                ', '.join(variables), ', '.join(constNames),
+            )
+
+    def _eliminateCommonLookups(self, bodyChunks, globalSetNames):
+        """Looks up the first names which the method has more than one VFFSL
+        call site of once, in the preamble.  Each of those call sites looks
+        up the rest of its name on that value and falls back to VFFSL if the
+        first name couldn't be found at that time.
+
+        Names that are local variables somewhere in the method or #set global
+        variables are left alone, and so are autocalled names that aren't in
+        the pureNames setting.
+        """
+        if not self.setting('eliminateCommonLookups') or not self._searchListLookups:
+            return
+        localNames = self.localNames(bodyChunks)
+        if localNames is None:
+            return
+        pureNames = self.setting('pureNames')
+
+        def key(lookup):
+            constName, name, useAC, useDottedNotation = lookup
+            first = name.partition('.')[0]
+            if (
+                    (useAC and first not in pureNames) or
+                    first in localNames or
+                    first in globalSetNames or
+                    not any('VFFSL(SL, {0})'.format(constName) in chunk for chunk in bodyChunks)
+            ):
+                return None
+            return (first, useAC)
+
+        keys = [key(lookup) for lookup in self._searchListLookups]
+        counts = collections.Counter(keys)
+        # (first name, useAC) -> variable
+        common = collections.OrderedDict()
+        searchListLookups = []
+        for lookup, lookupKey in zip(self._searchListLookups, keys):
+            if lookupKey is None or counts[lookupKey] < 2:
+                searchListLookups.append(lookup)
+                continue
+            if lookupKey not in common:
+                first, useAC = lookupKey
+                common[lookupKey] = '_c{0}'.format(len(common) + 1)
+                self._commonLookupChunks.append('{0} = VFFSL(SL, {1}, default=NotFound)'.format(
+                    common[lookupKey], self._moduleCompiler.addCompiledName(first, useAC, lookup[3]),
+                ))
+            self._reuseFirstName(bodyChunks, lookup, common[lookupKey])
+        self._searchListLookups = searchListLookups
+
+    def _hoistLoopInvariantLookups(self, bodyChunks, globalSetNames):
+        """Looks up the first part of the names of the VFFSL call sites in
+        #for and #while loops once, before the outermost loop they're in.
+        Each call site looks up the rest of its name on the hoisted value and
+        falls back to VFFSL if the first part couldn't be found at that time.
+
+        Names that are local variables somewhere in the method or #set global
+        variables are left alone, and so are autocalled names that aren't in
+        the pureNames setting.
+        """
+        if (
+                not self.setting('hoistLoopInvariantLookups') or
+                not self._loops or
+                not self._searchListLookups
+        ):
+            return
+        localNames = self.localNames(bodyChunks)
+        if localNames is None:
+            return
+        pureNames = self.setting('pureNames')
+
+        # loop start index -> {(first name, useAC): (variable, constName)}
+        hoisted = collections.defaultdict(collections.OrderedDict)
+        searchListLookups = []
+        for lookup in self._searchListLookups:
+            constName, name, useAC, useDottedNotation = lookup
+            first = name.partition('.')[0]
+            # call sites outside of loops keep searching
+            searchListLookups.append(lookup)
+            if (
+                    (useAC and first not in pureNames) or
+                    first in localNames or
+                    first in globalSetNames
+            ):
+                continue
+            call = 'VFFSL(SL, {0})'.format(constName)
+            for i, chunk in enumerate(bodyChunks):
+                # the outermost loop whose body has the call site
+                starts = [start for start, end in self._loops if start < i < end]
+                if call not in chunk or not starts:
+                    continue
+                variables = hoisted[min(starts)]
+                key = (first, useAC)
+                if key not in variables:
+                    self._hoistedCount += 1
+                    variables[key] = (
+                        '_h{0}'.format(self._hoistedCount),
+                        self._moduleCompiler.addCompiledName(first, useAC, useDottedNotation),
+                    )
+                self._reuseFirstName(bodyChunks, lookup, variables[key][0])
+        self._searchListLookups = searchListLookups
+
+        for start, variables in hoisted.items():
+            header = bodyChunks[start]
+            # the line break and indentation the header starts with
+            lineStart = header[:len(header) - len(header.lstrip('\n \t'))]
+            bodyChunks[start] = ''.join(
+                '{0}{1} = VFFSL(SL, {2}, default=NotFound)'.format(lineStart, variable, constName)
+                for variable, constName in variables.values()
+            ) + header
+
     def addMethArg(self, name, defVal=None):
         self._argStringList.append((name, defVal))
+        self._localNames.setdefault(name.lstrip('*').strip(), 0)
 
-    def methodSignature(self):
+    def methodArgString(self):
         argStringChunks = []
         for arg in self._argStringList:
             chunk = arg[0]
             if arg[1] is not None:
                 chunk += '=' + arg[1]
             argStringChunks.append(chunk)
-        argString = (', ').join(argStringChunks)
+        return (', ').join(argStringChunks)
+
+    def methodSignature(self):
+        argString = self.methodArgString()
 
         output = []
         if self._decorators:
             output.append(''.join([self._indent + decorator + '\n'
                                    for decorator in self._decorators]))
-        output.append(self._indent + "def "
-                      + self.methodName() + "(" +
+        output.append(self._indent + ("async def " if self._isAsync else "def ")
+                      + self._defName() + "(" +
                       argString + "):\n\n")
         return ''.join(output)
 
@@ -567,6 +1184,7 @@ class ClassCompiler(GenUtils):
         self._finishedMethodsList = []      # store by order
         self._methodsIndex = {}      # store by name
         self._baseClass = 'Template'
+        self._baseModule = None
         # printed after methods in the gen class def:
         self._generatedAttribs = []
         methodCompiler = self._spawnMethodCompiler(
@@ -589,12 +1207,59 @@ class ClassCompiler(GenUtils):
         while self._activeMethodsList:
             methCompiler = self._popActiveMethodCompiler()
             self._swallowMethodCompiler(methCompiler)
+        classNames, globalNames, globalSetNames = self.staticNames()
+        for methCompiler in self._finishedMethodsList:
+            methCompiler.finishBody(classNames, globalNames, globalSetNames)
+
+    def staticNames(self):
+        """Returns the names placeholders look up without searching for them,
+        as three sets:
+
+        - names of the class, looked up on self: the methods and #attrs of
+          the class.
+        - names of globals, loaded directly if the loadGlobalsDirectly
+          setting is on: #import'ed names and builtins that self doesn't
+          have.
+        - names any method does a #set global of, which are in neither of
+          the others.  They're looked up in the #set global variables first.
+
+        Templates with an #extends have no names of the class or of globals:
+        their methods may be called with a self which isn't an instance of
+        the class (partial templates call them with the calling template),
+        and the names of the base class aren't known without importing it.
+        """
+        ownNames = set()
+        for attrib in self._generatedAttribs:
+            ownNames.update(_assigned_names(five.text(attrib)))
+        globalSetNames = set()
+        for methCompiler in self._finishedMethodsList:
+            ownNames.update(methCompiler.definedNames())
+            globalSetNames.update(methCompiler.globalSetNames())
+
+        if self._baseModule is not None:
+            classNames = globalNames = set()
+        else:
+            classNames = ownNames
+            if self.setting('loadGlobalsDirectly'):
+                # import a.b binds a
+                importedNames = set(
+                    name.split('.')[0]
+                    for name in self._moduleCompiler.importedVarNames()
+                )
+                globalNames = (importedNames | _BUILTIN_NAMES) - set(dir(Template)) - ownNames
+            else:
+                globalNames = set()
+        return classNames - globalSetNames, globalNames - globalSetNames, globalSetNames
 
     def className(self):
         return self._className
 
-    def setBaseClass(self, baseClassName):
+    def mainMethodName(self):
+        return self._mainMethodName
+
+    def setBaseClass(self, baseClassName, moduleName=None):
         self._baseClass = baseClassName
+        self._baseModule = moduleName
 
     def setMainMethodName(self, methodName):
         if methodName == self._mainMethodName:
@@ -684,7 +1349,12 @@ class ClassCompiler(GenUtils):
         self._swallowMethodCompiler(methCompiler)
 
         # insert the code to call the block
-        self.addChunk('self.{0}()'.format(methodName))
+        self.addFlushPoint()
+        if self.setting('asyncRespond'):
+            self.addChunk('write_value(self.{0}(), _filter)'.format(methodName))
+        else:
+            self.addChunk('self.{0}()'.format(methodName))
+        self.addFlushPoint()
 
     # code wrapping methods
 
@@ -752,14 +1422,18 @@ class LegacyCompiler(SettingsManager, GenUtils):
         self._importStatements = [
             'from Cheetah.DummyTransaction import DummyTransaction',
             'from Cheetah.NameMapper import NotFound',
+            'from Cheetah.NameMapper import compile_name',
             'from Cheetah.NameMapper import valueForName as VFN',
             'from Cheetah.NameMapper import valueFromSearchList as VFSL',
             'from Cheetah.NameMapper import valueFromFrameOrSearchList as VFFSL',
+            'from Cheetah.NameMapper import valuesFromFrameOrSearchList as VFFSLS',
             'from Cheetah.Template import NO_CONTENT',
             'from Cheetah.Template import Template',
         ]
 
         self._moduleConstants = []
+        self._compiledNameCount = 0
+        self._nameMapperVarCount = 0
 
         self._importedVarNames = [
             'DummyTransaction',
@@ -830,8 +1504,8 @@ class LegacyCompiler(SettingsManager, GenUtils):
         #   with their dots and namespaces.
         chunks = baseClassName.split('.')
         if len(chunks) == 1:
-            self._getActiveClassCompiler().setBaseClass(baseClassName)
             modName = baseClassName
+            self._getActiveClassCompiler().setBaseClass(baseClassName, modName)
             # we assume the class name to be the module name
             # and that it's not a builtin:
             importStatement = 'from {0} import {1}'.format(
@@ -845,7 +1519,7 @@ class LegacyCompiler(SettingsManager, GenUtils):
             if finalClassName != chunks[-2]:
                 # we assume the class name to be the module name
                 modName = '.'.join(chunks)
-            self._getActiveClassCompiler().setBaseClass(finalClassName)
+            self._getActiveClassCompiler().setBaseClass(finalClassName, modName)
             importStatement = "from %s import %s" % (modName, finalClassName)
             self.addImportStatement(importStatement)
             self.addImportedVarNames([finalClassName])
@@ -870,6 +1544,22 @@ class LegacyCompiler(SettingsManager, GenUtils):
     def addAttribute(self, attribName, expr):
         self._getActiveClassCompiler().addAttribute(attribName + ' =' + expr)
 
+    def nameMapperVarCount(self):
+        """The number of $vars compiled using NameMapper so far."""
+        return self._nameMapperVarCount
+
+    def addCompiledName(self, name, useAC, useDottedNotation):
+        """Adds a module level NameMapper.compile_name() constant for a single
+        call site and returns its name.
+        """
+        self._compiledNameCount += 1
+        constName = '_n{0}'.format(self._compiledNameCount)
+        self._moduleConstants.append('{0} = compile_name("{1}", {2}, {3}{4})'.format(
+            constName, name, useAC, useDottedNotation,
+            ', lookupMode="dict"' if self.setting('lookupMode') == 'dict' else '',
+        ))
+        return constName
+
     def addComment(self, comm):
         for line in comm.splitlines():
             self.addMethComment(line)
@@ -881,6 +1571,14 @@ class LegacyCompiler(SettingsManager, GenUtils):
         self._addActiveClassCompiler(classCompiler)
         self._parser.parse()
         self._swallowClassCompiler(self._popActiveClassCompiler())
+        if self.setting('streamingRespond'):
+            self._importStatements.insert(
+                1, 'from Cheetah.DummyTransaction import StreamingResponse',
+            )
+        if self.setting('asyncRespond'):
+            self._importStatements.insert(
+                0, 'from Cheetah.async_transaction import AsyncTransaction',
+            )
 
         futures = ''
         if self.setting('future_unicode_literals'):
@@ -95,6 +95,7 @@ directiveNamesAndParsers = {
 
     # output, filtering, and caching
     'slurp': 'eatSlurp',
+    'flush': 'eatFlush',
     'filter': 'eatFilter',
     'silent': None,
 
@@ -831,8 +832,9 @@ class _LowLevelParser(SourceReader):
         Raises a ParseError with `failure_msg` on failure.
         """
         expr_pos = self.pos()
+        nameMapperVars = self._compiler.nameMapperVarCount()
         expr = self.getExpression(**kwargs)
-        if 'VFN(' in expr or 'VFFSL(' in expr:
+        if self._compiler.nameMapperVarCount() != nameMapperVars:
             self.setPos(expr_pos)
             raise ParseError(self, failure_msg)
         return expr
@@ -1180,7 +1182,7 @@ class LegacyParser(_LowLevelParser):
         pos = self.pos()
         directiveName = False
         for key in self._endDirectiveNamesAndHandlers.keys():
-            if self.find(key, pos) == pos:
+            if self.startswith(key, pos):
                 directiveName = key
                 break
         if not directiveName:
@@ -1205,6 +1207,8 @@ class LegacyParser(_LowLevelParser):
             self._compiler.closeFilterBlock()
         else:
             assert directiveName in ['while', 'for', 'if', 'try', 'with']
+            if directiveName in ('while', 'for'):
+                self._compiler.addFlushPoint(whenFull=True)
             self._compiler.commitStrConst()
             self._compiler.dedent()
 
@@ -1445,6 +1449,14 @@ class LegacyParser(_LowLevelParser):
         self._compiler.commitStrConst()
         self.readToEOL(gobble=True)
 
+    def eatFlush(self):
+        isLineClearToStartToken = self.isLineClearToStartToken()
+        endOfFirstLinePos = self.findEOL()
+        self.getDirectiveStartToken()
+        self.advance(len('flush'))
+        self._eatRestOfDirectiveTag(isLineClearToStartToken, endOfFirstLinePos)
+        self._compiler.addFlush()
+
     def eatMacroCall(self):
         isLineClearToStartToken = self.isLineClearToStartToken()
         endOfFirstLinePos = self.findEOL()
@@ -1478,20 +1490,11 @@ class LegacyParser(_LowLevelParser):
         kwArgs['src'] = srcBlock
         srcFromMacroOutput = macro(*positionalArgs, **kwArgs)
 
-        origParseSrc = self._src
-        origBreakPoint = self.breakPoint()
-        origPos = self.pos()
         # add a comment to the output about the macro src that is being parsed
         # or add a comment prefix to all the comments added by the compiler
-        self._src = srcFromMacroOutput
-        self.setPos(0)
-        self.setBreakPoint(len(srcFromMacroOutput))
-
+        self.pushSrc(srcFromMacroOutput)
         self.parse(assertEmptyStack=False)
-
-        self._src = origParseSrc
-        self.setBreakPoint(origBreakPoint)
-        self.setPos(origPos)
+        self.popSrc()
 
     def eatCall(self):
         isLineClearToStartToken = self.isLineClearToStartToken()
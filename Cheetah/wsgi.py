@@ -0,0 +1,23 @@
+"""Serving templates from WSGI applications."""
+from __future__ import unicode_literals
+
+
+def wsgi_response(
+        template,
+        start_response,
+        status='200 OK',
+        headers=(('Content-Type', 'text/html; charset=UTF-8'),),
+        encoding='UTF-8',
+):
+    """Starts the response and returns an iterable of the encoded output of
+    the template, for returning from a WSGI application.
+
+    Templates compiled with the streamingRespond setting are rendered while
+    the server sends their output, a chunk at a time.  Other templates are
+    rendered up front.
+    """
+    start_response(status, list(headers))
+    if hasattr(template, 'respond_iter'):
+        return (chunk.encode(encoding) for chunk in template.respond_iter())
+    else:
+        return [template.respond().encode(encoding)]
@@ -1,21 +1,37 @@
+import platform
+
 from setuptools import find_packages, setup, Extension
 
+from Cheetah import __version__
+
+
+# The NameMapper extension needs CPython, PyPy uses the pure python NameMapper.
+if platform.python_implementation() == 'CPython':
+    ext_modules = [Extension("Cheetah._namemapper", ["Cheetah/c/_namemapper.c"])]
+else:
+    ext_modules = []
 
 setup(
     name="yelp_cheetah",
-    version='0.3.3',
+    version=__version__,
     description='cheetah, hacked by yelpers',
     classifiers=[
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python',
         'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.6',
         'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
+        'Programming Language :: Python :: 3.13',
         'Programming Language :: Python :: Implementation :: CPython',
+        'Programming Language :: Python :: Implementation :: PyPy',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
         'Topic :: Internet :: WWW/HTTP :: Site Management',
@@ -29,10 +45,9 @@ setup(
     url="http://github.com/bukzor/yelp_cheetah",
     license='MIT License',
     packages=find_packages(exclude=('tests*', 'testing*')),
-    ext_modules=[
-        Extension("Cheetah._namemapper", ["Cheetah/c/_namemapper.c"]),
-    ],
+    ext_modules=ext_modules,
     platforms=['linux'],
+    python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, !=3.4.*, !=3.5.*',
     install_requires=[
         'argparse',
         'markupsafe',
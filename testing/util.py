@@ -1,8 +1,33 @@
 import contextlib
 import subprocess
 import sys
+import types
+
+import pytest
 
 from Cheetah import five
+from Cheetah import NameMapper
+
+
+# Inline caches only hit, and SearchLists only remember names, with the
+# extension (not with the pure python NameMapper used on PyPy) where dicts have
+# version tags (python 3.6 - 3.13)
+requires_extension = pytest.mark.skipif(
+    NameMapper._impl.__name__ != 'Cheetah._namemapper' or not (3, 6) <= sys.version_info < (3, 14),
+    reason='needs the _namemapper extension and dict versions',
+)
+
+
+def call_with_locals(local_vars, func, *args):
+    """Return func(*args), called from a frame with local_vars as its locals
+    and the globals of the caller.  Since python 3.13 names added with
+    locals().update() aren't seen by frame lookups.
+    """
+    names = sorted(local_vars)
+    namespace = {}
+    exec('def call({0}):\n    return _func(*_args)\n'.format(', '.join(names + ['_func', '_args'])), namespace)
+    call = types.FunctionType(namespace['call'].__code__, sys._getframe(1).f_globals)
+    return call(*[local_vars[name] for name in names] + [func, args])
 
 
 @contextlib.contextmanager
@@ -3,10 +3,23 @@ from __future__ import unicode_literals
 
 import io
 import os.path
+import sys
+import types
 
+import pytest
+
+from Cheetah import five
 from Cheetah.compile import compile_source
+from Cheetah.compile import compile_to_class
 from Cheetah.compile import _create_module_from_source
+from Cheetah.DummyTransaction import DummyTransaction
+from Cheetah.legacy_compiler import _assigned_names
+from Cheetah.legacy_compiler import _bound_names
+from Cheetah.legacy_compiler import _deleted_names
+from Cheetah.NameMapper import NotFound
+from Cheetah.Template import NO_CONTENT
 from Cheetah.cheetah_compile import compile_template
+from testing.util import requires_extension
 from testing.util import run_python
 
 
@@ -50,3 +63,568 @@ def test_unicode_literals_off():
     assert 'from __future__ import unicode_literals\n' not in tmpl_source
     # u because we're not unicode literals
     assert "write(u'''Hello World''')" in tmpl_source
+
+
+@requires_extension
+def test_compiled_name_per_call_site():
+    tmpl_source = compile_source('$foo $foo $bar.upper()')
+    assert tmpl_source.count(' = compile_name(') == 4
+    assert '_n1 = compile_name("foo", False, False)' in tmpl_source
+    assert '_n2 = compile_name("foo", False, False)' in tmpl_source
+    assert 'VFFSL(SL, _n1)' in tmpl_source
+    assert 'VFFSL(SL, _n2)' in tmpl_source
+    assert 'VFN(VFFSL(SL, _n3), _n4)()' in tmpl_source
+
+    module = _create_module_from_source(tmpl_source)
+    tmpl = module.DynamicallyCompiledTemplate(
+        searchList=[{'foo': 'a', 'bar': 'b'}],
+    )
+    assert tmpl.respond() == 'a a B'
+    assert tmpl.respond() == 'a a B'
+    assert module._n1.hits == 1
+
+
+def test_prefetch_search_list_names():
+    tmpl_source = compile_source(
+        '#def f(x)\n'
+        '$x $foo $foo.upper() $missing\n'
+        '#for i in range(2)\n'
+        '$i $foo\n'
+        '#end for\n'
+        '#end def\n'
+        '$f(1)',
+        settings={'prefetchSearchListNames': True},
+    )
+    assert '_p1, _p2, = VFFSLS(SL, (_n7, _n8,), default=NotFound)' in tmpl_source
+
+    module = _create_module_from_source(tmpl_source)
+    tmpl = module.DynamicallyCompiledTemplate(
+        searchList=[{'foo': 'a', 'missing': 'b'}],
+    )
+    assert tmpl.respond() == '1 a A b\n0 a\n1 a\n'
+
+
+class Cart(object):
+    def __init__(self):
+        self.total = 0
+
+    def add(self, amount):
+        self.total += amount
+
+
+def test_prefetch_looks_up_the_rest_of_names_at_the_call_site():
+    tmpl_source = compile_source(
+        '$cart.total\n#silent $cart.add(5)\n$cart.total $cart.total',
+        settings={'prefetchSearchListNames': True},
+    )
+    assert '_p1, = VFFSLS(SL, (_n6,), default=NotFound)' in tmpl_source
+    assert '_v = (VFN(_p1, _n7) if _p1 is not NotFound else VFFSL(SL, _n1)) #' in tmpl_source
+
+    module = _create_module_from_source(tmpl_source)
+    tmpl = module.DynamicallyCompiledTemplate(searchList=[{'cart': Cart()}])
+    assert tmpl.respond() == '0\n5 5'
+
+
+def test_prefetch_search_list_names_off_by_default():
+    assert 'VFFSLS(SL' not in compile_source('$foo $bar')
+
+
+def test_prefetch_skips_names_bound_in_the_method():
+    tmpl_source = compile_source(
+        '#if True\n#set y = 1\n#end if\n$y',
+        settings={'prefetchSearchListNames': True},
+    )
+    assert 'VFFSLS(SL' not in tmpl_source
+
+
+def test_prefetch_skips_methods_it_cannot_parse():
+    tmpl_source = compile_source(
+        '#def f()\n<% x = %>\n$foo\n#end def\n',
+        settings={'prefetchSearchListNames': True},
+    )
+    assert 'VFFSLS(SL' not in tmpl_source
+
+
+def test_bound_names():
+    assert _bound_names(
+        'def f(a, *args, **kwargs):\n'
+        '    import os.path\n'
+        '    from x import y as z\n'
+        '    global g\n'
+        '    b, (c, _) = d\n'
+        '    def h(): pass\n'
+        '    class C: pass\n'
+        '    try: pass\n'
+        '    except E as e: pass\n'
+    ) == {'a', 'args', 'kwargs', 'os', 'z', 'g', 'b', 'c', '_', 'h', 'C', 'e'}
+    assert _bound_names('def f(:') is None
+
+
+def test_assigned_and_deleted_names():
+    assert _assigned_names('a, (b, c) = d') == {'a', 'b', 'c'}
+    assert _assigned_names('print(1)') == set()
+    assert _assigned_names('x = )') == set()
+    assert _deleted_names('del x, y.z') == {'x'}
+    assert _deleted_names('del )') == set()
+
+
+@pytest.mark.skipif(five.PY2, reason='python 3 syntax')
+def test_assigned_names_python3_syntax():
+    assert _assigned_names('a, *b = c') == {'a', 'b'}
+    assert _assigned_names('x: int = 1') == {'x'}
+    assert _assigned_names('x: int') == set()
+
+
+def test_locals_are_loaded_directly():
+    tmpl_source = compile_source(
+        '#def f(arg, *args)\n'
+        '#for i, (j, k) in [(1, (2, 3))]\n'
+        '$arg $args $i $j $k\n'
+        '#end for\n'
+        '#set x = 1\n'
+        '#with open(__file__) as fp\n'
+        '$x $fp.name\n'
+        '#end with\n'
+        '#try\n'
+        '#raise ValueError\n'
+        '#except ValueError as e\n'
+        '$e.args\n'
+        '#end try\n'
+        '#end def\n',
+    )
+    assert 'VFFSL(' not in tmpl_source.partition('def f(')[2].partition('def respond(')[0]
+    assert '_v = arg #' in tmpl_source
+    assert '_v = VFN(fp, _n1) #' in tmpl_source
+
+
+def test_locals_not_certainly_bound_use_namemapper():
+    cls = compile_to_class(
+        '$x\n'
+        '#set x = 1\n'
+        '#if False\n'
+        '#set y = 2\n'
+        '#end if\n'
+        '#for z in []\n'
+        '#pass\n'
+        '#end for\n'
+        '#del x\n'
+        '$x $y $z\n',
+    )
+    assert cls([{'x': 'a', 'y': 'b', 'z': 'c'}]).respond() == 'a\na b c\n'
+
+
+def test_psp_del_forgets_locals():
+    cls = compile_to_class('#set x = 1\n<% del x %>$x')
+    assert cls([{'x': 2}]).respond() == '2'
+
+
+def test_class_names_are_looked_up_on_self():
+    tmpl_source = compile_source(
+        '#attr title = "T"\n'
+        '#for item in [1]\n'
+        '$render_row(item) $title.lower() $title.__class__.__name__ $row()\n'
+        '#end for\n'
+        '#def render_row(item)\n'
+        '<$item>\n'
+        '#end def\n'
+        '#block row\n'
+        'row\n'
+        '#end block\n',
+    )
+    assert '_v = (VFFSL(SL, _n1) if "render_row" in _globalSetVars else self.render_row)(item) #' in tmpl_source
+    assert '_v = VFN((VFFSL(SL, _n2) if "title" in _globalSetVars else self.title), _n3)() #' in tmpl_source
+    assert '_n6 = compile_name("__class__.__name__", False, False)' in tmpl_source
+    assert '_v = (VFFSL(SL, _n4) if "title" in _globalSetVars else VFN(self.title, _n6)) #' in tmpl_source
+    assert '_v = (VFFSL(SL, _n5) if "row" in _globalSetVars else self.row)() #' in tmpl_source
+
+    module = _create_module_from_source(tmpl_source)
+    tmpl = module.DynamicallyCompiledTemplate(searchList=[{'title': 'S'}])
+    assert tmpl.respond() == '<1>\n t {0} row\n\nrow\n'.format(type('').__name__)
+
+
+def test_class_names_of_subclasses_are_looked_up_with_namemapper():
+    # The methods of a subclass may be called with a self which isn't an
+    # instance of it, and the names of its base class aren't known
+    tmpl_source = compile_source(
+        '#extends testing.templates.extends_test_template\n'
+        '#implements respond\n'
+        '$f() $spacer() $len("")\n'
+        '#def f()\n'
+        'f\n'
+        '#end def\n'
+    )
+    assert '_v = VFFSL(SL, _n1)() #' in tmpl_source
+    assert '_v = VFFSL(SL, _n2)() #' in tmpl_source
+    assert '_v = VFFSL(SL, _n3)("") #' in tmpl_source
+
+    module = _create_module_from_source(tmpl_source)
+    assert module.DynamicallyCompiledTemplate().respond() == (
+        'f\n <img src="spacer.gif" width="1" height="1" alt="" /> 0\n'
+    )
+
+
+def _partial_module(monkeypatch, name, source):
+    tmpl_source = compile_source(
+        '#extends Cheetah.partial_template\n' + source, cls_name=name,
+    )
+    # partial templates put their functions in the module they are defined in
+    module = types.ModuleType(str(name))
+    monkeypatch.setitem(sys.modules, module.__name__, module)
+    exec(compile(tmpl_source, '<partial>', 'exec', dont_inherit=True), module.__dict__)
+    return module
+
+
+def test_partial_template_calling_its_own_functions(monkeypatch):
+    _partial_module(
+        monkeypatch, 'partial_calls_own_functions',
+        '#def wrap(text)\n'
+        '[$inner(text)]\n'
+        '#end def\n'
+        '#def inner(text)\n'
+        '<$text>#slurp\n'
+        '#end def\n',
+    )
+    cls = compile_to_class(
+        '#from partial_calls_own_functions import wrap\n'
+        "$wrap('hello')",
+    )
+    assert cls().respond() == '[<hello>]\n'
+
+
+def test_autocalled_class_names_are_looked_up_on_self():
+    tmpl_source = compile_source(
+        '#attr title = "t"\n'
+        '$title.upper $f\n'
+        '#def f()\n'
+        'f\n'
+        '#end def\n',
+        settings={'useAutocalling': True},
+    )
+    assert '_v = (VFFSL(SL, _n1) if "title" in _globalSetVars else VFN(self, _n1)) #' in tmpl_source
+    assert '_v = (VFFSL(SL, _n2) if "f" in _globalSetVars else VFN(self, _n2)) #' in tmpl_source
+    module = _create_module_from_source(tmpl_source)
+    tmpl = module.DynamicallyCompiledTemplate()
+    assert tmpl.respond() == 'T f\n\n'
+
+
+def test_class_names_shadowed_by_locals_or_set_global():
+    cls = compile_to_class(
+        '#def f()\n'
+        '#if True\n'
+        '#set g = "local"\n'
+        '#end if\n'
+        '$g $h\n'
+        '#end def\n'
+        '#def g()\n'
+        'method\n'
+        '#end def\n'
+        '#def h()\n'
+        '#set global h = "global"\n'
+        '#end def\n'
+        '$h()$f()',
+    )
+    assert cls().respond() == 'local global\n'
+
+
+def test_globals_are_loaded_directly():
+    tmpl_source = compile_source(
+        '#import os.path\n'
+        '#from json import dumps as to_json\n'
+        '$len($xs) $to_json($xs) $os.path.join("a", "b") $sorted($xs)\n'
+        '$abs(-1) $round(1)\n'
+        '#def sorted(xs)\n'
+        'mine\n'
+        '#end def\n'
+        '#def f()\n'
+        '#set global abs = lambda x: "global"\n'
+        '#end def\n',
+    )
+    assert '_v = (VFFSL(SL, _n2) if "len" in _globalSetVars else len)(VFFSL(SL, _n1)) #' in tmpl_source
+    assert '_v = (VFFSL(SL, _n4) if "to_json" in _globalSetVars else to_json)(VFFSL(SL, _n3)) #' in tmpl_source
+    assert '_v = VFN((VFFSL(SL, _n5) if "os" in _globalSetVars else VFN(os, _n11)), _n6)("a", "b") #' in tmpl_source
+    assert '_v = (VFFSL(SL, _n8) if "sorted" in _globalSetVars else self.sorted)(VFFSL(SL, _n7)) #' in tmpl_source
+    assert '_v = (_globalSetVars["abs"] if "abs" in _globalSetVars else VFFSL(SL, _n9))(-1) #' in tmpl_source
+    assert '_v = (VFFSL(SL, _n10) if "round" in _globalSetVars else round)(1) #' in tmpl_source
+
+    module = _create_module_from_source(tmpl_source)
+    tmpl = module.DynamicallyCompiledTemplate(
+        searchList=[{'xs': [2, 1], 'len': NotCalled(), 'abs': lambda x: 'searched'}],
+    )
+    assert tmpl.respond() == '2 [2, 1] a/b mine\n\nsearched {0}\n'.format(round(1))
+
+
+def test_builtins_used_as_search_list_names_are_searched():
+    cls = compile_to_class('$id $type $format $filter $input $hash $min $max $print')
+    searchList = {
+        'id': 5, 'type': 'biz', 'format': 'json', 'filter': 'all',
+        'input': 'i', 'hash': 'h', 'min': 0, 'max': 9, 'print': 'p',
+    }
+    assert cls([searchList]).respond() == '5 biz json all i h 0 9 p'
+
+
+def test_globals_shadowed_by_the_search_list():
+    cls = compile_to_class(
+        '$len("abc")',
+        settings={'loadGlobalsDirectly': False},
+    )
+    assert cls([{'len': lambda x: 'shadowed'}]).respond() == 'shadowed'
+
+
+def test_set_global_variables_are_read_from_their_dict():
+    tmpl_source = compile_source(
+        '$x\n'
+        '#set global x = "set"\n'
+        '#if True\n'
+        '#set global y = "set"\n'
+        '#end if\n'
+        '$x $x.__class__.__name__ $y\n'
+        '#def f()\n'
+        '$x\n'
+        '#end def\n'
+        '$f()',
+    )
+    assert '_v = _globalSetVars["x"] #' in tmpl_source
+    assert '_v = VFN(_globalSetVars["x"], _n7) #' in tmpl_source
+    assert '_v = (_globalSetVars["y"] if "y" in _globalSetVars else VFFSL(SL, _n4)) #' in tmpl_source
+
+    module = _create_module_from_source(tmpl_source)
+    tmpl = module.DynamicallyCompiledTemplate(searchList=[{'x': 'searched'}])
+    assert tmpl.respond() == 'searched\nset {0} set\nset\n'.format(type('').__name__)
+
+
+def test_set_global_variables_of_partial_templates(monkeypatch):
+    _partial_module(
+        monkeypatch, 'partial_sets_globals',
+        '#def set_title(title)\n'
+        '#set global page_title = title\n'
+        '#set global heading = title.upper()\n'
+        '#end def\n',
+    )
+    cls = compile_to_class(
+        '#from partial_sets_globals import set_title\n'
+        '#attr heading = "default"\n'
+        "$set_title('Home')<title>$page_title</title> $heading",
+    )
+    assert cls().respond() == '<title>Home</title> HOME'
+
+
+def test_hoist_loop_invariant_lookups():
+    tmpl_source = compile_source(
+        '#compiler-settings\n'
+        'hoistLoopInvariantLookups = True\n'
+        '#end compiler-settings\n'
+        '#for i in range(2)\n'
+        '#for j in $rows\n'
+        '$sym$j$sym\n'
+        '#if False\n'
+        '$missing\n'
+        '#end if\n'
+        '#end for\n'
+        '#set x = 1\n'
+        '$x\n'
+        '#end for\n'
+        '$sym\n'
+        '#while False: $x $sym\n',
+    )
+    assert '_h1 = VFFSL(SL, _n8, default=NotFound)' in tmpl_source
+    assert '_v = (_h2 if _h2 is not NotFound else VFFSL(SL, _n2)) #' in tmpl_source
+    assert '_v = (_h2 if _h2 is not NotFound else VFFSL(SL, _n3)) #' in tmpl_source
+    assert '_v = VFFSL(SL, _n5) #' in tmpl_source
+    assert '_v = VFFSL(SL, _n6) #' in tmpl_source
+
+    module = _create_module_from_source(tmpl_source)
+    tmpl = module.DynamicallyCompiledTemplate(searchList=[{'rows': 'ab', 'sym': '$', 'x': 2}])
+    assert tmpl.respond() == '$a$\n$b$\n1\n$a$\n$b$\n1\n$\n'
+
+
+def test_hoist_looks_up_the_rest_of_names_in_the_loop():
+    tmpl_source = compile_source(
+        '#for i in range(3)\n'
+        '#silent $cart.add(1)\n'
+        '#if False\n'
+        '$cart.missing\n'
+        '#end if\n'
+        '$cart.total\n'
+        '#end for\n',
+        settings={'hoistLoopInvariantLookups': True},
+    )
+    assert '_h1 = VFFSL(SL, _n5, default=NotFound)' in tmpl_source
+    assert '_v = (VFN(_h1, _n7) if _h1 is not NotFound else VFFSL(SL, _n4)) #' in tmpl_source
+
+    cart = Cart()
+    cart.add(4)
+    module = _create_module_from_source(tmpl_source)
+    tmpl = module.DynamicallyCompiledTemplate(searchList=[{'cart': cart}])
+    assert tmpl.respond() == '5\n6\n7\n'
+
+
+def test_hoist_loop_invariant_lookups_of_pure_names():
+    calls = []
+
+    def counted():
+        calls.append(None)
+        return len(calls)
+
+    cls = compile_to_class(
+        '#for i in range(3)\n'
+        '$pure $impure\n'
+        '#end for\n'
+        '#def f()\n'
+        '#set global g = 1\n'
+        '#for i in range(2): $g$pure\n'
+        '#end def\n',
+        settings={
+            'hoistLoopInvariantLookups': True,
+            'pureNames': ['pure', 'g'],
+            'useAutocalling': True,
+        },
+    )
+    tmpl = cls(searchList=[{'pure': counted, 'impure': counted}])
+    assert tmpl.respond() == '1 2\n1 3\n1 4\n'
+    assert tmpl.f() == '15\n15\n'
+
+    tmpl_source = compile_source(
+        '#for i in range(2): $pure <% x = %>\n',
+        settings={'hoistLoopInvariantLookups': True},
+    )
+    assert '_h1' not in tmpl_source
+
+
+def test_eliminate_common_lookups():
+    calls = []
+
+    def counted():
+        calls.append(None)
+        return len(calls)
+
+    tmpl_source = compile_source(
+        '$a.b.c $a.b.c $pure $pure $impure $impure $once\n'
+        '#for x in $a.b.c: $x$pure$missing$missing\n'
+        '#set y = 1\n'
+        '$y $y\n',
+        settings={
+            'eliminateCommonLookups': True,
+            'pureNames': ['a', 'pure', 'missing'],
+            'useDottedNotation': True,
+            'useAutocalling': True,
+        },
+    )
+    assert '_c1 = VFFSL(SL, _n15, default=NotFound)' in tmpl_source
+    assert '_c2 = VFFSL(SL, _n18, default=NotFound)' in tmpl_source
+    assert '_c3 = VFFSL(SL, _n20, default=NotFound)' in tmpl_source
+    assert '_c4' not in tmpl_source
+    assert 'for x in (VFN(_c1, _n19) if _c1 is not NotFound else VFFSL(SL, _n8)):' in tmpl_source
+    assert '_v = VFFSL(SL, _n5) #' in tmpl_source
+    assert '_v = VFFSL(SL, _n7) #' in tmpl_source
+    assert '_v = VFFSL(SL, _n13) #' in tmpl_source
+
+    module = _create_module_from_source(tmpl_source)
+    searchList = {'a': {'b': {'c': 'pq'}}, 'pure': counted, 'impure': counted, 'once': 'o'}
+    with pytest.raises(NotFound):
+        module.DynamicallyCompiledTemplate(searchList=[searchList]).respond()
+    del calls[:]
+    searchList['missing'] = '-'
+    tmpl = module.DynamicallyCompiledTemplate(searchList=[searchList])
+    assert tmpl.respond() == 'pq pq 1 1 2 3 o\np1--\nq1--\n1 1\n'
+
+    tmpl_source = compile_source(
+        '#def f()\n'
+        '#set global g = 1\n'
+        '$g $g\n'
+        '#end def\n'
+        '$h $h <% x = %>\n',
+        settings={'eliminateCommonLookups': True},
+    )
+    assert '_c1' not in tmpl_source
+
+
+def test_eliminate_common_lookups_looks_up_the_rest_of_names_at_the_call_site():
+    cls = compile_to_class(
+        '$cart.total\n#silent $cart.add(5)\n$cart.total $cart.total',
+        settings={'eliminateCommonLookups': True},
+    )
+    assert cls(searchList=[{'cart': Cart()}]).respond() == '0\n5 5'
+
+
+class NotCalled(object):
+    def __call__(self):  # pragma: no cover (only on failure)
+        raise AssertionError('called')
+
+    def __str__(self):
+        return 'not called'
+
+
+def test_dict_lookup_mode():
+    settings = {'lookupMode': 'dict', 'useAutocalling': True}
+    tmpl_source = compile_source('$a.b $c', settings=settings)
+    assert '_n1 = compile_name("a.b", False, False, lookupMode="dict")' in tmpl_source
+
+    cls = compile_to_class('$a.b $a.c.d $f', settings=settings)
+    # $f isn't autocalled
+    assert cls([{'a': {'b': 1, 'c': {'d': 2}}, 'f': NotCalled()}]).respond() == '1 2 not called'
+    # attributes are never looked at
+    with pytest.raises(NotFound):
+        cls([{'a': {'b': 1, 'c': ValueError('d')}}]).respond()
+
+
+def test_invalid_lookup_mode():
+    with pytest.raises(ValueError):
+        compile_source('$a.b', settings={'lookupMode': 'attributes'})
+
+
+STREAMING_TEMPLATE = (
+    '<head>\n'
+    '#block head\n'
+    'css\n'
+    '#end block\n'
+    '#for i in range(4)\n'
+    '$i\n'
+    '#end for\n'
+    '#if True\n'
+    '#flush\n'
+    '#end if\n'
+    'tail\n'
+)
+
+
+def test_streaming_respond():
+    settings = {'streamingRespond': True, 'streamingChunkSize': 4}
+    cls = compile_to_class(STREAMING_TEMPLATE, settings=settings)
+    tmpl = cls()
+    assert list(tmpl.respond_iter()) == ['<head>\n', 'css\n', '0\n1\n', '2\n3\n', 'tail\n']
+    assert tmpl.transaction is None
+    assert tmpl.respond() == '<head>\ncss\n0\n1\n2\n3\ntail\n'
+
+    # while it is suspended, the template can render as usual
+    chunks = tmpl.respond_iter()
+    assert next(chunks) == '<head>\n'
+    assert tmpl.transaction is None
+    assert tmpl.head() == 'css\n'
+    assert ''.join(chunks) == 'css\n0\n1\n2\n3\ntail\n'
+
+
+def test_streaming_respond_into_a_transaction():
+    cls = compile_to_class(STREAMING_TEMPLATE, settings={'streamingRespond': True})
+    tmpl = cls()
+    trans = tmpl.transaction = DummyTransaction()
+    assert list(tmpl.respond_iter()) == []
+    assert tmpl.respond() is NO_CONTENT
+    assert trans.response().getvalue() == '<head>\ncss\n0\n1\n2\n3\ntail\n' * 2
+
+
+def test_streaming_respond_off_by_default():
+    tmpl_source = compile_source(STREAMING_TEMPLATE)
+    assert 'respond_iter' not in tmpl_source
+    assert 'yield' not in tmpl_source
+    assert compile_to_class(STREAMING_TEMPLATE)().respond() == '<head>\ncss\n0\n1\n2\n3\ntail\n'
+
+
+def test_streaming_main_method_cannot_return():
+    with pytest.raises(AssertionError):
+        compile_source('#return 1', settings={'streamingRespond': True})
+    compile_source('#def f()\n#return 1\n#end def\n', settings={'streamingRespond': True})
+
+
+def test_async_respond_cannot_stream():
+    with pytest.raises(AssertionError):
+        compile_source('x', settings={'asyncRespond': True, 'streamingRespond': True})
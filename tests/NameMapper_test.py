@@ -1,13 +1,30 @@
+from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import collections
+import contextlib
+import functools
+import pytest
 import unittest
 
 from Cheetah.compile import compile_to_class
+from Cheetah.NameMapper import CompiledName
+from Cheetah.NameMapper import InlineCache
 from Cheetah.NameMapper import NotFound
+from Cheetah.NameMapper import SearchList
+from Cheetah.NameMapper import TooManyPeriodsInName
+from Cheetah.NameMapper import compile_name
+from Cheetah.NameMapper import enable_stats
+from Cheetah.NameMapper import get_stats
+from Cheetah.NameMapper import reset_stats
 from Cheetah.NameMapper import valueFromFrame
 from Cheetah.NameMapper import valueFromFrameOrSearchList
 from Cheetah.NameMapper import valueFromSearchList
 from Cheetah.NameMapper import valueForName
+from Cheetah.NameMapper import valuesFromFrameOrSearchList
+from Cheetah.NameMapper import valuesFromSearchList
+from testing.util import call_with_locals
+from testing.util import requires_extension
 
 
 class DummyClass(object):
@@ -448,15 +465,25 @@ class VFS_4namespaces(VFS):
     _searchListLength = 4
 
 
+class VFS_SearchList(VFS):
+    def searchList(self):
+        # kept for the whole test so the merged index gets built
+        if not hasattr(self, '_searchList'):
+            self._searchList = SearchList((
+                {'dummy': 1234}, {'other': 1}, self.namespace(), {'dummy': 1234},
+            ))
+        return self._searchList
+
+
 class VFF(VFN):
     def get(self, name, autocall=True):
-        locals().update({
+        local_vars = {
             'ns': self._testNamespace,
             'aStr': self._testNamespace['aStr'],
             'aFloat': self._testNamespace['aFloat'],
             'none': 'some',
-        })
-        return valueFromFrame(name, autocall)
+        }
+        return call_with_locals(local_vars, valueFromFrame, name, autocall)
 
     def setUp(self):
         """Mod some of the data
@@ -495,8 +522,8 @@ class VFFSL(VFS):
         del ns['anInt']  # will be picked up by globals
 
     def VFFSL(self, searchList, name, autocall=True):
-        locals().update({'anInt': 1, 'none': 'some'})
-        return valueFromFrameOrSearchList(searchList, name, autocall)
+        local_vars = {'anInt': 1, 'none': 'some'}
+        return call_with_locals(local_vars, valueFromFrameOrSearchList, searchList, name, autocall)
 
     def get(self, name, autocall=True):
         return self.VFFSL(self.searchList(), name, autocall)
@@ -514,6 +541,10 @@ class VFFSL_4(VFFSL):
     _searchListLength = 4
 
 
+class VFFSL_SearchList(VFFSL, VFS_SearchList):
+    pass
+
+
 def test_map_builtins_int():
     template_cls = compile_to_class(
         '''
@@ -523,3 +554,583 @@ def test_map_builtins_int():
         ''',
     )
     assert 5 == template_cls().intify('5')
+
+
+class AttrNamespace(object):
+    pass
+
+
+@requires_extension
+def test_inline_cache_hit():
+    cache = InlineCache()
+    searchList = [{}, AttrNamespace(), {'foo': 'bar'}]
+    for _ in range(3):
+        assert valueFromSearchList(searchList, 'foo', False, True, cache) == 'bar'
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+@requires_extension
+def test_inline_cache_attribute_hit():
+    cache = InlineCache()
+    namespace = AttrNamespace()
+    namespace.foo = 'bar'
+    searchList = [{}, namespace]
+    for _ in range(3):
+        assert valueFromSearchList(searchList, 'foo', False, True, cache) == 'bar'
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_inline_cache_earlier_dict_gains_name():
+    cache = InlineCache()
+    first = {}
+    searchList = [first, {'foo': 'bar'}]
+    assert valueFromSearchList(searchList, 'foo', False, True, cache) == 'bar'
+    first['foo'] = 'baz'
+    assert valueFromSearchList(searchList, 'foo', False, True, cache) == 'baz'
+    assert cache.hits == 0
+
+
+def test_inline_cache_earlier_object_gains_name():
+    cache = InlineCache()
+    namespace = AttrNamespace()
+    searchList = [namespace, {'foo': 'bar'}]
+    assert valueFromSearchList(searchList, 'foo', False, True, cache) == 'bar'
+    namespace.foo = 'baz'
+    assert valueFromSearchList(searchList, 'foo', False, True, cache) == 'baz'
+    del namespace.foo
+    AttrNamespace.foo = 'class attr'
+    try:
+        assert valueFromSearchList(searchList, 'foo', False, True, cache) == 'class attr'
+    finally:
+        del AttrNamespace.foo
+
+
+def test_inline_cache_namespace_replaced():
+    cache = InlineCache()
+    searchList = [{}, {'foo': 'bar'}]
+    assert valueFromSearchList(searchList, 'foo', False, True, cache) == 'bar'
+    searchList[0] = {'foo': 'baz'}
+    assert valueFromSearchList(searchList, 'foo', False, True, cache) == 'baz'
+    searchList[:] = [{}]
+    with pytest.raises(NotFound):
+        valueFromSearchList(searchList, 'foo', False, True, cache)
+
+
+def test_inline_cache_hit_namespace_loses_name():
+    cache = InlineCache()
+    last = {'foo': 'bar'}
+    searchList = [{}, last, {'foo': 'baz'}]
+    assert valueFromSearchList(searchList, 'foo', False, True, cache) == 'bar'
+    del last['foo']
+    assert valueFromSearchList(searchList, 'foo', False, True, cache) == 'baz'
+
+
+def test_inline_cache_shared_between_names():
+    cache = InlineCache()
+    searchList = [{'foo': 1, 'bar': 2}]
+    assert valueFromSearchList(searchList, 'foo', False, True, cache) == 1
+    assert valueFromSearchList(searchList, 'bar', False, True, cache) == 2
+    assert valueFromSearchList(searchList, 'foo.real', False, True, cache) == 1
+
+
+@requires_extension
+def test_inline_cache_globals_and_builtins():
+    cache = InlineCache()
+    searchList = [{}]
+    for _ in range(2):
+        assert valueFromFrameOrSearchList(searchList, 'testNamespace', False, True, cache) is testNamespace
+    assert cache.hits == 1
+    cache = InlineCache()
+    for _ in range(2):
+        assert valueFromFrameOrSearchList(searchList, 'len', False, True, cache) is len
+    assert cache.hits == 1
+    searchList[0]['len'] = 'shadowed'
+    assert valueFromFrameOrSearchList(searchList, 'len', False, True, cache) == 'shadowed'
+
+
+def test_inline_cache_locals_take_precedence():
+    cache = InlineCache()
+    searchList = [{'foo': 'bar'}]
+    assert valueFromFrameOrSearchList(searchList, 'foo', False, True, cache) == 'bar'
+    foo = 'local'
+    assert valueFromFrameOrSearchList(searchList, 'foo', False, True, cache) == foo
+
+
+@requires_extension
+def test_inline_cache_autocall():
+    cache = InlineCache()
+    searchList = [{'aFunc': dummyFunc}]
+    for _ in range(2):
+        assert valueFromSearchList(searchList, 'aFunc', True, True, cache) == 'Scooby'
+    assert cache.hits == 1
+
+
+def test_inline_cache_not_a_list():
+    cache = InlineCache()
+    for _ in range(2):
+        assert valueFromSearchList(iter([{'foo': 'bar'}]), 'foo', False, True, cache) == 'bar'
+    assert cache.hits == 0
+
+
+def test_inline_cache_wrong_type():
+    with pytest.raises(TypeError):
+        valueFromSearchList([{}], 'foo', False, True, object())
+
+
+def test_compile_name():
+    name = compile_name('a.b.c', True, False)
+    assert isinstance(name, CompiledName)
+    assert name.name == 'a.b.c'
+    assert name.chunks == ('a', 'b', 'c')
+    assert (name.executeCallables, name.useDottedNotation) == (True, False)
+    assert repr(name) == 'compile_name({0!r}, True, False)'.format('a.b.c')
+
+
+def test_compile_name_chunks_are_interned():
+    first = compile_name('foo.bar').chunks
+    second = compile_name(''.join(['fo', 'o.bar'])).chunks
+    assert first[0] is second[0]
+    assert first[1] is second[1]
+
+
+def test_compile_name_trailing_period():
+    assert compile_name('a.').chunks == ('a',)
+    assert compile_name('').chunks == ('',)
+
+
+def test_compile_name_too_many_periods():
+    compile_name('.'.join(['a'] * 14))
+    with pytest.raises(TooManyPeriodsInName):
+        compile_name('.'.join(['a'] * 15))
+    with pytest.raises(TooManyPeriodsInName):
+        valueForName({}, '.'.join(['a'] * 15))
+
+
+def test_compiled_name_lookups():
+    searchList = [{'aFunc': dummyFunc, 'aDict': {'one': 1}}]
+    assert valueFromSearchList(searchList, compile_name('aFunc', True)) == 'Scooby'
+    assert valueFromSearchList(searchList, compile_name('aFunc', False)) is dummyFunc
+    assert valueFromFrameOrSearchList(searchList, compile_name('aDict.one')) == 1
+    assert valueForName(searchList[0], compile_name('aDict.one')) == 1
+    assert valueFromFrame(compile_name('dummyFunc', True)) == 'Scooby'
+    with pytest.raises(NotFound):
+        valueForName(searchList[0], compile_name('aDict.one', False, False))
+
+
+def test_compiled_name_not_found_message():
+    with pytest.raises(NotFound) as excinfo:
+        valueFromSearchList([{'a': {}}], compile_name('a.b'))
+    assert str(excinfo.value) == "cannot find 'b' while searching for 'a.b'"
+
+
+def test_compiled_name_fixes_flags():
+    with pytest.raises(TypeError):
+        valueFromSearchList([{}], compile_name('foo'), True)
+    with pytest.raises(TypeError):
+        valueForName({}, compile_name('foo'), useDottedNotation=False)
+
+
+def test_dict_lookup_mode():
+    name = compile_name('a.b', True, lookupMode='dict')
+    assert (name.executeCallables, name.lookupMode) == (False, 'dict')
+    assert repr(name) == "compile_name({0!r}, False, True, lookupMode='dict')".format('a.b')
+    assert compile_name('a').lookupMode == 'default'
+
+    assert valueForName({'a': {'b': 1}}, name) == 1
+    assert valueForName({'a': collections.OrderedDict(b=1)}, name) == 1
+    assert valueForName({'a': {'b': dummyFunc}}, name) is dummyFunc
+    # the first part is searched for as usual
+    assert valueFromSearchList([DummyClass(), {'a': {'b': 1}}], name) == 1
+    for value in (DummyClass(), [1], 'str'):
+        with pytest.raises(NotFound) as excinfo:
+            valueForName({'a': value}, name)
+        assert str(excinfo.value) == "cannot find 'b' while searching for 'a.b'"
+    with pytest.raises(NotFound):
+        valueFromSearchList([{'a': {'c': 1}}], name)
+    with pytest.raises(ValueError):
+        compile_name('a.b', lookupMode='attributes')
+
+
+@requires_extension
+def test_compiled_name_inline_cache():
+    name = compile_name('foo')
+    searchList = [{}, {'foo': 'bar'}]
+    for _ in range(3):
+        assert valueFromSearchList(searchList, name) == 'bar'
+    assert (name.hits, name.misses) == (2, 1)
+
+
+def test_name_must_be_text():
+    with pytest.raises(TypeError):
+        valueFromSearchList([{}], 5)
+    with pytest.raises(TypeError):
+        compile_name(5)
+
+
+def test_positional_and_keyword_arguments():
+    searchList = [{'aFunc': dummyFunc}]
+    assert valueFromSearchList(searchList, 'aFunc', True, True) == 'Scooby'
+    assert valueFromSearchList(searchList, 'aFunc', executeCallables=True) == 'Scooby'
+    assert valueFromSearchList(searchList=searchList, name='aFunc') is dummyFunc
+    assert valueFromFrameOrSearchList(searchList, 'aFunc', 1) == 'Scooby'
+    assert valueForName(searchList[0], 'aFunc', useDottedNotation=True) is dummyFunc
+    assert valueFromFrame('dummyFunc', True) == 'Scooby'
+    assert valueFromFrame(name='dummyFunc') is dummyFunc
+
+
+def test_bad_arguments():
+    with pytest.raises(TypeError):
+        valueFromSearchList([{}], 'foo', 1.0)
+    with pytest.raises(TypeError):
+        valueFromSearchList([{}])
+    with pytest.raises(TypeError):
+        valueFromSearchList([{}], 'foo', True, True, None, None, None)
+    with pytest.raises(TypeError):
+        valueForName({}, 'foo', bogus=True)
+    with pytest.raises(TypeError):
+        valueFromFrame()
+
+
+class RaisingProperty(object):
+    @property
+    def foo(self):
+        raise ValueError('not me')
+
+
+class UserMapping(object):
+    def __init__(self, data):
+        self.data = data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+
+def test_searchlist_misses_skip_broken_namespaces():
+    searchList = [RaisingProperty(), UserMapping({}), {'foo': 'bar'}]
+    assert valueFromSearchList(searchList, 'foo') == 'bar'
+
+
+def test_searchlist_defaultdict():
+    searchList = [collections.defaultdict(lambda: 'default')]
+    assert valueFromSearchList(searchList, 'foo') == 'default'
+
+
+def test_dotted_lookup_falls_back_to_attributes():
+    empty = {}
+    assert valueForName(empty, 'keys') == empty.keys
+    assert valueForName(UserMapping({'foo': 1}), 'foo') == 1
+    assert valueForName(UserMapping({}), 'data') == {}
+    with pytest.raises(ValueError):
+        valueForName(RaisingProperty(), 'foo')
+
+
+class CallableInstance(object):
+    def __call__(self):
+        raise AssertionError('instances are not autocalled')
+
+    def method(self):
+        return 'method result'
+
+
+@pytest.mark.parametrize('repeat', (1, 2))
+def test_autocall_classification(repeat):
+    def func():
+        return 'func result'
+
+    def func_with_mro():
+        raise AssertionError('not autocalled')
+    func_with_mro.mro = None
+
+    instance = CallableInstance()
+    partial = functools.partial(func)
+    namespace = {
+        'func': func,
+        'func_with_mro': func_with_mro,
+        'method': instance.method,
+        'builtin_method': 'abc'.upper,
+        'builtin_function': len,
+        'partial': partial,
+        'cls': CallableInstance,
+        'instance': instance,
+    }
+    for _ in range(repeat):
+        assert valueForName(namespace, 'func', True) == 'func result'
+        assert valueForName(namespace, 'func_with_mro', True) is func_with_mro
+        assert valueForName(namespace, 'method', True) == 'method result'
+        assert valueForName(namespace, 'builtin_method', True) == 'ABC'
+        assert valueForName(namespace, 'partial', True) is partial
+        assert valueForName(namespace, 'cls', True) is CallableInstance
+        assert valueForName(namespace, 'instance', True) is instance
+    with pytest.raises(TypeError):
+        valueForName(namespace, 'builtin_function', True)
+
+
+def test_not_found_attributes():
+    with pytest.raises(NotFound) as excinfo:
+        valueFromSearchList([{'a': {}}], 'a.b')
+    assert excinfo.value.key == 'b'
+    assert excinfo.value.name == 'a.b'
+    assert excinfo.value.args == ("cannot find 'b' while searching for 'a.b'",)
+    assert isinstance(excinfo.value, LookupError)
+
+
+@pytest.mark.parametrize('lookup', (
+    functools.partial(valueFromSearchList, [{}]),
+    functools.partial(valueFromFrameOrSearchList, [{}]),
+    valueFromFrame,
+    functools.partial(valueForName, {}),
+    lambda name: valuesFromSearchList([{}], (name,))[0],
+))
+def test_not_found_first_chunk_has_the_full_name(lookup):
+    with pytest.raises(NotFound) as excinfo:
+        lookup('not_there.b')
+    assert excinfo.value.key == 'not_there'
+    assert excinfo.value.name == 'not_there.b'
+    assert str(excinfo.value) == "cannot find 'not_there' while searching for 'not_there.b'"
+
+
+def test_not_found_raised_by_user_code():
+    def raises():
+        raise NotFound('custom')
+
+    exc = NotFound('custom')
+    assert (str(exc), exc.key, exc.name) == ('custom', None, None)
+    with pytest.raises(NotFound) as excinfo:
+        valueFromSearchList([{'raises': raises}], 'raises', True)
+    assert str(excinfo.value) == "custom while searching for 'raises'"
+
+
+def test_default():
+    searchList = [{'a': {'b': 1}, 'aFunc': dummyFunc}]
+    sentinel = object()
+    assert valueFromSearchList(searchList, 'a.b', default=sentinel) == 1
+    assert valueFromSearchList(searchList, 'missing', default=sentinel) is sentinel
+    assert valueFromSearchList(searchList, 'a.missing', default=sentinel) is sentinel
+    assert valueFromSearchList(searchList, 'a.b', False, True, None, sentinel) == 1
+    assert valueFromSearchList(searchList, 'aFunc', True, default=None) == 'Scooby'
+    assert valueFromFrameOrSearchList(searchList, 'missing', default=None) is None
+    assert valueFromFrameOrSearchList(searchList, compile_name('sentinel'), default=None) is sentinel
+
+
+def test_default_does_not_hide_other_errors():
+    with pytest.raises(ValueError):
+        valueForName(RaisingProperty(), 'foo')
+    with pytest.raises(ValueError):
+        valueFromSearchList([{'a': RaisingProperty()}], 'a.foo', default=None)
+
+
+def test_values_from_search_list():
+    searchList = [{'a': {'b': 1}}, {'c': 2, 'aFunc': dummyFunc}]
+    names = ('a.b', 'c', compile_name('aFunc', True), 'missing', 'a.missing')
+    assert valuesFromSearchList(searchList, names, default=None) == (
+        1, 2, 'Scooby', None, None,
+    )
+    assert valuesFromSearchList(searchList, ()) == ()
+    with pytest.raises(NotFound) as excinfo:
+        valuesFromSearchList(searchList, ('c', 'missing'))
+    assert excinfo.value.name == 'missing'
+
+
+def test_values_from_frame_or_search_list():
+    local = 'local'
+    assert valuesFromFrameOrSearchList(
+        [{'local': 'searchList', 'c': 2}], ('local', 'c', 'len'),
+    ) == (local, 2, len)
+
+
+def test_search_list_is_a_list():
+    searchList = SearchList([{'a': 1}])
+    searchList.append({'b': 2})
+    assert isinstance(searchList, list)
+    assert searchList == [{'a': 1}, {'b': 2}]
+
+
+def test_search_list_sees_changes():
+    first, second = {'a': 1}, {'a': 2, 'b': 2}
+    searchList = SearchList([first, second])
+    for _ in range(10):
+        assert valueFromSearchList(searchList, 'a') == 1
+        assert valueFromSearchList(searchList, 'b') == 2
+    first['b'] = 1
+    assert valueFromSearchList(searchList, 'b') == 1
+    del first['a']
+    assert valueFromSearchList(searchList, 'a') == 2
+    searchList.insert(0, {'a': 0})
+    assert valueFromSearchList(searchList, 'a') == 0
+    searchList[:] = [{}, {}]
+    with pytest.raises(NotFound):
+        valueFromSearchList(searchList, 'a')
+
+
+def test_search_list_keeps_order_around_objects():
+    class Obj(object):
+        a = 'attribute'
+
+    searchList = SearchList([{}, {'b': 1}, Obj(), {'a': 'key'}, {'b': 2}])
+    for _ in range(10):
+        assert valueFromSearchList(searchList, 'a') == 'attribute'
+        assert valueFromSearchList(searchList, 'b') == 1
+        assert valueFromSearchList(searchList, 'keys') == searchList[0].keys
+        assert valuesFromSearchList(searchList, ('a', 'b')) == ('attribute', 1)
+
+
+@pytest.mark.parametrize('name', ('keys', 'items', 'get'))
+def test_search_list_finds_dict_attributes_before_later_keys(name):
+    namespaces = [{}, {}, {name: 'key'}]
+    searchList = SearchList(namespaces)
+    cache = InlineCache()
+    for _ in range(3):
+        for lookup in (searchList, namespaces):
+            assert valueFromSearchList(lookup, name) == getattr(namespaces[0], name)
+            assert valueFromSearchList(lookup, name, cache=cache) == getattr(namespaces[0], name)
+            assert valuesFromSearchList(lookup, (name,)) == (getattr(namespaces[0], name),)
+    namespaces[0][name] = 'first'
+    assert valueFromSearchList(SearchList(namespaces), name) == 'first'
+
+
+@requires_extension
+def test_search_list_inline_cache():
+    searchList = SearchList([{}, {}, {'a': 1}])
+    cache = InlineCache()
+    for _ in range(10):
+        assert valueFromSearchList(searchList, 'a', cache=cache) == 1
+    assert cache.hits == 9
+    searchList[1]['a'] = 2
+    assert valueFromSearchList(searchList, 'a', cache=cache) == 2
+
+
+@requires_extension
+def test_search_list_remembers_missing_names():
+    class Obj(object):
+        pass
+
+    obj = Obj()
+    first = {'a': 1}
+    searchList = SearchList([first, {'b': 2}, obj, {'c': 3}])
+    for _ in range(3):
+        assert valueFromSearchList(searchList, 'x', default=None) is None
+    assert searchList.skipped == 8
+    assert valueFromFrameOrSearchList(searchList, 'len') is len
+    assert valueFromFrameOrSearchList(searchList, 'len') is len
+    assert searchList.skipped == 12
+
+    # every kind of namespace can gain the name
+    obj.x = 'attribute'
+    assert valueFromSearchList(searchList, 'x') == 'attribute'
+    first['x'] = 'key'
+    assert valueFromSearchList(searchList, 'x') == 'key'
+    del first['x']
+    del obj.x
+    assert valueFromSearchList(searchList, 'x', default=None) is None
+    searchList.append({'x': 'appended'})
+    assert valueFromSearchList(searchList, 'x') == 'appended'
+
+
+@requires_extension
+def test_search_list_remembers_where_names_are():
+    searchList = SearchList([{'a': 1}, {'b': 2}, object(), {'c': 3}, {'d': 4}])
+    for _ in range(3):
+        assert valueFromSearchList(searchList, 'd') == 4
+    # the run of dicts at the end is searched as one
+    assert searchList.skipped == 6
+    searchList[1]['d'] = 'shadowed'
+    assert valueFromSearchList(searchList, 'd') == 'shadowed'
+    assert searchList.skipped == 6
+
+
+@contextlib.contextmanager
+def _recording_stats():
+    reset_stats()
+    enable_stats()
+    try:
+        yield
+    finally:
+        enable_stats(False)
+        reset_stats()
+
+
+def _stats_without_time(name):
+    stats = get_stats()[name]
+    assert stats.pop('time') >= 0
+    return stats
+
+
+def _stats(locals=0, searchList=None, globals=0, builtins=0, misses=0, autocalls=0):
+    return {
+        'locals': locals, 'searchList': searchList or {}, 'globals': globals, 'builtins': builtins,
+        'misses': misses, 'autocalls': autocalls,
+    }
+
+
+def test_stats_disabled():
+    reset_stats()
+    valueFromSearchList([{'a': 1}], 'a')
+    assert get_stats() == {}
+
+
+def test_stats_sources():
+    local = 1
+    searchList = [{}, {'a': lambda: 2}]
+    with _recording_stats():
+        assert valueFromFrameOrSearchList(searchList, 'local') == local
+        for _ in range(3):
+            assert valueFromFrameOrSearchList(searchList, 'a', True) == 2
+        assert valueFromFrameOrSearchList(searchList, 'compile_name') is compile_name
+        assert valueFromFrameOrSearchList(searchList, 'len') is len
+        assert valueFromFrameOrSearchList(searchList, 'missing', default=None) is None
+        with pytest.raises(NotFound):
+            valueFromSearchList(searchList, 'a.missing')
+        assert set(get_stats()) == {'local', 'a', 'compile_name', 'len', 'missing', 'a.missing'}
+        assert _stats_without_time('local') == _stats(locals=1)
+        assert _stats_without_time('a') == _stats(searchList={1: 3}, autocalls=3)
+        assert _stats_without_time('compile_name') == _stats(globals=1)
+        assert _stats_without_time('len') == _stats(builtins=1)
+        assert _stats_without_time('missing') == _stats(misses=1)
+        assert _stats_without_time('a.missing') == _stats(searchList={1: 1}, misses=1)
+
+
+def test_stats_compiled_names_and_caches():
+    name = compile_name('a.b', True, True)
+    searchList = SearchList([{}, {'x': 1}, {'a': {'b': lambda: 3}}])
+    with _recording_stats():
+        for _ in range(5):
+            assert valueFromSearchList(searchList, name) == 3
+            assert valueFromSearchList(list(searchList), 'a.b', True, True, cache=InlineCache()) == 3
+        assert _stats_without_time('a.b') == _stats(searchList={2: 10}, autocalls=10)
+
+
+def test_stats_value_from_frame():
+    local = 1
+    with _recording_stats():
+        assert valueFromFrame('local') == local
+        with pytest.raises(NotFound):
+            valueFromFrame('missing')
+        assert _stats_without_time('local') == _stats(locals=1)
+        assert _stats_without_time('missing') == _stats(misses=1)
+
+
+def test_stats_batch_lookups():
+    local = 1
+    searchList = [{'a': 1}, {'b': lambda: 2}]
+    autocalled = compile_name('b', True, False)
+    with _recording_stats():
+        assert valuesFromFrameOrSearchList(
+            searchList, ('local', 'a', autocalled, 'len', 'missing'), default=None,
+        ) == (local, 1, 2, len, None)
+        assert valuesFromSearchList(SearchList(searchList), (autocalled,)) == (2,)
+        assert _stats_without_time('local') == _stats(locals=1)
+        assert _stats_without_time('a') == _stats(searchList={0: 1})
+        assert _stats_without_time('b') == _stats(searchList={1: 2}, autocalls=2)
+        assert _stats_without_time('len') == _stats(builtins=1)
+        assert _stats_without_time('missing') == _stats(misses=1)
+
+
+def test_stats_reset():
+    with _recording_stats():
+        valueFromSearchList([{'a': 1}], 'a')
+        reset_stats()
+        assert get_stats() == {}
+        valueFromSearchList([{'a': 1}], 'a')
+        enable_stats(False)
+        valueFromSearchList([{'a': 1}], 'a')
+        assert _stats_without_time('a') == _stats(searchList={0: 1})
@@ -523,6 +523,11 @@ def test_set_with_dollar_signs_raises():
         compile_to_class('#set $foo = 1\n')
 
 
+def test_set_with_dollar_signs_on_local_raises():
+    with pytest.raises(ParseError):
+        compile_to_class('#set foo = 1\n#set $foo = 2\n')
+
+
 def test_macros_with_arguments():
     def herp_macro(src, foo):
         return src + foo  # pragma: no cover
@@ -0,0 +1,33 @@
+from __future__ import unicode_literals
+
+import pytest
+
+from Cheetah.SourceReader import SourceReader
+
+
+@pytest.mark.parametrize('src', ('', 'a', 'ab\ncd\n', 'ab\r\ncd\re\n\nf'))
+def test_lines(src):
+    reader = SourceReader(src)
+    for pos in range(len(src) + 1):
+        BOL = max(src.rfind('\n', 0, pos) + 1, src.rfind('\r', 0, pos) + 1)
+        assert reader.findBOL(pos) == BOL
+        if pos == len(src) or src[pos] in '\r\n' or src[pos - 1] not in '\r\n':
+            continue
+        row = src[:pos].replace('\r\n', '\n').replace('\r', '\n').count('\n') + 1
+        assert reader.getRowCol(pos) == (row, 1)
+
+
+def test_position_in_a_line_break():
+    with pytest.raises(AssertionError):
+        SourceReader('a\r\nb').lineNum(2)
+
+
+def test_push_and_pop_src():
+    reader = SourceReader('ab\ncd')
+    reader.setPos(4)
+    reader.pushSrc('x\ny\nz')
+    assert (reader.src(), reader.pos(), len(reader)) == ('x\ny\nz', 0, 5)
+    assert reader.getRowCol(4) == (3, 1)
+    reader.popSrc()
+    assert (reader.src(), reader.pos(), len(reader)) == ('ab\ncd', 4, 5)
+    assert reader.getRowCol() == (2, 2)
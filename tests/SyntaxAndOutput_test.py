@@ -1590,7 +1590,7 @@ class RaiseDirective(OutputTest):
         def test(self=self):
             self.verify("#if 1\n#raise ValueError\n#end if\n",
                         "")
-        self.failUnlessRaises(ValueError, test)
+        self.assertRaises(ValueError, test)
 
     def test3(self):
         """#raise ValueError in #if block
@@ -1,7 +1,12 @@
 from __future__ import unicode_literals
 
 from Cheetah import five
+from Cheetah import Template as Template_module
 from Cheetah.compile import compile_to_class
+from Cheetah.DummyTransaction import DummyResponse
+from Cheetah.DummyTransaction import DummyTransaction
+from Cheetah.NameMapper import SearchList
+from Cheetah.Template import NO_CONTENT
 from Cheetah.Template import Template
 
 
@@ -28,6 +33,90 @@ def test_instantiate_with_tuple():
     assert ret == 'foo_val bar_val'
 
 
+def test_search_list_with_many_namespaces():
+    cls = compile_to_class('#for i in range(20)\n$foo $bar\n#end for\n')
+    namespaces = [{'ns{0}'.format(i): i} for i in range(8)] + [{'bar': 'b'}]
+    tmpl = cls(searchList=[{'foo': 'f'}] + namespaces)
+    assert isinstance(tmpl.searchList(), SearchList)
+    assert tmpl.respond() == 'f b\n' * 20
+    namespaces[0]['bar'] = 'shadowed'
+    assert tmpl.respond() == 'f shadowed\n' * 20
+
+
+def test_get_var_names_are_bounded():
+    tmpl = compile_to_class('')()
+    for i in range(Template_module._COMPILED_NAMES_MAX + 1):
+        assert not tmpl.varExists('name{0}'.format(i))
+    assert len(Template_module._compiled_names) <= Template_module._COMPILED_NAMES_MAX
+
+
+def test_set_global_after_a_miss():
+    cls = compile_to_class(
+        '#for i in range(3)\n'
+        '$varExists("foo")\n'
+        '#end for\n'
+        '#set global foo = "bar"\n'
+        '$varExists("foo") $foo\n'
+    )
+    assert cls([{}, {}]).respond() == 'False\nFalse\nFalse\nTrue bar\n'
+
+
+def test_writes_to_the_transaction_of_the_caller():
+    cls = compile_to_class('#def f(x)\n<$x>\n#end def\n$f(1)$f(2)')
+    tmpl = cls()
+    assert tmpl.f(0) == '<0>\n'
+    assert tmpl.transaction is None
+
+    trans = DummyTransaction()
+    tmpl.transaction = trans
+    assert tmpl.respond() is NO_CONTENT
+    assert tmpl.f(3) is NO_CONTENT
+    assert tmpl.transaction is trans
+    assert trans.response().getvalue() == '<1>\n<2>\n<3>\n'
+
+
+class UpperResponse(DummyResponse):
+    def write(self, value):
+        super(UpperResponse, self).write(value.upper())
+
+
+def test_writes_to_a_response_subclass():
+    tmpl = compile_to_class('hello $x')(searchList=[{'x': 'y'}])
+    trans = DummyTransaction()
+    trans.response(UpperResponse())
+    tmpl.transaction = trans
+    assert tmpl.respond() is NO_CONTENT
+    assert trans.response().getvalue() == 'HELLO Y'
+
+
+def _old_protocol_method(self):
+    """A method compiled before templates wrote to _CHEETAH__write."""
+    trans = self.transaction
+    if not trans:
+        self.transaction = trans = DummyTransaction()
+        _dummyTrans = True
+    else:
+        _dummyTrans = False
+    trans.response().write('<old>')
+    if _dummyTrans:
+        self.transaction = None
+        return trans.response().getvalue()
+    else:
+        return NO_CONTENT
+
+
+def test_methods_compiled_with_the_old_output_protocol():
+    cls = compile_to_class(
+        '#def new()\n<new>$old()\n#end def\n'
+        '#call $str\n$old()#end call\n$new()',
+    )
+    tmpl = type(str('Mixed'), (cls,), {'old': _old_protocol_method})()
+    assert tmpl.old() == '<old>'
+    # only the output of the #call is filtered
+    assert tmpl.respond() == '&lt;old&gt;\n<new><old>\n'
+    assert tmpl.transaction is None
+
+
 def test_TryExceptImportTestFailCase():
     """Test situation where an inline #import statement will get relocated"""
     source = '''
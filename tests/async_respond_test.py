@@ -0,0 +1,71 @@
+"""Templates compiled with asyncRespond (python 3 only)."""
+from __future__ import unicode_literals
+
+import asyncio
+import inspect
+
+from Cheetah.compile import compile_to_class
+from Cheetah.Template import NO_CONTENT
+
+
+ASYNC_TEMPLATE = (
+    '#def item(n)\n'
+    '<$n>#slurp\n'
+    '#end def\n'
+    '#block head\n'
+    '$fetch("head") $item($fetch(1))\n'
+    '#end block\n'
+    '$fetch("<a>") $fetch(2) $item(3) $plain\n'
+    '#call $str\n'
+    '$fetch("<b>")\n'
+    '#end call\n'
+)
+
+
+def run(coro):
+    # asyncio.run() needs python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_async_respond():
+    cls = compile_to_class(ASYNC_TEMPLATE, settings={'asyncRespond': True})
+    started = []
+
+    async def fetch(value):
+        started.append(value)
+        await asyncio.sleep(0)
+        started.append(None)
+        return value
+
+    tmpl = cls([{'fetch': fetch, 'plain': '<p>'}])
+    output = run(tmpl.arespond())
+    assert output == (
+        'head <1>\n'
+        '&lt;a&gt; 2 <3> &lt;p&gt;\n'
+        '&amp;lt;b&amp;gt;\n'
+    )
+    assert tmpl.transaction is None
+    # The #call region is awaited where it ends, everything else together at
+    # the end: the fetches of the main method run alongside the head block.
+    assert started == ['<b>', None, '<a>', 2, 'head', None, None, None, 1, None]
+    assert run(tmpl.item(4)) == '<4>'
+
+
+def test_async_respond_corner_cases():
+    cls = compile_to_class(
+        '#def gen()\n#yield 1\n#end def\n'
+        '#def none()\n#end def\n'
+        '$no_content() $none()$NO_CONTENT',
+        settings={'asyncRespond': True},
+    )
+
+    async def no_content():
+        return NO_CONTENT
+
+    tmpl = cls([{'no_content': no_content, 'NO_CONTENT': NO_CONTENT}])
+    assert run(tmpl.arespond()) == ' '
+    assert inspect.isasyncgen(tmpl.gen())
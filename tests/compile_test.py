@@ -8,7 +8,9 @@ import subprocess
 import sys
 import textwrap
 
+import Cheetah
 from Cheetah import five
+from Cheetah.compile import ClassCache
 from Cheetah.compile import compile_file
 from Cheetah.compile import compile_source
 from Cheetah.compile import compile_to_class
@@ -77,6 +79,175 @@ def test_compile_source_follows_settings():
         ret(searchList=[]).respond()
 
 
+def test_compile_to_class_cache(tmpdir, monkeypatch):
+    cache_dir = os.path.join(tmpdir.strpath, 'cache')
+    cls = compile_to_class('Hello $x', cache_dir=cache_dir, class_cache=None)
+    assert cls(searchList=[{'x': 1}]).respond() == 'Hello 1'
+    entries = os.listdir(cache_dir)
+    assert len(entries) == 1 and entries[0].endswith('.marshal')
+
+    with monkeypatch.context() as patch:
+        patch.setattr('Cheetah.compile.compile_source', None)
+        cls = compile_to_class('Hello $x', cache_dir=cache_dir, class_cache=None)
+    assert cls(searchList=[{'x': 2}]).respond() == 'Hello 2'
+
+    # Other cls_names, settings and sources are other entries
+    compile_to_class('Hello $x', cls_name='other', cache_dir=cache_dir, class_cache=None)
+    compile_to_class(
+        'Hello $x', settings={'useDottedNotation': False},
+        cache_dir=cache_dir, class_cache=None,
+    )
+    compile_to_class('Bye $x', cache_dir=cache_dir, class_cache=None)
+    assert len(os.listdir(cache_dir)) == 4
+
+
+def test_compile_to_class_cache_ignores_broken_entries(tmpdir):
+    compile_to_class('Hello', cache_dir=tmpdir.strpath, class_cache=None)
+    entry, = os.listdir(tmpdir.strpath)
+    with io.open(os.path.join(tmpdir.strpath, entry), 'wb') as entry_file:
+        entry_file.write(b'\xff')
+    cls = compile_to_class('Hello', cache_dir=tmpdir.strpath, class_cache=None)
+    assert cls().respond() == 'Hello'
+    assert os.listdir(tmpdir.strpath) == [entry]
+
+
+def test_compile_to_class_cache_dir_is_a_file(tmpfile):
+    cls = compile_to_class('Hello', cache_dir=tmpfile, class_cache=None)
+    assert cls().respond() == 'Hello'
+
+
+def _raise_oserror(*args):
+    raise OSError(28, 'No space left on device')
+
+
+def test_compile_to_class_cache_write_fails(tmpdir, monkeypatch):
+    monkeypatch.setattr(os, 'rename', _raise_oserror)
+    cls = compile_to_class('Hello', cache_dir=tmpdir.strpath, class_cache=None)
+    assert cls().respond() == 'Hello'
+    # The temporary file is removed
+    assert os.listdir(tmpdir.strpath) == []
+
+
+def test_compile_to_class_cache_write_and_cleanup_fail(tmpdir, monkeypatch):
+    monkeypatch.setattr(os, 'rename', _raise_oserror)
+    monkeypatch.setattr(os, 'remove', _raise_oserror)
+    cls = compile_to_class('Hello', cache_dir=tmpdir.strpath, class_cache=None)
+    assert cls().respond() == 'Hello'
+
+
+def test_compile_to_class_class_cache():
+    class_cache = ClassCache()
+    cls = compile_to_class('Hello', class_cache=class_cache)
+    assert compile_to_class('Hello', class_cache=class_cache) is cls
+    assert compile_to_class('Hello', class_cache=None) is not cls
+    assert compile_to_class('Hello', class_cache=ClassCache()) is not cls
+    other = compile_to_class(
+        'Hello', settings={'useDottedNotation': False}, class_cache=class_cache,
+    )
+    assert other is not cls
+    assert class_cache.stats() == {
+        'hits': 1, 'misses': 2, 'evictions': 0, 'entries': 2, 'size': 10,
+    }
+
+    class_cache.clear()
+    assert compile_to_class('Hello', class_cache=class_cache) is not cls
+    assert class_cache.stats() == {
+        'hits': 0, 'misses': 1, 'evictions': 0, 'entries': 1, 'size': 5,
+    }
+
+
+def macro(src, **kwargs):
+    return 'macro: ' + src
+
+
+class Macro(object):
+    def __init__(self, parser):
+        pass
+
+    def __call__(self, src, **kwargs):
+        return 'Macro: ' + src
+
+
+MACRO_CACHE_SCRIPT = textwrap.dedent("""\
+    from __future__ import unicode_literals
+
+    import sys
+
+    from Cheetah import compile
+
+    def macro(src, **kwargs):
+        return 'macro: ' + src
+
+    if sys.argv[2] == 'cached':
+        compile.compile_source = None
+    cls = compile.compile_to_class(
+        '#macro\\nsource\\n#end macro\\n',
+        settings={'macroDirectives': {'macro': macro}},
+        cache_dir=sys.argv[1],
+        class_cache=None,
+    )
+    sys.stdout.write(cls().respond())
+""")
+
+
+def test_compile_to_class_cache_with_functions_in_settings(tmpdir):
+    cache_dir = tmpdir.join('cache').strpath
+    for run in ('compile', 'cached'):
+        output = subprocess.check_output(
+            [sys.executable, '-c', MACRO_CACHE_SCRIPT, cache_dir, run],
+            cwd=os.path.dirname(os.path.dirname(Cheetah.__file__)),
+        )
+        assert output == b'macro: source\n'
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_compile_to_class_settings_keys():
+    class_cache = ClassCache()
+    settings = {
+        'macroDirectives': {'macro': macro, 'Macro': Macro},
+        'other': [1, (2.5, None), frozenset(['a', b'b']), set([True])],
+    }
+    source = '#macro\na\n#end macro\n#Macro\nb\n#end Macro\n'
+    cls = compile_to_class(source, settings=settings, class_cache=class_cache)
+    assert cls().respond() == 'macro: a\nMacro: b\n'
+    assert compile_to_class(source, settings=dict(settings), class_cache=class_cache) is cls
+    assert class_cache.stats()['hits'] == 1
+
+
+@pytest.mark.parametrize('value', (lambda src: src, Macro(None), Macro(None).__call__))
+def test_compile_to_class_settings_without_keys_are_not_cached(tmpdir, value):
+    class_cache = ClassCache()
+    settings = {'macroDirectives': {'macro': value}}
+    cls = compile_to_class('Hello', settings=settings, cache_dir=tmpdir.strpath, class_cache=class_cache)
+    assert cls().respond() == 'Hello'
+    assert compile_to_class('Hello', settings=settings, cache_dir=tmpdir.strpath, class_cache=class_cache) is not cls
+    assert class_cache.stats()['entries'] == 0
+    assert os.listdir(tmpdir.strpath) == []
+
+
+def test_class_cache_evicts_least_recently_used():
+    class_cache = ClassCache(max_entries=2, max_size=10)
+    class_cache.add('a', 'A', 3)
+    class_cache.add('b', 'B', 3)
+    assert class_cache.get('a') == 'A'
+    class_cache.add('c', 'C', 3)
+    assert class_cache.get('b') is None
+    assert class_cache.stats()['evictions'] == 1
+
+    # Too big together
+    class_cache.add('d', 'D', 8)
+    assert class_cache.stats() == {
+        'hits': 1, 'misses': 1, 'evictions': 3, 'entries': 1, 'size': 8,
+    }
+
+
+def test_class_cache_keeps_the_first_class_added():
+    class_cache = ClassCache()
+    assert class_cache.add('a', 'A', 1) == 'A'
+    assert class_cache.add('a', 'A2', 1) == 'A'
+    assert class_cache.get('a') == 'A'
+
+
 def test_compile_file_filename_requires_text():
     with pytest.raises(TypeError):
         compile_file(b'not_text.tmpl')
@@ -207,7 +378,7 @@ def test_compile_to_class_traceback():
     assert re.match(r'''Traceback \(most recent call last\):
   File ".+/tests/compile_test\.py", line \d*, in test_compile_to_class_traceback
     ret\(\).respond\(\)
-  File "<generated cheetah module>", line \d*, in respond
+(    [~^]+\n)?  File "<generated cheetah module>", line \d*, in respond
 ZeroDivisionError: (integer )?division( or modulo)? by zero''', traceback)
 
 
@@ -322,6 +493,7 @@ $arr
 #with $ctx()
     inside ctx
 #end with
+#flush
     """
     compiled_templates = [compile_source(MEGA_TEMPLATE) for _ in range(5)]
     assert len(set(compiled_templates)) == 1
@@ -0,0 +1,119 @@
+"""Render templates concurrently from many threads and subinterpreters."""
+from __future__ import unicode_literals
+
+import collections
+import functools
+import sys
+import threading
+
+import pytest
+
+from Cheetah.compile import compile_to_class
+
+try:
+    import _interpreters as interpreters  # 3.13+
+except ImportError:  # pragma: no cover
+    try:
+        import _xxsubinterpreters as interpreters
+    except ImportError:
+        interpreters = None
+
+
+THREADS = 8
+RENDERS = 200
+
+TEMPLATE = '''\
+$title
+#for $item in $rows
+$item.name=$item.count $describe($item.count)
+#end for
+'''
+
+# Renders TEMPLATE in a subinterpreter, with its own copy of _namemapper
+SUBINTERPRETER_SCRIPT = '''\
+import sys
+sys.path[:] = {path!r}
+
+import collections
+
+from Cheetah import NameMapper
+from Cheetah.compile import compile_to_class
+assert NameMapper._impl.__name__ == 'Cheetah._namemapper', NameMapper._impl
+
+class Describer(object):
+    def describe(self, count):
+        return 'even' if count % 2 == 0 else 'odd'
+
+Row = collections.namedtuple('Row', ('name', 'count'))
+template_cls = compile_to_class({template!r})
+for i in range({renders}):
+    items = [Row('item%d' % j, i + j) for j in range(3)]
+    result = template_cls(searchList=[dict(title="title%d" % i, rows=items), Describer()]).respond()
+    expected = 'title%d\\n' % i + ''.join(
+        '%s=%d %s\\n' % (item.name, item.count, Describer().describe(item.count)) for item in items
+    )
+    assert result == expected, (result, expected)
+'''
+
+
+class Describer(object):
+    def describe(self, count):
+        return 'even' if count % 2 == 0 else 'odd'
+
+
+Row = collections.namedtuple('Row', ('name', 'count'))
+
+
+def _render_many(template_cls, thread_number, start, errors):
+    start.wait()
+    try:
+        for i in range(RENDERS):
+            items = [Row('item{0}'.format(j), thread_number * i + j) for j in range(3)]
+            title = 'thread{0} render{1}'.format(thread_number, i)
+            result = template_cls(searchList=[dict(title=title, rows=items), Describer()]).respond()
+            expected = title + '\n' + ''.join(
+                '{0}={1} {2}\n'.format(item.name, item.count, Describer().describe(item.count))
+                for item in items
+            )
+            assert result == expected, (result, expected)
+    except Exception as e:  # pragma: no cover (only on failure)
+        errors.append(e)
+
+
+def _run_threads(target):
+    start = threading.Event()
+    errors = []
+    threads = [threading.Thread(target=target, args=(i, start, errors)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_render_from_many_threads():
+    template_cls = compile_to_class(TEMPLATE)
+    errors = _run_threads(functools.partial(_render_many, template_cls))
+    assert not errors, errors
+
+
+def _render_in_subinterpreter(thread_number, start, errors):
+    script = SUBINTERPRETER_SCRIPT.format(path=sys.path, template=TEMPLATE, renders=RENDERS // 4)
+    interpreter = interpreters.create()
+    try:
+        start.wait()
+        # 3.13+ returns the error, older versions raise it
+        error = interpreters.run_string(interpreter, script)
+        if error is not None:  # pragma: no cover (only on failure)
+            errors.append(error)
+    except Exception as e:  # pragma: no cover (only on failure)
+        errors.append(e)
+    finally:
+        interpreters.destroy(interpreter)
+
+
+@pytest.mark.skipif(interpreters is None, reason='needs subinterpreters')
+def test_render_in_subinterpreters():
+    errors = _run_threads(_render_in_subinterpreter)
+    assert not errors, errors
@@ -0,0 +1,151 @@
+"""Run the NameMapper tests against the pure python NameMapper."""
+from __future__ import unicode_literals
+
+import io
+import os.path
+import types
+
+import pytest
+
+from Cheetah import _pynamemapper
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Inline caches never hit without dict version tags, the pure python
+# SearchList doesn't remember anything, and these tests don't exercise the
+# NameMapper functions at all.
+EXCLUDED = frozenset((
+    'test_compiled_name_inline_cache',
+    'test_get_refcount_tree_1',
+    'test_get_refcount_tree_2',
+    'test_inline_cache_attribute_hit',
+    'test_inline_cache_autocall',
+    'test_inline_cache_globals_and_builtins',
+    'test_inline_cache_hit',
+    'test_map_builtins_int',
+    'test_refcounting_compiled_name',
+    'test_refcounting_inline_cache',
+    'test_search_list_inline_cache',
+    'test_search_list_remembers_missing_names',
+    'test_search_list_remembers_where_names_are',
+))
+
+
+# python 2 clears the globals of a module once it is collected
+_modules = []
+
+
+def _load_tests(filename):
+    """Execute a NameMapper test module with its NameMapper imports pointed
+    at the pure python version, and return its tests.
+    """
+    with io.open(os.path.join(HERE, filename)) as test_file:
+        source = test_file.read().replace(
+            'from Cheetah.NameMapper import', 'from Cheetah._pynamemapper import',
+        )
+    module = types.ModuleType(str('{0}.{1}'.format(__name__, filename[:-3])))
+    module.__file__ = __file__
+    exec(compile(source, filename, 'exec'), module.__dict__)
+    _modules.append(module)
+    return dict(
+        (name, value) for name, value in vars(module).items()
+        if name.startswith(('test_', 'VF')) and name not in EXCLUDED
+    )
+
+
+globals().update(_load_tests('NameMapper_test.py'))
+globals().update(_load_tests('refcount_test.py'))
+
+
+def test_inline_caches_count_misses():
+    cache = _pynamemapper.InlineCache()
+    name = _pynamemapper.compile_name('foo')
+    for _ in range(2):
+        assert _pynamemapper.valueFromSearchList([{'foo': 1}], 'foo', cache=cache) == 1
+        assert _pynamemapper.valueFromSearchList([{'foo': 1}], name) == 1
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert (name.hits, name.misses) == (0, 2)
+
+
+def test_name_table_is_bounded():
+    for i in range(_pynamemapper.NAME_TABLE_SIZE + 1):
+        with pytest.raises(_pynamemapper.NotFound):
+            _pynamemapper.valueForName({}, 'a{0}'.format(i))
+    assert len(_pynamemapper._name_table) <= _pynamemapper.NAME_TABLE_SIZE
+
+
+def test_not_found_without_a_key():
+    assert str(_pynamemapper.NotFound()) == ''
+    assert str(_pynamemapper.NotFound('a', 'b')) == str(('a', 'b'))
+
+
+def test_not_found_args_can_be_set():
+    exc = _pynamemapper._not_found('a', 'a.b')
+    exc.args = ('hi',)
+    assert str(exc) == 'hi'
+
+
+def test_batch_lookup_not_iterable():
+    with pytest.raises(TypeError):
+        _pynamemapper.valuesFromSearchList(None, ('a',))
+
+
+def test_batch_lookup_flags():
+    searchList = [{'a': lambda: 1}]
+    assert _pynamemapper.valuesFromSearchList(searchList, ('a',), True) == (1,)
+    assert _pynamemapper.valuesFromSearchList(searchList, ('b',), default=None) == (None,)
+
+
+def test_not_found_formatting():
+    assert str(_pynamemapper._not_found('a')) == "cannot find 'a'"
+    assert repr(_pynamemapper._not_found('a', 'a.b')) == repr(
+        _pynamemapper.NotFound("cannot find 'a' while searching for 'a.b'"),
+    )
+
+
+def test_nested_not_found_keeps_its_name():
+    def raises():
+        return _pynamemapper.valueForName({}, 'x.y')
+
+    with pytest.raises(_pynamemapper.NotFound) as excinfo:
+        _pynamemapper.valueFromSearchList([{'a': raises}], 'a.b', True)
+    assert excinfo.value.name == 'x.y'
+
+
+def test_callables_with_mro_are_not_autocalled():
+    class Callable(object):
+        mro = None
+
+        def __call__(self):
+            raise AssertionError('called')
+
+    value = Callable()
+    assert _pynamemapper.valueFromSearchList([{'a': value}], 'a', True) is value
+
+
+def test_search_list_not_iterable():
+    with pytest.raises(TypeError):
+        _pynamemapper.valueFromSearchList(None, 'a')
+
+
+def test_batch_lookup_names_not_a_sequence():
+    with pytest.raises(TypeError):
+        _pynamemapper.valuesFromSearchList([], None)
+
+
+@pytest.mark.parametrize('name', ('keys', 'items', 'get'))
+def test_search_list_finds_dict_attributes_before_later_keys(name):
+    namespaces = [{}, {}, {name: 'key'}]
+    expected = getattr(namespaces[0], name)
+    for lookup in (_pynamemapper.SearchList(namespaces), namespaces):
+        assert _pynamemapper.valueFromSearchList(lookup, name) == expected
+        assert _pynamemapper.valuesFromSearchList(lookup, (name,)) == (expected,)
+
+
+def test_value_for_key():
+    assert _pynamemapper.valueForKey({'a': 1}, 'a') == 1
+    with pytest.raises(_pynamemapper.NotFound):
+        _pynamemapper.valueForKey({}, 'a')
+    with pytest.raises(TypeError):
+        _pynamemapper.valueForKey({}, 1)
@@ -1,10 +1,16 @@
+from __future__ import absolute_import
+
 import gc
 import pytest
 import sys
 
+from Cheetah.NameMapper import InlineCache
+from Cheetah.NameMapper import compile_name
 from Cheetah.NameMapper import valueFromFrame
 from Cheetah.NameMapper import valueFromFrameOrSearchList
 from Cheetah.NameMapper import valueFromSearchList
+from testing.util import call_with_locals
+from testing.util import requires_extension
 
 # pylint:disable=star-args
 
@@ -37,13 +43,13 @@ class NameSpaceObject2(object):
 )
 def test_refcounting(getter_func, namespace, style):
     if style == 'frame':
-        locals().update(vars(namespace))
+        local_vars = vars(namespace)
         SL = None
     elif style == 'searchlist':
-        locals()  # see: http://stackoverflow.com/questions/22263023
+        local_vars = {}
         SL = [namespace]
     elif style == 'both':
-        locals().update(vars(namespace))
+        local_vars = vars(namespace)
         SL = []
     else:
         raise AssertionError('Unknown style: {0}'.format(style))
@@ -58,7 +64,7 @@ def test_refcounting(getter_func, namespace, style):
     refcounts_before = get_refcount_tree(namespace)
 
     # Run the function
-    result = getter_func(*args)
+    result = call_with_locals(local_vars, getter_func, *args)
 
     # Collect refcounts after
     refcounts_after = get_refcount_tree(namespace)
@@ -82,6 +88,63 @@ def test_refcounting(getter_func, namespace, style):
     assert not failures, failures
 
 
+@requires_extension
+@pytest.mark.parametrize('namespace', (NameSpaceObject, NameSpaceObject2))
+@pytest.mark.parametrize(
+    'getter_func', (valueFromSearchList, valueFromFrameOrSearchList),
+)
+def test_refcounting_inline_cache(getter_func, namespace):
+    SL = [{}, namespace]
+    cache = InlineCache()
+    # Fill the cache so the second call is a hit
+    getter_func(SL, 'ns1.ns2.ns3', True, False, cache)
+
+    refcounts_before = get_refcount_tree(namespace)
+    result = getter_func(SL, 'ns1.ns2.ns3', True, False, cache)
+    refcounts_after = get_refcount_tree(namespace)
+    assert cache.hits == 1
+
+    failures = []
+    for name, (refcount_before, id_) in refcounts_before.items():
+        refcount_after, _ = refcounts_after[name]
+        if id_ == id(result):
+            refcount_after -= 1
+        if refcount_before != refcount_after:
+            failures.append(  # pragma: no cover
+                (name, refcount_before, refcount_after),
+            )
+
+    assert not failures, failures
+
+
+@requires_extension
+@pytest.mark.parametrize('namespace', (NameSpaceObject, NameSpaceObject2))
+@pytest.mark.parametrize(
+    'getter_func', (valueFromSearchList, valueFromFrameOrSearchList),
+)
+def test_refcounting_compiled_name(getter_func, namespace):
+    SL = [{}, namespace]
+    name = compile_name('ns1.ns2.ns3', True, False)
+    getter_func(SL, name)
+
+    refcounts_before = get_refcount_tree(namespace)
+    result = getter_func(SL, name)
+    refcounts_after = get_refcount_tree(namespace)
+    assert name.hits == 1
+
+    failures = []
+    for key, (refcount_before, id_) in refcounts_before.items():
+        refcount_after, _ = refcounts_after[key]
+        if id_ == id(result):
+            refcount_after -= 1
+        if refcount_before != refcount_after:
+            failures.append(  # pragma: no cover
+                (key, refcount_before, refcount_after),
+            )
+
+    assert not failures, failures
+
+
 def test_get_refcount_tree_1():
     """Demonstrate what that thing does."""
     t1 = get_refcount_tree(NameSpaceObject)
@@ -0,0 +1,29 @@
+# -*- coding: UTF-8 -*-
+from __future__ import unicode_literals
+
+from Cheetah.compile import compile_to_class
+from Cheetah.wsgi import wsgi_response
+
+
+def _response(template):
+    started = []
+    body = wsgi_response(template, lambda *args: started.append(args))
+    return started, body
+
+
+def test_wsgi_response_streams():
+    cls = compile_to_class(
+        '#block head\nhead\n#end block\nbody ☃\n',
+        settings={'streamingRespond': True},
+    )
+    started, body = _response(cls())
+    assert started == [('200 OK', [('Content-Type', 'text/html; charset=UTF-8')])]
+    assert not isinstance(body, list)
+    assert list(body) == [b'head\n', 'body ☃\n'.encode('UTF-8')]
+
+
+def test_wsgi_response_without_streaming():
+    cls = compile_to_class('body ☃\n')
+    started, body = _response(cls())
+    assert started == [('200 OK', [('Content-Type', 'text/html; charset=UTF-8')])]
+    assert body == ['body ☃\n'.encode('UTF-8')]